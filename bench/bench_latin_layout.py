@@ -0,0 +1,56 @@
+import argparse
+import numpy as np
+
+from common import make_generator, time_it, write_results
+
+
+def legacy_layout(generator, text):
+
+    # the per-char prefix and substring measurements done before the single pass layout
+    font = generator.digital_font
+    for i, c in enumerate(text):
+        font.getmask(c).size
+        font.getsize(c)
+        font.getsize(text[:i+1])
+    for word in text.split("_"):
+        if len(word) > 0:
+            font.getmask(word).size
+            font.getsize(word)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--lengths", type=str, default="10,20,40,80,160",
+        help="Line lengths to benchmark as a comma separated list")
+    parser.add_argument("--font_size", type=int, default=64)
+    parser.add_argument("--min_time", type=float, default=1.0,
+        help="Minimum number of seconds spent on each measurement")
+    parser.add_argument("--legacy", action='store_true', default=False,
+        help="Also time the quadratic prefix measurements of the old layout")
+    parser.add_argument("--output", type=str, default=None,
+        help="Path to a JSON file for the results")
+    args = parser.parse_args()
+
+    generator = make_generator("en", font_sizes=str(args.font_size))
+    generator.select_font()
+    chars = np.array(sorted(set(generator.get_available_chars(0))))
+
+    results = []
+    print(f"{'length':>8} {'layout/s':>12} {'render/s':>12}" + (f" {'legacy/s':>12}" if args.legacy else ""))
+    for length in [int(x) for x in args.lengths.split(",")]:
+        np.random.seed(length)
+        text = "".join(np.random.choice(chars, length))
+        text = "_".join(text[i:i+8] for i in range(0, length, 8))
+        result = {
+            "length": length,
+            "layout_per_sec": time_it(lambda: generator.layout_latin_textline(text), args.min_time),
+            "render_per_sec": time_it(lambda: generator.generate_synthetic_textline_image_latin_based(text), args.min_time),
+        }
+        if args.legacy:
+            result["legacy_per_sec"] = time_it(lambda: legacy_layout(generator, text), args.min_time)
+        results.append(result)
+        print(f"{length:>8} {result['layout_per_sec']:>12.1f} {result['render_per_sec']:>12.1f}" + 
+            (f" {result['legacy_per_sec']:>12.1f}" if args.legacy else ""))
+
+    write_results(results, args.output)
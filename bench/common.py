@@ -0,0 +1,77 @@
+import os
+import sys
+import time
+import json
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from utils.fonts import load_chars, load_coverage, CoverageCache
+from core.core import TextlineGenerator
+
+
+LANGUAGE_SETUPS = {
+    "en": {
+        "font_folder": "fonts/en",
+        "char_paths": ["chars/en/latin_chars.txt", "chars/en/punc_basic_chars.txt"],
+        "char_set_props": [0.8, 0.2],
+        "char_dist": 0,
+    },
+    "jp": {
+        "font_folder": "fonts/jp",
+        "char_paths": ["chars/jp/adobe_1_7_chars.txt", "chars/jp/hiragana_chars.txt", "chars/jp/katakana.txt"],
+        "char_set_props": [0.6, 0.2, 0.2],
+        "char_dist": 15,
+    },
+}
+
+COVERAGE_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "effsynth", "coverage")
+
+
+def make_generator(language, max_length=20, font_sizes="64", word_bbox=True, vertical=False,
+        synth_transform=None, save_path=None, **kwargs):
+
+    setup = LANGUAGE_SETUPS[language]
+    font_folder = os.path.join(REPO_ROOT, setup["font_folder"])
+    font_paths = sorted(os.path.join(font_folder, x) for x in os.listdir(font_folder))
+    char_paths = [os.path.join(REPO_ROOT, x) for x in setup["char_paths"]]
+    coverage_dict, charset_coverage_dict = load_coverage(font_paths, char_paths, CoverageCache(COVERAGE_CACHE_DIR))
+    char_sets = [load_chars(x) for x in char_paths]
+    char_sets_and_props = list(zip(char_sets, setup["char_set_props"]))
+
+    return TextlineGenerator(
+        "bench", font_paths, char_sets_and_props, save_path,
+        synth_transform if not synth_transform is None else (lambda x: x), coverage_dict,
+        max_length, font_sizes, 5, 0.005, 2,
+        language, vertical, None,
+        setup["char_dist"], 2, None,
+        word_bbox, 0, False,
+        1, False, False,
+        charset_coverage_dict=charset_coverage_dict, **kwargs
+    )
+
+
+def time_it(func, min_time=1.0, min_reps=3):
+
+    # returns calls per second, repeating until both limits are reached
+    reps, start = 0, time.perf_counter()
+    while True:
+        func()
+        reps += 1
+        elapsed = time.perf_counter() - start
+        if reps >= min_reps and elapsed >= min_time:
+            return reps / elapsed
+
+
+def time_repeats(func, repeats=3, min_time=1.0, min_reps=3):
+
+    # median, min and max rate over a few independent measurements
+    rates = sorted(time_it(func, min_time, min_reps) for _ in range(repeats))
+    return {"per_sec": rates[len(rates) // 2], "min_per_sec": rates[0], "max_per_sec": rates[-1]}
+
+
+def write_results(results, path):
+    if path is None:
+        return
+    with open(path, "w") as f:
+        json.dump(results, f, indent=2)
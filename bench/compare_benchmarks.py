@@ -0,0 +1,40 @@
+import sys
+import json
+import argparse
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("base", type=str, help="Results of run_benchmarks.py for the base commit")
+    parser.add_argument("new", type=str, help="Results of run_benchmarks.py for the new commit")
+    parser.add_argument("--threshold", type=float, default=0.05,
+        help="Relative change in rate above which a result counts as a regression or improvement")
+    parser.add_argument("--fail_on_regression", action='store_true', default=False,
+        help="Exit with status 1 if any result regressed")
+    args = parser.parse_args()
+
+    with open(args.base) as f:
+        base = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    print(f"base {base['meta'].get('commit')}, new {new['meta'].get('commit')}")
+
+    regressions = 0
+    print(f"{'benchmark':<40} {'base/s':>12} {'new/s':>12} {'change':>9}")
+    for name in sorted(set(base["results"]) | set(new["results"])):
+        if not name in base["results"] or not name in new["results"]:
+            print(f"{name:<40} {'only in ' + ('new' if name in new['results'] else 'base'):>35}")
+            continue
+        base_rate, new_rate = base["results"][name]["per_sec"], new["results"][name]["per_sec"]
+        change = new_rate / base_rate - 1
+        flag = ""
+        if change < -args.threshold:
+            flag = "  regression"
+            regressions += 1
+        elif change > args.threshold:
+            flag = "  improvement"
+        print(f"{name:<40} {base_rate:>12.1f} {new_rate:>12.1f} {change:>+8.1%}{flag}")
+
+    if args.fail_on_regression and regressions > 0:
+        sys.exit(1)
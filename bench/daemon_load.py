@@ -0,0 +1,128 @@
+import os
+import sys
+import time
+import argparse
+import tempfile
+import threading
+import subprocess
+import numpy as np
+
+from common import REPO_ROOT, write_results
+from core.daemon import DaemonClient
+
+
+def start_daemon(socket_path, timeout=60):
+    # the time until the daemon accepts connections is its startup cost
+    start = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, os.path.join(REPO_ROOT, "effsynth_daemon.py"), "--socket", socket_path],
+        cwd=REPO_ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    while True:
+        try:
+            DaemonClient(socket_path).close()
+            return proc, time.perf_counter() - start
+        except (FileNotFoundError, ConnectionRefusedError):
+            if proc.poll() is not None or time.perf_counter() - start > timeout:
+                raise RuntimeError(f"Daemon did not come up:\n{proc.stderr.read() if proc.poll() is not None else ''}")
+            time.sleep(0.05)
+
+
+def run_client(socket_path, request, num_requests, latencies, lines):
+    with DaemonClient(socket_path) as client:
+        for _ in range(num_requests):
+            t0 = time.perf_counter()
+            reply, payloads = client.request(request)
+            latencies.append(time.perf_counter() - t0)
+            lines.append(len(reply["records"]))
+
+
+def cli_baseline(args, out_dir):
+    # one effsynth.py process generating as many lines as a request, startup included
+    cmd = [sys.executable, os.path.join(REPO_ROOT, "effsynth.py"), "--count", str(args.count),
+        "--language", args.language, "--font_folder", os.path.join("fonts", args.language),
+        "--char_folder", os.path.join("chars", args.language), "--char_sets", args.char_sets,
+        "--char_set_props", args.char_set_props, "--train_test_val_props", "1.0,0.0,0.0",
+        "--transforms", args.transforms, "--transform_backend", args.transform_backend,
+        "--output_folder", out_dir]
+    start = time.perf_counter()
+    subprocess.run(cmd, cwd=REPO_ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+    return time.perf_counter() - start
+
+
+def percentiles(latencies):
+    latencies = np.asarray(latencies) * 1000
+    return {"p50_ms": float(np.percentile(latencies, 50)), "p90_ms": float(np.percentile(latencies, 90)),
+        "p99_ms": float(np.percentile(latencies, 99)), "max_ms": float(latencies.max())}
+
+
+if __name__ == '__main__':
+
+    # latency and throughput of a daemon under several concurrent clients, after a cold first request;
+    # starts its own daemon unless --socket points at a running one
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--socket", type=str, default=None)
+    parser.add_argument("--clients", type=str, default="1,2,4",
+        help="Numbers of concurrent clients to measure, as a comma separated list")
+    parser.add_argument("--requests", type=int, default=20,
+        help="Requests sent by every client")
+    parser.add_argument("--count", type=int, default=16,
+        help="Lines per request")
+    parser.add_argument("--language", type=str, default="en")
+    parser.add_argument("--char_sets", type=str, default="latin,punc_basic")
+    parser.add_argument("--char_set_props", type=str, default="0.8,0.2")
+    parser.add_argument("--transforms", type=str, default="pr")
+    parser.add_argument("--transform_backend", type=str, default="numpy")
+    parser.add_argument("--cli_baseline", action="store_true", default=False,
+        help="Also time an effsynth.py process generating one request's worth of lines")
+    parser.add_argument("--output", type=str, default=None,
+        help="Json file the results are written to")
+    args = parser.parse_args()
+
+    request = {"language": args.language, "char_sets": args.char_sets, "char_set_props": args.char_set_props,
+        "transforms": args.transforms, "transform_backend": args.transform_backend, "count": args.count}
+    results = {"request": request}
+
+    proc = None
+    socket_path = args.socket
+    if socket_path is None:
+        socket_path = os.path.join(tempfile.mkdtemp(prefix="effsynth_daemon_"), "daemon.sock")
+        proc, results["startup_s"] = start_daemon(socket_path)
+        print(f"Daemon startup: {results['startup_s']:.2f}s")
+
+    try:
+        # the first request of a configuration loads coverage, fonts and the transform preset
+        with DaemonClient(socket_path) as client:
+            t0 = time.perf_counter()
+            client.request(request)
+            results["cold_request_ms"] = (time.perf_counter() - t0) * 1000
+        print(f"Cold request: {results['cold_request_ms']:.0f}ms for {args.count} lines")
+
+        results["load"] = []
+        for num_clients in [int(x) for x in args.clients.split(",")]:
+            latencies, lines = [], []
+            threads = [threading.Thread(target=run_client, args=(socket_path, request, args.requests, latencies, lines))
+                for _ in range(num_clients)]
+            start = time.perf_counter()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.perf_counter() - start
+            entry = {"clients": num_clients, "requests": len(latencies), **percentiles(latencies),
+                "requests_per_s": len(latencies) / elapsed, "lines_per_s": sum(lines) / elapsed}
+            results["load"].append(entry)
+            print(f"{num_clients:>3} clients: p50 {entry['p50_ms']:.0f}ms p90 {entry['p90_ms']:.0f}ms "
+                f"p99 {entry['p99_ms']:.0f}ms, {entry['requests_per_s']:.1f} requests/s, {entry['lines_per_s']:.0f} lines/s")
+
+        with DaemonClient(socket_path) as client:
+            results["daemon_stats"] = client.stats()
+    finally:
+        if not proc is None:
+            proc.terminate()
+            proc.wait()
+
+    if args.cli_baseline:
+        with tempfile.TemporaryDirectory(prefix="effsynth_cli_") as out_dir:
+            results["cli_s"] = cli_baseline(args, out_dir)
+        print(f"effsynth.py for {args.count} lines: {results['cli_s']:.2f}s")
+
+    write_results(results, args.output)
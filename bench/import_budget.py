@@ -0,0 +1,83 @@
+import os
+import re
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# backends a run only pays for when its transform preset uses them
+HEAVY_MODULES = ("torch", "torchvision", "kornia", "albumentations", "cv2", "matplotlib", "wikipedia", "fontTools")
+MINIMAL_RUN_ARGS = ["--count", "10", "--language", "en", "--font_folder", "fonts/en", "--char_folder", "chars/en",
+    "--char_sets", "latin,punc_basic", "--char_set_props", "0.8,0.2", "--train_test_val_props", "1.0,0.0,0.0",
+    "--transforms", "pr", "--writer_threads", "0"]
+
+# name, effsynth.py args, heavy modules allowed to be imported
+CASES = (
+    ("help", ["--help"], ()),
+    ("minimal_numpy", MINIMAL_RUN_ARGS + ["--transform_backend", "numpy"], ("cv2",)),
+    ("minimal_torch", MINIMAL_RUN_ARGS, ("torch", "torchvision")),
+)
+
+
+def run_case(args, out_dir, importtime=False):
+    # wall time and peak RSS of one effsynth.py process, plus its stderr
+    cmd = [sys.executable] + (["-X", "importtime"] if importtime else []) + [os.path.join(REPO_ROOT, "effsynth.py")] + args
+    if args != ["--help"]:
+        cmd += ["--output_folder", out_dir]
+    start = time.perf_counter()
+    proc = subprocess.Popen(cmd, cwd=REPO_ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    stderr = proc.stderr.read()
+    _, status, rusage = os.wait4(proc.pid, 0)
+    wall_time = time.perf_counter() - start
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    if proc.returncode != 0:
+        raise RuntimeError(f"{' '.join(cmd)} failed:\n{stderr}")
+    # ru_maxrss is in KB on Linux
+    return wall_time, rusage.ru_maxrss / 2**10, stderr
+
+
+def imported_modules(stderr):
+    return set(re.findall(r"^import time:\s+\d+ \|\s+\d+ \|\s*([\w.]+)$", stderr, flags=re.M))
+
+
+if __name__ == '__main__':
+
+    # startup cost of effsynth.py for --help and minimal runs, failing when it goes over budget
+    # or when a case imports a heavy backend it does not use
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--help_budget_s", type=float, default=1.0)
+    parser.add_argument("--minimal_numpy_budget_s", type=float, default=2.0)
+    parser.add_argument("--minimal_torch_budget_s", type=float, default=8.0)
+    parser.add_argument("--help_budget_mb", type=float, default=150)
+    parser.add_argument("--minimal_numpy_budget_mb", type=float, default=250)
+    parser.add_argument("--minimal_torch_budget_mb", type=float, default=1000)
+    args = parser.parse_args()
+
+    failures = []
+    for name, case_args, allowed in CASES:
+        out_dir = tempfile.mkdtemp(prefix="effsynth_startup_")
+        try:
+            runs = []
+            for _ in range(args.repeats):
+                shutil.rmtree(out_dir, ignore_errors=True)
+                runs.append(run_case(case_args, out_dir)[:2])
+            shutil.rmtree(out_dir, ignore_errors=True)
+            modules = imported_modules(run_case(case_args, out_dir, importtime=True)[2])
+        finally:
+            shutil.rmtree(out_dir, ignore_errors=True)
+        wall_time, rss = min(x[0] for x in runs), max(x[1] for x in runs)
+        heavy = sorted(x for x in HEAVY_MODULES if x in modules and not x in allowed)
+        time_budget, rss_budget = getattr(args, f"{name}_budget_s"), getattr(args, f"{name}_budget_mb")
+        print(f"{name:<16} {wall_time:>6.2f}s (budget {time_budget:.2f}s) {rss:>7.1f}MB (budget {rss_budget:.0f}MB)"
+            + (f" unexpected imports: {', '.join(heavy)}" if len(heavy) > 0 else ""))
+        if wall_time > time_budget or rss > rss_budget or len(heavy) > 0:
+            failures.append(name)
+
+    if len(failures) > 0:
+        print(f"Over budget: {', '.join(failures)}")
+        sys.exit(1)
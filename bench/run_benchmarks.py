@@ -0,0 +1,182 @@
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+import numpy as np
+
+from common import REPO_ROOT, LANGUAGE_SETUPS, make_generator, time_repeats, write_results
+from utils.misc import seed_rngs
+
+
+# the effsynth.py char set arguments matching LANGUAGE_SETUPS
+E2E_ARGS = {
+    "en": ["--char_folder", "chars/en", "--char_sets", "latin,punc_basic", "--char_set_props", "0.8,0.2"],
+    "jp": ["--char_folder", "chars/jp", "--char_sets", "adobe,hiragana,katakana", "--char_set_props", "0.6,0.2,0.2",
+        "--char_dist", "15"],
+}
+
+
+def reseed(seed):
+    seed_rngs(np.random.SeedSequence(seed))
+
+
+def sample_lines(generator, num_lines, seed):
+    # fixed (font, size, text) triples for the render and transform benchmarks
+    reseed(seed)
+    lines = []
+    while len(lines) < num_lines:
+        text = generator.next_synthetic_text()
+        if not all(c == "_" or c.isspace() for c in text):
+            lines.append((generator.font_path, generator.font_size, text))
+    return lines
+
+
+def render_line(generator, line):
+    font_path, font_size, text = line
+    generator.set_font(font_path, font_size)
+    generator.num_symbols = len(text)
+    if generator.language == "en":
+        return generator.generate_synthetic_textline_image_latin_based(text)
+    return generator.generate_synthetic_textline_image_character_based(text)
+
+
+def cycle(func, items):
+    # a zero argument callable stepping through items, so every call does comparable work
+    state = {"i": 0}
+    def step():
+        func(items[state["i"] % len(items)])
+        state["i"] += 1
+    return step
+
+
+def bench_text(args, results):
+    for language in args.languages:
+        for length in args.lengths:
+            generator = make_generator(language, max_length=length)
+            generator.select_font()
+            font_idxs = np.full(64, generator.font_index[generator.font_path])
+            reseed(args.seed)
+            results[f"text/{language}/len{length}"] = time_repeats(
+                generator.generate_synthetic_textline_text, args.repeats, args.min_time)
+            reseed(args.seed)
+            rates = time_repeats(lambda: generator.generate_synthetic_textline_texts(font_idxs), args.repeats, args.min_time)
+            results[f"text_batch/{language}/len{length}"] = {k: v * len(font_idxs) for k, v in rates.items()}
+
+
+def bench_render(args, results):
+    for language in args.languages:
+        for length in args.lengths:
+            for font_size in args.font_sizes:
+                generator = make_generator(language, max_length=length, font_sizes=str(font_size),
+                    vertical=language == "jp")
+                lines = sample_lines(generator, args.num_lines, args.seed)
+                # timed with warm font and glyph caches, as in a long run
+                for line in lines:
+                    render_line(generator, line)
+                results[f"render/{language}/len{length}/size{font_size}"] = time_repeats(
+                    cycle(lambda line: render_line(generator, line), lines), args.repeats, args.min_time)
+
+
+def bench_transform(args, results):
+    from utils.transforms import TRANSFORM_DICT, get_synth_transform
+    generator = make_generator("en", max_length=20)
+    images = [render_line(generator, line)["image"] for line in sample_lines(generator, args.num_lines, args.seed)]
+    for backend in args.transform_backends:
+        for preset in TRANSFORM_DICT:
+            transform = get_synth_transform(preset, "numpy" if backend == "numpy" else "torch", backend == "batch")
+            transform(images[0])
+            reseed(args.seed)
+            if backend == "batch":
+                rates = time_repeats(lambda: transform.transform_batch(images), args.repeats, args.min_time)
+                rates = {k: v * len(images) for k, v in rates.items()}
+            else:
+                rates = time_repeats(cycle(transform, images), args.repeats, args.min_time)
+            results[f"transform/{backend}/{preset}"] = rates
+
+
+def bench_e2e(args, results):
+    # the whole effsynth.py loop, as lines/s measured by its profiler so startup is left out
+    for language in args.languages:
+        out_dir = tempfile.mkdtemp(prefix="effsynth_bench_")
+        try:
+            profile_path = os.path.join(out_dir, "profile.json")
+            cmd = [sys.executable, os.path.join(REPO_ROOT, "effsynth.py"), "--count", str(args.e2e_count),
+                "--language", language, "--font_folder", LANGUAGE_SETUPS[language]["font_folder"],
+                *E2E_ARGS[language], "--output_folder", out_dir, "--profile", "--profile_interval", "0",
+                "--profile_output", profile_path, "--word_bbox", "--train_test_val_props", "1.0,0.0,0.0"]
+            if language == "jp":
+                cmd.append("--vertical")
+            start = time.perf_counter()
+            subprocess.run(cmd, cwd=REPO_ROOT, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            wall_time = time.perf_counter() - start
+            with open(profile_path) as f:
+                profile = json.load(f)
+            results[f"e2e/{language}"] = {"per_sec": profile["lines_per_s"], "wall_s": wall_time,
+                "stage_mean_s": {k: v["mean_s"] for k, v in profile["stages"].items()}}
+        finally:
+            shutil.rmtree(out_dir, ignore_errors=True)
+
+
+def run_meta():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO_ROOT, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = None
+    import PIL
+    import torch
+    return {"commit": commit, "time": time.strftime("%Y-%m-%dT%H:%M:%S"), "python": platform.python_version(),
+        "platform": platform.platform(), "cpu_count": os.cpu_count(), "numpy": np.__version__,
+        "pillow": PIL.__version__, "torch": torch.__version__}
+
+
+BENCHMARKS = {
+    "text": bench_text,
+    "render": bench_render,
+    "transform": bench_transform,
+    "e2e": bench_e2e,
+}
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--benchmarks", type=str, default=",".join(BENCHMARKS),
+        help="Benchmark groups to run as a comma separated list")
+    parser.add_argument("--filter", type=str, default=None,
+        help="Regex that result names must match to be kept")
+    parser.add_argument("--languages", type=str, default="en,jp")
+    parser.add_argument("--lengths", type=str, default="10,20,40")
+    parser.add_argument("--font_sizes", type=str, default="32,64")
+    parser.add_argument("--transform_backends", type=str, default="torch,numpy,batch")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--num_lines", type=int, default=32,
+        help="Number of fixed lines the render and transform benchmarks cycle through")
+    parser.add_argument("--e2e_count", type=int, default=500,
+        help="Number of textlines generated by the end to end benchmark")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--min_time", type=float, default=1.0,
+        help="Minimum number of seconds spent on each measurement")
+    parser.add_argument("--output", type=str, default=None,
+        help="Path to a JSON file for the results, to be compared with compare_benchmarks.py")
+    args = parser.parse_args()
+    args.languages = args.languages.split(",")
+    args.lengths = [int(x) for x in args.lengths.split(",")]
+    args.font_sizes = [int(x) for x in args.font_sizes.split(",")]
+    args.transform_backends = args.transform_backends.split(",")
+
+    results = {}
+    for name in args.benchmarks.split(","):
+        group = {}
+        BENCHMARKS[name](args, group)
+        for key, value in group.items():
+            if args.filter is None or re.search(args.filter, key):
+                results[key] = value
+                print(f"{key:<40} {value['per_sec']:>12.1f}/s")
+
+    write_results({"meta": run_meta(), "args": {k: v for k, v in vars(args).items()}, "results": results}, args.output)
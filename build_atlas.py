@@ -0,0 +1,67 @@
+import os
+import argparse
+import multiprocessing
+import numpy as np
+
+from utils.fonts import load_char_sets, load_coverage, chars_to_codepoints, CoverageCache
+from utils.atlas import build_atlas
+
+
+def build_task(task):
+    atlas_dir, font_path, font_size, codepoints = task
+    num_glyphs, num_bytes = build_atlas(atlas_dir, font_path, font_size, codepoints)
+    return font_path, font_size, num_glyphs, num_bytes
+
+
+if __name__ == '__main__':
+
+    # renders the covered glyphs of every (font, size) once into memory mapped atlases,
+    # which effsynth.py reads through --glyph_atlas_dir instead of rasterizing them in every process
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--font_folder", type=str, required=True,
+        help="Path to folder with font files of interest")
+    parser.add_argument("--font_sizes", type=str, default="64",
+        help="Font sizes to build atlases for as a comma separated list")
+    parser.add_argument("--atlas_dir", type=str, required=True,
+        help="Folder the atlases are written to")
+    parser.add_argument("--char_folder", type=str, default=None,
+        help="Path to folder with character set text files; without it every glyph a font covers is rendered")
+    parser.add_argument("--char_sets", type=str, default=None,
+        help="Names of character sets to render as a comma separated list")
+    parser.add_argument("--coverage_cache_dir", type=str,
+        default=os.path.join(os.path.expanduser("~"), ".cache", "effsynth", "coverage"),
+        help="Folder for cached font coverage; empty disables it")
+    parser.add_argument("--workers", type=int, default=1,
+        help="Number of processes building atlases")
+    args = parser.parse_args()
+
+    font_paths = [os.path.join(args.font_folder, x) for x in os.listdir(args.font_folder)]
+    coverage_cache = CoverageCache(args.coverage_cache_dir)
+    if not args.char_sets is None:
+        num_sets = len(args.char_sets.split(","))
+        chosen_char_paths, _ = load_char_sets(args.char_folder, args.char_sets, ",".join([str(1 / num_sets)] * num_sets))
+    else:
+        chosen_char_paths = []
+    coverage_dict, charset_coverage_dict = load_coverage(font_paths, chosen_char_paths, coverage_cache)
+
+    # the chosen char sets, or the whole coverage, plus the space placeholder and digits used for numbers
+    tasks = []
+    for font_path in font_paths:
+        covered = chars_to_codepoints(coverage_dict[font_path])
+        if len(chosen_char_paths) > 0:
+            codepoints = np.concatenate(charset_coverage_dict[font_path])
+        else:
+            codepoints = covered
+        codepoints = np.union1d(codepoints, np.intersect1d(covered, chars_to_codepoints("_0123456789")))
+        for font_size in [int(x) for x in args.font_sizes.split(",")]:
+            tasks.append((args.atlas_dir, font_path, font_size, codepoints))
+
+    total_bytes = 0
+    pool = multiprocessing.Pool(args.workers) if args.workers > 1 else None
+    for font_path, font_size, num_glyphs, num_bytes in (pool.imap_unordered(build_task, tasks) if not pool is None else map(build_task, tasks)):
+        print(f"{font_path} at size {font_size}: {num_glyphs} glyphs, {num_bytes / 2**20:.1f} MB")
+        total_bytes += num_bytes
+    if not pool is None:
+        pool.close()
+        pool.join()
+    print(f"Built {len(tasks)} atlases in {args.atlas_dir}, {total_bytes / 2**20:.1f} MB of glyphs")
@@ -1,10 +1,28 @@
 import numpy as np
-from PIL import ImageOps, Image, ImageFont, ImageDraw
+from PIL import Image, ImageDraw
 import os
 import re
-import wikipedia
+from collections import deque
+from functools import partial
 
 from utils.misc import *
+from utils.fonts import FontCache, chars_to_codepoints
+from utils.glyphs import GlyphCache, rasterize_glyph, glyph_metrics
+from utils.lexicon import Lexicon
+from utils.profiling import StageProfiler
+from utils.shards import CODECS, encode_image, image_save_kwargs
+from utils.image_writer import write_bytes
+
+
+SETNAMES = ("train", "test", "val",)
+
+# TextlineGenerator arguments, with the defaults of effsynth.py
+GENERATOR_DEFAULTS = {
+    "max_length": 20, "font_sizes": "64", "max_spaces": 5, "num_geom_p": 0.005, "max_numbers": 2,
+    "vertical": False, "spec_seqs": None, "char_dist": 0, "char_dist_std": 2, "p_specseq": None,
+    "word_bbox": False, "real_words": 0, "single_words": False, "specseq_count": 1,
+    "wiki_text": False, "case_aug": False,
+}
 
 
 class TextlineGenerator:
@@ -15,7 +33,11 @@ class TextlineGenerator:
             max_length, font_sizes, max_spaces, num_geom_p, max_numbers,
             language, vertical, spec_seqs, char_dist, char_dist_std,
             p_specseq, word_bbox, real_words, single_words, specseq_count,
-            wiki_text, case_aug
+            wiki_text, case_aug, font_cache=None, glyph_cache=None,
+            charset_coverage_dict=None, text_batch_size=64,
+            image_codec="png", png_compress_level=6, encode_only=False, image_writer=None,
+            skip_existing=False, corpus=None, lexicon=None, profiler=None, seed=None, glyph_atlas=None,
+            grayscale=False, variants=None
         ):
 
         self.setname = setname
@@ -25,6 +47,8 @@ class TextlineGenerator:
         self.all_chars = set(sum(self.char_sets, []))
         self.save_path = save_path
         self.synth_transform = synth_transform
+        # (name, transform, sample, save path) of every variant a render is fanned out to
+        self.variants = variants
         self.coverage_dict = coverage_dict
         self.max_length = max_length
         self.font_sizes = [int(x) for x in font_sizes.split(",")]
@@ -43,74 +67,214 @@ class TextlineGenerator:
             assert len(self.p_specseq) == len(self.spec_seqs)
             assert round(sum(self.p_specseq), 4) == 1., f"Probs of spec seqs do not add to 1! ({sum(self.p_specseq)})"
         self.word_bbox = word_bbox
-        if real_words > 0 or single_words:
+        self.lexicon = lexicon
+        if self.lexicon is None and ((real_words > 0 and not wiki_text and corpus is None) or single_words):
             assert os.name == "posix", "Not a unix OS; adding in real words won't work!"
-            with open("/usr/share/dict/words", "r") as f:
-                words = re.sub("[^\w]", " ",  f.read()).split()
-            self.words = words
+            self.lexicon = Lexicon.from_file()
         self.num_real_words = real_words
         self.single_words = single_words
         self.wiki_text = wiki_text
         self.case_aug = case_aug
+        self.font_cache = font_cache if not font_cache is None else FontCache()
+        self.glyph_cache = glyph_cache if not glyph_cache is None else GlyphCache()
+        self.glyph_atlas = glyph_atlas
+        # grayscale textlines are rendered in one channel, and only expanded by color transforms
+        self.grayscale = grayscale
+
+        # covered chars of each char set, concatenated over fonts so a batch can be sampled at once
+        if charset_coverage_dict is None:
+            charset_coverage_dict = {}
+            for font_path in self.font_paths:
+                covered_codepoints = chars_to_codepoints(self.coverage_dict[font_path])
+                charset_coverage_dict[font_path] = [np.intersect1d(covered_codepoints, chars_to_codepoints(char_set)) 
+                    for char_set in self.char_sets]
+        self.font_index = {font_path: i for i, font_path in enumerate(self.font_paths)}
+        self.available_chars, self.available_offsets, self.available_counts = [], [], []
+        for j in range(len(self.char_sets)):
+            arrays = [np.asarray(charset_coverage_dict[font_path][j], dtype="<u4") for font_path in self.font_paths]
+            counts = np.array([len(x) for x in arrays])
+            self.available_chars.append(np.concatenate(arrays).view("<U1"))
+            self.available_offsets.append(np.cumsum(counts) - counts)
+            self.available_counts.append(counts)
+        # with a seed, every image draws from its own stream derived from (seed, split, image id),
+        # so texts are sampled one at a time
+        self.seed = seed
+        self.text_batch_size = text_batch_size if seed is None else 1
+        self.text_buffer = deque()
+        self.image_codec = image_codec
+        self.png_compress_level = png_compress_level
+        self.encode_only = encode_only
+        self.image_writer = image_writer
+        self.skip_existing = skip_existing
+        self.corpus = corpus
+        self.profiler = profiler if not profiler is None else StageProfiler()
+        self.font_time = 0.
+
+    def reseed(self, seed_seq):
+
+        # drop texts sampled from the previous random stream
+        seed_rngs(seed_seq)
+        self.text_buffer.clear()
+
+    def image_seed_seq(self, image_id, *key):
+
+        return np.random.SeedSequence(self.seed, spawn_key=(SETNAMES.index(self.setname), image_id, *key))
 
     def select_font(self):
 
         font_path = np.random.choice(self.font_paths)
-        self.font_size = int(np.random.choice(self.font_sizes))
-        self.digital_font = ImageFont.truetype(font_path, size=self.font_size)
-        self.covered_chars = set(self.coverage_dict[font_path])
+        font_size = int(np.random.choice(self.font_sizes))
+        self.set_font(font_path, font_size)
+
+    def set_font(self, font_path, font_size):
+
+        t0 = self.profiler.tic()
+        self.font_size = int(font_size)
+        self.font_path = str(font_path)
+        self.digital_font = self.font_cache.get_font(self.font_path, self.font_size)
+        self.covered_chars = self.font_cache.get_covered_chars(self.font_path, self.coverage_dict[self.font_path])
+        self.font_time += self.profiler.toc("font", t0, font=os.path.basename(self.font_path))
+
+    def get_available_chars(self, char_set_idx):
+
+        font_idx = self.font_index[self.font_path]
+        offset = self.available_offsets[char_set_idx][font_idx]
+        count = self.available_counts[char_set_idx][font_idx]
+        return self.available_chars[char_set_idx][offset:offset+count]
+
+    def get_char_metrics(self, c):
+
+        # mask size and full size of a single glyph, from the atlas if it has the glyph
+        if not self.glyph_atlas is None:
+            metrics = self.glyph_atlas.get_metrics(self.font_path, self.font_size, c)
+            if not metrics is None:
+                return metrics
+        key = ("metrics", self.font_path, self.font_size, c)
+        metrics = self.glyph_cache.get(key)
+        if metrics is None:
+            metrics = self.glyph_cache.put(key, glyph_metrics(self.digital_font, c), 64)
+        return metrics
+
+    def get_char_render(self, c):
+
+        # render of a single glyph and its bbox, from the atlas if it has the glyph
+        if not self.glyph_atlas is None:
+            entry = self.glyph_atlas.get_render(self.font_path, self.font_size, c)
+            if not entry is None:
+                return entry
+        key = ("render", self.font_path, self.font_size, c)
+        entry = self.glyph_cache.get(key)
+        if entry is None:
+            char_render, bbox = rasterize_glyph(self.digital_font, self.font_size, c)
+            nbytes = char_render.nbytes + 64 if not char_render is None else 64
+            entry = self.glyph_cache.put(key, (char_render, bbox), nbytes)
+        return entry
 
     def generate_synthetic_textline_text(self):
 
-        seq_chars = []
-        num_chars = np.random.choice(range(1, self.max_length))
-        props = [x[1] for x in self.char_sets_and_props]
-        for char_set, prop in self.char_sets_and_props:
-            if prop == max(props) and round(prop * num_chars) == 0:
-                char_set_count = 1
-            else:
-                char_set_count = round(prop * num_chars)
-            available_chars = self.covered_chars.intersection(set(char_set))
-            chosen_chars = np.random.choice(list(available_chars), char_set_count)
-            seq_chars.extend(chosen_chars)
-        
-        num_spaces = np.random.choice(range(0, self.max_spaces))
-        seq_spaces = num_spaces * ["_"]
-        
-        num_numbers = np.random.choice(range(0, self.max_numbers))
-        seq_numbers = np.random.geometric(p=self.num_geom_p, size=num_numbers)
+        synth_text = self.generate_synthetic_textline_texts([self.font_index[self.font_path]])[0]
+        self.num_symbols = len(synth_text)
+
+        return synth_text
 
-        synth_seq = to_string_list(seq_numbers) + to_string_list(seq_spaces) + to_string_list(seq_chars)
+    def generate_synthetic_textline_texts(self, font_idxs):
+
+        # sample one text per font index, with random draws made for the whole batch at once
+        font_idxs = np.asarray(font_idxs)
+        k = len(font_idxs)
+        tokens = [[] for _ in range(k)]
+
+        num_chars = np.random.randint(1, self.max_length, size=k)
+        props = [x[1] for x in self.char_sets_and_props]
+        for j, (char_set, prop) in enumerate(self.char_sets_and_props):
+            char_set_counts = np.round(prop * num_chars).astype(int)
+            if prop == max(props):
+                char_set_counts[char_set_counts == 0] = 1
+            counts = self.available_counts[j][font_idxs]
+            assert np.all(counts[char_set_counts > 0] > 0), "Selected font covers no characters of a character set!"
+            line_idxs = np.repeat(np.arange(k), char_set_counts)
+            draws = self.available_offsets[j][font_idxs][line_idxs] + \
+                (np.random.random(len(line_idxs)) * counts[line_idxs]).astype(int)
+            chosen_chars = self.available_chars[j][draws].tolist()
+            for i, c in zip(line_idxs.tolist(), chosen_chars):
+                tokens[i].append(c)
+
+        num_spaces = np.random.randint(0, self.max_spaces, size=k)
+        for i, n in enumerate(num_spaces.tolist()):
+            tokens[i].extend(n * ["_"])
+
+        num_numbers = np.random.randint(0, self.max_numbers, size=k)
+        seq_numbers = np.random.geometric(p=self.num_geom_p, size=num_numbers.sum())
+        for i, number in zip(np.repeat(np.arange(k), num_numbers).tolist(), seq_numbers.tolist()):
+            tokens[i].append(str(number))
 
         if not self.spec_seqs is None:
-            for _ in range(self.specseq_count):
-                seq_spec = np.random.choice(self.spec_seqs, p=self.p_specseq)
-                synth_seq += [seq_spec]
+            seq_specs = np.random.choice(len(self.spec_seqs), size=(k, self.specseq_count), p=self.p_specseq)
+            for i in range(k):
+                tokens[i].extend(self.spec_seqs[x] for x in seq_specs[i].tolist())
 
         if self.num_real_words > 0:
-            random_words = np.random.choice(self.words, self.num_real_words).tolist()
-            synth_seq += [f"_{w}_" for w in random_words]
-            synth_seq
+            for font_idx in np.unique(font_idxs).tolist():
+                rows = np.flatnonzero(font_idxs == font_idx)
+                random_words = self.lexicon.sample(self.font_paths[font_idx], size=(len(rows), self.num_real_words))
+                for i, word_ids in zip(rows.tolist(), random_words.tolist()):
+                    tokens[i].extend(f"_{self.lexicon.word(x)}_" for x in word_ids)
+
+        # shuffle tokens within each line by sorting on random keys
+        line_idxs = np.repeat(np.arange(k), [len(x) for x in tokens])
+        flat_tokens = sum(tokens, [])
+        order = np.lexsort((np.random.random(len(flat_tokens)), line_idxs))
+        synth_seqs = [[] for _ in range(k)]
+        for idx in order.tolist():
+            synth_seqs[line_idxs[idx]].append(flat_tokens[idx])
+
+        synth_texts = [re.sub("_+",  "_", "".join(synth_seq)) for synth_seq in synth_seqs]
+        for synth_text in synth_texts:
+            assert len(synth_text) > 0, synth_text
+
+        return synth_texts
+
+    def fill_text_buffer(self):
+
+        font_idxs = np.random.randint(0, len(self.font_paths), size=self.text_batch_size)
+        font_sizes = np.random.choice(self.font_sizes, size=self.text_batch_size)
+        synth_texts = self.generate_synthetic_textline_texts(font_idxs)
+        self.text_buffer.extend(zip(font_idxs.tolist(), font_sizes.tolist(), synth_texts))
+
+    def next_synthetic_text(self):
+
+        # font loading is timed on its own, and left out of the text time
+        t0 = self.profiler.tic()
+        self.font_time = 0.
+        if self.single_words:
+            self.select_font()
+            synth_text = self.generate_synthetic_word_text()
+        elif not self.corpus is None:
+            self.select_font()
+            synth_text = self.generate_synthetic_corpus_text()
+        elif self.wiki_text:
+            self.select_font()
+            synth_text = self.generate_synthetic_wiki_text()
+        else:
+            if len(self.text_buffer) == 0:
+                self.fill_text_buffer()
+            font_idx, font_size, synth_text = self.text_buffer.popleft()
+            self.set_font(self.font_paths[font_idx], font_size)
+        self.profiler.toc("text", t0, exclude=self.font_time)
 
-        np.random.shuffle(synth_seq)
-        synth_text = "".join(synth_seq)
-        synth_text = re.sub("_+",  "_", synth_text)
         self.num_symbols = len(synth_text)
 
-        assert len(synth_text) > 0, synth_text
-
         return synth_text
 
     def generate_synthetic_word_text(self):
 
-        random_word = np.random.choice(self.words)
+        random_word = self.lexicon.sample_words(self.font_path)[0]
 
         random_chars = []
         num_chars = np.random.choice(range(1, self.max_length))
-        for char_set, prop in self.char_sets_and_props:
+        for j, (char_set, prop) in enumerate(self.char_sets_and_props):
             char_set_count = round(prop * num_chars)
-            available_chars = self.covered_chars.intersection(set(char_set))
-            chosen_chars = np.random.choice(list(available_chars), char_set_count)
+            chosen_chars = np.random.choice(self.get_available_chars(j), char_set_count)
             random_chars.extend(chosen_chars)
         np.random.shuffle(random_chars)
         random_chars = "".join(random_chars)
@@ -131,6 +295,7 @@ class TextlineGenerator:
 
     def generate_synthetic_wiki_text(self):
 
+        import wikipedia
         wikipedia.set_lang(self.language)
         wikipedia.set_rate_limiting(rate_limit=True)
 
@@ -164,167 +329,310 @@ class TextlineGenerator:
         return synth_text
         
 
-    def generate_synthetic_textline_image_latin_based(self, text):
+    def generate_synthetic_corpus_text(self):
 
-        W = sum(self.digital_font.getsize(c)[0] + self.char_dist for c in text) - (2 * self.char_dist)
-        H = self.digital_font.getsize(text)[1]
-        image = Image.new("RGB", (W, H), (255,255,255))
-        draw = ImageDraw.Draw(image)
-        x_pos, y_pos = 0, 0
-        bboxes = []
+        # the same word or char windows as generate_synthetic_wiki_text, from the local corpus
+        synth_text = " "
 
-        if self.word_bbox:
-            word_bboxes = []
-            next_word_first_char = 0
-            running_word_len = 0
-            next_word_start_x = x_pos
-        
-        for i, c in enumerate(text):
+        if self.num_real_words > 0:
+            num_words = np.random.choice(range(1, self.num_real_words))
+            while str.isspace(synth_text) or len(synth_text)==0:
+                synth_words = self.corpus.sample_words(num_words)
+                if self.case_aug:
+                    case_func = np.random.choice([self.make_cap, self.make_upper, self.make_lower])
+                    synth_words = [case_func(x) for x in synth_words]
+                synth_text = "_".join(synth_words)
+
+        else:
+            num_chars = np.random.choice(range(1, self.max_length))
+            while str.isspace(synth_text) or len(synth_text)==0:
+                synth_text = self.corpus.sample_chars(num_chars)
+
+        self.num_symbols = len(synth_text)
+
+        return synth_text
+
+    def layout_latin_textline(self, text):
+
+        # char and word boxes from per-glyph metrics, in a single pass over the text
+        metrics = [self.get_char_metrics(c) for c in text]
+        x_jiggles = np.random.normal(self.char_dist, self.char_dist_std, size=len(text))
+        offsets = (self.char_dist + x_jiggles).astype(int).tolist()
+
+        W = sum(size_w + self.char_dist for _, _, size_w, _ in metrics) - (2 * self.char_dist)
+        H = max(size_h for _, _, _, size_h in metrics)
+        x_pos = 0
+        char_positions, bboxes, word_bboxes = [], [], []
 
-            w, h = self.digital_font.getmask(c).size
-            bottom_1 = self.digital_font.getsize(c)[1]
-            bottom_2 = self.digital_font.getsize(text[:i+1])[1]
-            bottom = bottom_1 if bottom_1 < bottom_2 else bottom_2
-            x_jiggle = np.random.normal(self.char_dist, self.char_dist_std)
-            offset = int(self.char_dist + x_jiggle)
+        # a word spans text[word_first_char:i]; its mask spans the lowest top to the highest bottom
+        word_first_char, word_start_x, running_word_len = 0, x_pos, 0
+        word_top, word_bottom = None, None
+
+        for i, (c, (w, h, _, bottom), offset) in enumerate(zip(text, metrics, offsets)):
 
             if c != "_":
 
-                bbox = (x_pos, max(bottom - h, 0), w, h)
-                bboxes.append(bbox)
-                draw.text((x_pos, y_pos), c, font=self.digital_font, fill=1)
+                bboxes.append((x_pos, max(bottom - h, 0), w, h))
+                char_positions.append((x_pos, c))
                 x_pos += w + offset
-                if safe_list_get(text, i+1, False) == "_" or i == len(text) - 1:
+                if i == len(text) - 1 or text[i+1] == "_":
                     running_word_len += w
                 else:
                     running_word_len += w + offset
-                
+
             else:
 
                 x_pos += w + offset
-                if i == 0 and self.word_bbox:
-                    next_word_start_x = x_pos
-                if i != 0 and self.word_bbox:
-                    _, wh = self.digital_font.getmask(text[next_word_first_char:i]).size
-                    word_bottom = self.digital_font.getsize(text[next_word_first_char:i])[1]
-                    next_word_first_char = i + 1
-                    wbbx = (next_word_start_x, max(word_bottom - wh, 0), running_word_len, wh)
-                    running_word_len = 0
-                    next_word_start_x = x_pos
-                    word_bboxes.append(wbbx)
-                
+                if i == 0:
+                    word_start_x = x_pos
+                else:
+                    word_y = max(word_top, 0) if not word_top is None else 0
+                    word_h = word_bottom - word_top if not word_top is None else 0
+                    word_bboxes.append((word_start_x, word_y, running_word_len, word_h))
+                    word_first_char, word_start_x, running_word_len = i + 1, x_pos, 0
+                    word_top, word_bottom = None, None
+                    continue
+
+            if i >= word_first_char:
+                top = bottom - h
+                word_top = top if word_top is None or top < word_top else word_top
+                word_bottom = bottom if word_bottom is None or bottom > word_bottom else word_bottom
+
+        if text[-1] != "_":
+            word_y = max(word_top, 0) if not word_top is None else 0
+            word_h = word_bottom - word_top if not word_top is None else 0
+            word_bboxes.append((word_start_x, word_y, running_word_len, word_h))
+
+        return W, H, char_positions, bboxes, word_bboxes
+
+    def generate_synthetic_textline_image_latin_based(self, text):
+
+        W, H, char_positions, bboxes, word_bboxes = self.layout_latin_textline(text)
+        image = Image.new("L", (W, H), 255) if self.grayscale else Image.new("RGB", (W, H), (255,255,255))
+        draw = ImageDraw.Draw(image)
+        for x_pos, c in char_positions:
+            draw.text((x_pos, 0), c, font=self.digital_font, fill=1)
+
         if self.word_bbox:
-            if text[i] != "_":
-                _, wh = self.digital_font.getmask(text[next_word_first_char:]).size
-                word_bottom = self.digital_font.getsize(text[next_word_first_char:])[1]
-                wbbx = (next_word_start_x, max(word_bottom - wh, 0), running_word_len, wh)
-                word_bboxes.append(wbbx)
             return {"bboxes": bboxes, "word_bboxes": word_bboxes, "image": image}
         else:
             return {"bboxes": bboxes, "image": image}
     
-    def generate_synthetic_textline_image_character_based(self, text):
+    def layout_character_textline(self, text):
 
-        # create character renders
-        char_renders = []
-        for c in text:
-            img = Image.new('RGB', (self.font_size*4, self.font_size*4), (0, 0, 0))
-            draw = ImageDraw.Draw(img)
-            draw.text((self.font_size, self.font_size), c, (255, 255, 255), 
-                font=self.digital_font, anchor='mm')
-            bbox = img.getbbox()
-            if bbox is None:
-                self.num_symbols -= 1
-                continue
-            x0, y0, x1, y1 = bbox
-            pbbox = (x0, y0, x1, y1)
-            char_render = ImageOps.invert(img.crop(pbbox))
-            char_renders.append(char_render)
+        # glyph renders and their positions on the canvas, with the jiggles of all inked glyphs drawn at once
+        glyphs = [(c, render) for c, render in zip(text, [self.get_char_render(c)[0] for c in text]) if not render is None]
+        self.num_symbols = len(glyphs)
+        num_ink = sum(c != "_" for c, _ in glyphs)
+        jiggles = np.minimum(self.char_dist, np.abs(np.random.normal(0, self.char_dist_std, size=num_ink)))
+        advances = iter((self.char_dist - jiggles).astype(int).tolist())
 
-        # create canvas
         if not self.vertical:
-            total_width = sum(cr.width for cr in char_renders)
-            canvas_w = int((self.char_dist * (self.num_symbols + 1)) + total_width)
-            canvas_h = int(self.font_size) 
-            canvas = Image.new('RGB', (canvas_w, canvas_h), (255, 255, 255))
+            canvas_w = self.char_dist * (self.num_symbols + 1) + sum(render.shape[1] for _, render in glyphs)
+            canvas_h = int(self.font_size)
         else:
-            total_height = sum(cr.height for cr in char_renders)
-            canvas_h = int((self.char_dist * (self.num_symbols + 1)) + total_height)
-            canvas_w = int(self.font_size) 
-            canvas = Image.new('RGB', (canvas_w, canvas_h), (255, 255, 255))
-        
-        # pasting
-        bboxes = []
-        if self.vertical:
-            y = self.char_dist
-        else:
-            x = self.char_dist
-        
-        for i in range(self.num_symbols):
-
-            # get render
-            curr_text = text[i]
-            curr_render = char_renders[i]
-            w, h = curr_render.size
-            
-            # account for spaces
-            if curr_text == "_":
-                if self.vertical:
-                    y += h
-                else:
-                    x += w
+            canvas_h = self.char_dist * (self.num_symbols + 1) + sum(render.shape[0] for _, render in glyphs)
+            canvas_w = int(self.font_size)
+
+        # spaces only move the position along by their size, glyphs also by the char distance less their jiggle
+        renders, bboxes = [], []
+        pos = self.char_dist
+        for c, render in glyphs:
+            h, w = render.shape
+            if c == "_":
+                pos += h if self.vertical else w
                 continue
-
-            # create y offset
             if not self.vertical:
-                height_diff = canvas_h - h
-                if height_diff < 0: height_diff = 0
-                y = height_diff // 2
-                if curr_text in self.low_chars:
-                    y = canvas_h - h - self.char_dist
+                y = canvas_h - h - self.char_dist if c in self.low_chars else max(canvas_h - h, 0) // 2
+                bboxes.append((pos, y, w, h))
+                pos += w + next(advances)
             else:
-                width_diff = canvas_w - w
-                if width_diff < 0: width_diff = 0
-                x = width_diff // 2
-
-            # pasting!
-            canvas.paste(curr_render, (x, y))
-            bboxes.append((x, y, w, h))
-
-            # move x position along
-            jiggle = min(self.char_dist, abs(np.random.normal(0, self.char_dist_std)))
-            if not self.vertical:                
-                x += w + int(self.char_dist - jiggle)
-            else:
-                y += h + int(self.char_dist - jiggle)
-        
-        return {"bboxes": bboxes, "image": canvas}
+                bboxes.append((max(canvas_w - w, 0) // 2, pos, w, h))
+                pos += h + next(advances)
+            renders.append(render)
 
-    def generate_synthetic_textline(self, image_id):
+        return int(canvas_w), int(canvas_h), renders, bboxes
 
-        self.select_font()
-        if self.single_words:
-            textline_text = self.generate_synthetic_word_text()
-        elif self.wiki_text:
-            textline_text = self.generate_synthetic_wiki_text()
-        else:
-            textline_text = self.generate_synthetic_textline_text()
+    def generate_synthetic_textline_image_character_based(self, text):
 
+        canvas_w, canvas_h, renders, bboxes = self.layout_character_textline(text)
+        canvas = np.full((canvas_h, canvas_w), 255, dtype=np.uint8)
+        for render, (x, y, _, _) in zip(renders, bboxes):
+            blit(canvas, render, x, y)
+
+        image = Image.fromarray(canvas, "L")
+        return {"bboxes": bboxes, "image": image if self.grayscale else image.convert("RGB")}
+
+    def render_synthetic_textline(self, image_id):
+
+        if not self.seed is None:
+            self.reseed(self.image_seed_seq(image_id))
+
+        # reject blank texts before spending time on rendering them
+        textline_text = self.next_synthetic_text()
+        while all(c == "_" or c.isspace() for c in textline_text):
+            textline_text = self.next_synthetic_text()
+
+        t0 = self.profiler.tic()
         if self.language == "jp" or self.language == "ja":
             out_dict = self.generate_synthetic_textline_image_character_based(textline_text)
         elif self.language == "en":
             out_dict = self.generate_synthetic_textline_image_latin_based(textline_text)
-            
-        out_image = self.synth_transform(out_dict["image"])
-        image_name = f"{self.setname}_{image_id}.png"
-        out_dict["trans_image"] = out_image
-        out_dict["image_name"] = image_name
+        self.profiler.toc("render", t0, font=os.path.basename(self.font_path))
+
+        out_dict["image_name"] = f"{self.setname}_{image_id}.{CODECS[self.image_codec][1]}"
         out_dict["text"] = textline_text
-        
-        out_image.save(os.path.join(self.save_path, image_name))
 
         return out_dict
 
+    def save_synthetic_textline(self, out_dict):
+
+        # array backed transforms hand over their buffer, which only becomes an image here
+        if isinstance(out_dict["trans_image"], np.ndarray):
+            out_dict["trans_image"] = Image.fromarray(out_dict["trans_image"])
+
+        # images are written under a temporary name and renamed, so one on disk is always complete;
+        # a resumed run finds the ones it already wrote and leaves them be
+        save_path = out_dict.get("save_path", self.save_path)
+        image_path = os.path.join(save_path, out_dict["image_name"]) if not self.encode_only else None
+        if self.skip_existing and not image_path is None and os.path.exists(image_path):
+            return
+
+        # with an image writer, encoding and writing happen in the background until finish_saves
+        if not self.image_writer is None:
+            image = out_dict["trans_image"]
+            encode = lambda: encode_image(image, self.image_codec, self.png_compress_level)
+            write = None if image_path is None else partial(write_bytes, image_path)
+            out_dict["save_future"] = self.image_writer.submit(encode, write)
+
+        # when writing shards the encoded bytes are handed back instead of saved to their own file
+        elif self.encode_only:
+            out_dict["encoded_image"] = encode_image(out_dict["trans_image"], self.image_codec, self.png_compress_level)
+        else:
+            out_dict["trans_image"].save(f"{image_path}.tmp", format=CODECS[self.image_codec][0],
+                **image_save_kwargs(self.image_codec, self.png_compress_level))
+            os.replace(f"{image_path}.tmp", image_path)
+
+    def finish_saves(self, out_dicts):
+
+        # waits for background saves, keeping only the textlines whose image made it to disk
+        if self.image_writer is None:
+            return out_dicts
+        saved = []
+        for out_dict in out_dicts:
+            if not "save_future" in out_dict:
+                saved.append(out_dict)
+                continue
+            ok, data = self.image_writer.result(out_dict.pop("save_future"))
+            if ok:
+                if self.encode_only:
+                    out_dict["encoded_image"] = data
+                saved.append(out_dict)
+        return saved
+
+    def make_synthetic_textline(self, image_id):
+
+        # render and transform, without saving
+        out_dict = self.render_synthetic_textline(image_id)
+        t0 = self.profiler.tic()
+        if not self.seed is None:
+            seed_rngs(self.image_seed_seq(image_id, 1))
+        out_dict["trans_image"] = self.synth_transform(out_dict["image"])
+        self.profiler.toc("transform", t0)
+
+        return out_dict
+
+    def variant_seed_seq(self, image_id, sample):
+
+        # the first sample of a preset draws what a run with only that preset would
+        return self.image_seed_seq(image_id, 1) if sample == 0 else self.image_seed_seq(image_id, 1, sample)
+
+    def make_variant(self, out_dict, variant, trans_image):
+
+        # variants share the render's text and boxes, only the transformed image differs
+        name, _, _, save_path = variant
+        return dict(out_dict, trans_image=trans_image, variant=name, save_path=save_path)
+
+    def make_synthetic_textline_variants(self, image_id):
+
+        # render once and transform for every variant, without saving
+        out_dict = self.render_synthetic_textline(image_id)
+        variant_dicts = []
+        for variant in self.variants:
+            t0 = self.profiler.tic()
+            if not self.seed is None:
+                seed_rngs(self.variant_seed_seq(image_id, variant[2]))
+            variant_dicts.append(self.make_variant(out_dict, variant, variant[1](out_dict["image"])))
+            self.profiler.toc("transform", t0, variant=variant[0])
+
+        return variant_dicts
+
+    def transform_synthetic_textlines(self, synth_transform, images, image_ids, sample=0, variant_name=None):
+
+        t0 = self.profiler.tic()
+        if hasattr(synth_transform, "transform_batch"):
+            # every sample of a batched transform draws from its own (seed, split, image id) stream,
+            # so how lines are split into chunks and batches doesn't change them
+            seed_seqs = [self.variant_seed_seq(image_id, sample) for image_id in image_ids] if not self.seed is None else None
+            trans_images = synth_transform.transform_batch(images, seed_seqs)
+        else:
+            trans_images = []
+            for image_id, image in zip(image_ids, images):
+                if not self.seed is None:
+                    seed_rngs(self.variant_seed_seq(image_id, sample))
+                trans_images.append(synth_transform(image))
+        self.profiler.toc("transform", t0, n=len(images), variant=variant_name)
+
+        return trans_images
+
+    def make_synthetic_textlines(self, image_ids):
+
+        # render every line first, so that a batched transform sees them all at once
+        out_dicts = [self.render_synthetic_textline(image_id) for image_id in image_ids]
+        images = [out_dict["image"] for out_dict in out_dicts]
+
+        # with variants, every render is transformed once per variant and its variants kept together
+        if not self.variants is None:
+            variant_images = [self.transform_synthetic_textlines(variant[1], images, image_ids, variant[2], variant[0])
+                for variant in self.variants]
+            return [self.make_variant(out_dict, variant, trans_images[i]) for i, out_dict in enumerate(out_dicts)
+                for variant, trans_images in zip(self.variants, variant_images)]
+
+        trans_images = self.transform_synthetic_textlines(self.synth_transform, images, image_ids)
+        for out_dict, trans_image in zip(out_dicts, trans_images):
+            out_dict["trans_image"] = trans_image
+
+        return out_dicts
+
+    def generate_synthetic_textline(self, image_id):
+
+        out_dict = self.make_synthetic_textline(image_id)
+        t0 = self.profiler.tic()
+        self.save_synthetic_textline(out_dict)
+        self.profiler.toc("save", t0)
+
+        return out_dict
+
+    def generate_synthetic_textline_variants(self, image_id):
+
+        variant_dicts = self.make_synthetic_textline_variants(image_id)
+        for variant_dict in variant_dicts:
+            t0 = self.profiler.tic()
+            self.save_synthetic_textline(variant_dict)
+            self.profiler.toc("save", t0)
+
+        return variant_dicts
+
+    def generate_synthetic_textlines(self, image_ids):
+
+        out_dicts = self.make_synthetic_textlines(image_ids)
+        for out_dict in out_dicts:
+            t0 = self.profiler.tic()
+            self.save_synthetic_textline(out_dict)
+            self.profiler.toc("save", t0)
+
+        return out_dicts
+
     def clean_wiki_text(self, x):
         clean_text = x.replace("\n", "").replace("=", "")
         clean_text = ''.join([i if (i in self.all_chars or i==" ") else '' for i in clean_text])
@@ -332,6 +640,7 @@ class TextlineGenerator:
 
     @staticmethod
     def wiki_check(random_page_name, min_size=50):
+        import wikipedia
         try:
             random_page = wikipedia.page(random_page_name)
             if len(random_page.content) < min_size:
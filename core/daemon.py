@@ -0,0 +1,331 @@
+import io
+import os
+import json
+import time
+import socket
+import struct
+import threading
+import socketserver
+from collections import OrderedDict
+import numpy as np
+from PIL import Image
+
+from core.core import TextlineGenerator, SETNAMES, GENERATOR_DEFAULTS
+from utils.fonts import load_char_sets, load_coverage, chars_to_codepoints, CoverageCache, FontCache
+from utils.glyphs import GlyphCache
+from utils.atlas import GlyphAtlas
+from utils.lexicon import Lexicon, DEFAULT_LEXICON_PATH
+from utils.coco import clip_bbox
+from utils.shards import CODECS, encode_image
+from utils.transforms import get_synth_transform
+
+
+# request fields and their defaults; char_sets and char_set_props have to be given
+REQUEST_DEFAULTS = {
+    "language": "en", "char_sets": None, "char_set_props": None, "font_folder": None, "char_folder": None,
+    "transforms": "default", "transform_backend": "torch", "batch_transforms": False, "transform_batch_size": 64,
+    "grayscale": False, "count": 1, "setname": "train", "seed": None, "start_id": 0,
+    "image_codec": "png", "png_compress_level": 6,
+    **GENERATOR_DEFAULTS,
+}
+MAX_COUNT = 4096
+# fields given as separated strings on the command line, which requests may also send as json lists
+LIST_FIELDS = {"char_sets": ",", "char_set_props": ",", "font_sizes": ",", "p_specseq": ",", "spec_seqs": "|"}
+
+# every message is a length prefixed json header followed by binary payloads, whose sizes the header lists
+MESSAGE_PREFIX = struct.Struct("!I")
+
+
+def send_message(sock, header, payloads=()):
+    data = json.dumps(dict(header, sizes=[len(x) for x in payloads])).encode("utf-8")
+    sock.sendall(b"".join([MESSAGE_PREFIX.pack(len(data)), data, *payloads]))
+
+
+def recv_exactly(sock, size, eof_ok=False):
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        n = sock.recv_into(view[received:])
+        if n == 0:
+            if eof_ok and received == 0:
+                return None
+            raise ConnectionError("Connection closed in the middle of a message")
+        received += n
+    return buffer
+
+
+def recv_message(sock):
+    # (None, []) once the peer closed the connection between messages
+    prefix = recv_exactly(sock, MESSAGE_PREFIX.size, eof_ok=True)
+    if prefix is None:
+        return None, []
+    header = json.loads(recv_exactly(sock, MESSAGE_PREFIX.unpack(prefix)[0]))
+    sizes = header.pop("sizes", [])
+    # payloads are read in one go and sliced, rather than with a recv per image
+    data = recv_exactly(sock, sum(sizes)) if len(sizes) > 0 else b""
+    offsets = np.cumsum([0] + sizes).tolist()
+    return header, [bytes(data[a:b]) for a, b in zip(offsets[:-1], offsets[1:])]
+
+
+def decode_image(data):
+    return np.asarray(Image.open(io.BytesIO(data)))
+
+
+class GenerationService:
+
+    # the state a daemon keeps warm between requests: fonts, glyphs, coverage, lexicons, transform
+    # presets and a TextlineGenerator per configuration, the least recently used dropped past max_generators
+    #
+    # generators, the caches and the global random state are not thread safe, so lines are made under
+    # one lock; encoding them happens outside of it, and PIL releases the GIL while compressing
+    def __init__(self, font_root="fonts", char_root="chars", coverage_cache_dir=None, font_cache_size=64,
+            glyph_cache_mb=256, glyph_atlas_dir=None, lexicon_path=DEFAULT_LEXICON_PATH, max_generators=16,
+            text_batch_size=64):
+        self.font_root = font_root
+        self.char_root = char_root
+        self.coverage_cache = CoverageCache(coverage_cache_dir)
+        self.font_cache = FontCache(font_cache_size)
+        self.glyph_cache = GlyphCache(int(glyph_cache_mb * 2**20))
+        self.glyph_atlas = GlyphAtlas(glyph_atlas_dir) if not glyph_atlas_dir is None else None
+        self.lexicon_path = lexicon_path
+        self.max_generators = max_generators
+        self.text_batch_size = text_batch_size
+        self.coverage = {}
+        self.lexicons = {}
+        self.transforms = {}
+        self.generators = OrderedDict()
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        self.num_requests = 0
+        self.num_lines = 0
+        self.generate_time = 0.
+        self.encode_time = 0.
+
+    def parse_request(self, request):
+        unknown = set(request) - set(REQUEST_DEFAULTS)
+        assert len(unknown) == 0, f"Unknown request fields: {sorted(unknown)}"
+        request = {**REQUEST_DEFAULTS, **request}
+        # lists and numbers become the strings effsynth.py takes, which generators are also keyed by
+        for k, sep in LIST_FIELDS.items():
+            if isinstance(request[k], (list, tuple)):
+                request[k] = sep.join(str(x) for x in request[k])
+            elif isinstance(request[k], (int, float)):
+                request[k] = str(request[k])
+        assert not request["char_sets"] is None and not request["char_set_props"] is None, \
+            "Requests need char_sets and char_set_props"
+        assert 0 < request["count"] <= MAX_COUNT, f"Count has to be between 1 and {MAX_COUNT}"
+        assert request["setname"] in SETNAMES, f"Unknown setname {request['setname']}"
+        assert request["image_codec"] in CODECS, f"Unknown image codec {request['image_codec']}"
+        if request["font_folder"] is None:
+            request["font_folder"] = os.path.join(self.font_root, request["language"])
+        if request["char_folder"] is None:
+            request["char_folder"] = os.path.join(self.char_root, request["language"])
+        return request
+
+    def get_coverage(self, font_folder, char_folder, char_sets, char_set_props):
+        key = (font_folder, char_folder, char_sets, char_set_props)
+        if not key in self.coverage:
+            font_paths = [os.path.join(font_folder, x) for x in os.listdir(font_folder)]
+            chosen_char_paths, char_sets_and_props = load_char_sets(char_folder, char_sets, char_set_props)
+            coverage_dict, charset_coverage_dict = load_coverage(font_paths, chosen_char_paths, self.coverage_cache)
+            self.coverage[key] = (font_paths, char_sets_and_props, coverage_dict, charset_coverage_dict)
+        return self.coverage[key]
+
+    def get_lexicon(self, font_paths, coverage_dict):
+        # one lexicon, indexed for every font folder it has been used with
+        key = tuple(sorted(font_paths))
+        if not key in self.lexicons:
+            lexicon = Lexicon.from_file(self.lexicon_path)
+            lexicon.index_fonts({font_path: chars_to_codepoints(coverage_dict[font_path]) for font_path in font_paths})
+            self.lexicons[key] = lexicon
+        return self.lexicons[key]
+
+    def get_transform(self, name, backend, batched, grayscale):
+        key = (name, backend, batched, grayscale)
+        if not key in self.transforms:
+            self.transforms[key] = get_synth_transform(name, backend, batched, grayscale)
+        return self.transforms[key]
+
+    def get_generator(self, request):
+        # with a seed every line is seeded from (seed, split, image id), so seeded and unseeded
+        # requests need generators of their own
+        kw = {k: request[k] for k in GENERATOR_DEFAULTS}
+        key = tuple(request[k] for k in ("language", "font_folder", "char_folder", "char_sets", "char_set_props",
+            "transforms", "transform_backend", "batch_transforms", "grayscale", "setname")) + \
+            (request["seed"] is None,) + tuple(sorted(kw.items()))
+        generator = self.generators.get(key)
+        if generator is None:
+            font_paths, char_sets_and_props, coverage_dict, charset_coverage_dict = self.get_coverage(
+                request["font_folder"], request["char_folder"], request["char_sets"], request["char_set_props"])
+            lexicon = None
+            if (kw["real_words"] > 0 and not kw["wiki_text"]) or kw["single_words"]:
+                lexicon = self.get_lexicon(font_paths, coverage_dict)
+            synth_transform = self.get_transform(request["transforms"], request["transform_backend"],
+                request["batch_transforms"], request["grayscale"])
+            generator = TextlineGenerator(
+                request["setname"], font_paths, char_sets_and_props, None,
+                synth_transform, coverage_dict,
+                kw["max_length"], kw["font_sizes"], kw["max_spaces"],
+                kw["num_geom_p"], kw["max_numbers"],
+                request["language"], kw["vertical"], kw["spec_seqs"],
+                kw["char_dist"], kw["char_dist_std"], kw["p_specseq"],
+                kw["word_bbox"], kw["real_words"], kw["single_words"],
+                kw["specseq_count"], kw["wiki_text"], kw["case_aug"],
+                font_cache=self.font_cache, glyph_cache=self.glyph_cache,
+                charset_coverage_dict=charset_coverage_dict, text_batch_size=self.text_batch_size,
+                image_codec=request["image_codec"], lexicon=lexicon, seed=request["seed"],
+                glyph_atlas=self.glyph_atlas, grayscale=request["grayscale"]
+            )
+            self.generators[key] = generator
+            if len(self.generators) > self.max_generators:
+                self.generators.popitem(last=False)
+        self.generators.move_to_end(key)
+        return generator
+
+    def make_lines(self, request):
+        with self.lock:
+            generator = self.get_generator(request)
+            if not request["seed"] is None:
+                generator.seed = request["seed"]
+            image_ids = range(request["start_id"], request["start_id"] + request["count"])
+            if request["batch_transforms"]:
+                batch_size = request["transform_batch_size"]
+                out_dicts = []
+                for start in range(0, len(image_ids), batch_size):
+                    out_dicts.extend(generator.make_synthetic_textlines(image_ids[start:start+batch_size]))
+            else:
+                out_dicts = [generator.make_synthetic_textline(image_id) for image_id in image_ids]
+        return image_ids, out_dicts
+
+    def generate(self, request):
+        # records laid out like the json of a tar shard sample, and the encoded images
+        request = self.parse_request(request)
+        t0 = time.perf_counter()
+        image_ids, out_dicts = self.make_lines(request)
+        t1 = time.perf_counter()
+        records, payloads = [], []
+        for image_id, out_dict in zip(image_ids, out_dicts):
+            image = out_dict["trans_image"]
+            if isinstance(image, np.ndarray):
+                image = Image.fromarray(image)
+            imgw, imgh = image.size
+            bboxes, word_bboxes = [np.array([clip_bbox(bbox, imgw, imgh) for bbox in out_dict.get(key, list())],
+                dtype=np.int64).reshape(-1, 4).tolist() for key in ("bboxes", "word_bboxes")]
+            records.append({"id": image_id, "text": out_dict["text"].replace("_", " "), "width": imgw, "height": imgh,
+                "bboxes": bboxes, "word_bboxes": word_bboxes})
+            payloads.append(encode_image(image, request["image_codec"], request["png_compress_level"]))
+        t2 = time.perf_counter()
+        with self.lock:
+            self.num_requests += 1
+            self.num_lines += len(records)
+            self.generate_time += t1 - t0
+            self.encode_time += t2 - t1
+        return records, payloads
+
+    def stats(self):
+        with self.lock:
+            return {
+                "uptime": time.time() - self.start_time,
+                "requests": self.num_requests,
+                "lines": self.num_lines,
+                "generate_time": self.generate_time,
+                "encode_time": self.encode_time,
+                "generators": len(self.generators),
+                "font_cache": self.font_cache.stats(),
+                "glyph_cache": self.glyph_cache.stats(),
+                "glyph_atlas": self.glyph_atlas.stats() if not self.glyph_atlas is None else None,
+            }
+
+
+class DaemonRequestHandler(socketserver.BaseRequestHandler):
+
+    # serves one client connection, request after request, until the client closes it;
+    # a bad request gets an error reply instead of bringing the connection down
+    def handle(self):
+        service = self.server.service
+        while True:
+            try:
+                request, _ = recv_message(self.request)
+            except (ConnectionError, ValueError):
+                return
+            if request is None:
+                return
+            op = request.pop("op", "generate")
+            try:
+                if op == "generate":
+                    records, payloads = service.generate(request)
+                    reply = {"records": records}
+                elif op == "stats":
+                    reply, payloads = service.stats(), []
+                else:
+                    raise ValueError(f"Unknown op {op}")
+            except Exception as e:
+                reply, payloads = {"error": f"{type(e).__name__}: {e}"}, []
+            try:
+                send_message(self.request, reply, payloads)
+            except OSError:
+                return
+
+
+class GenerationDaemon(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+
+    # a thread per client connection, all sharing one GenerationService
+    daemon_threads = True
+
+    def __init__(self, socket_path, service):
+        # a socket file left behind by a daemon that died is replaced, a live one is not
+        if os.path.exists(socket_path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(socket_path)
+                raise OSError(f"A daemon is already serving on {socket_path}")
+            except ConnectionRefusedError:
+                os.remove(socket_path)
+            finally:
+                probe.close()
+        super().__init__(socket_path, DaemonRequestHandler)
+        self.service = service
+
+    def server_close(self):
+        super().server_close()
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+
+
+class DaemonClient:
+
+    # a connection to a running daemon; requests on one connection are answered in order, so threads
+    # should each open their own client
+    def __init__(self, socket_path, timeout=None):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        self.sock.connect(socket_path)
+
+    def request(self, request, op="generate"):
+        send_message(self.sock, dict(request, op=op))
+        reply, payloads = recv_message(self.sock)
+        if reply is None:
+            raise ConnectionError("Daemon closed the connection")
+        if "error" in reply:
+            raise RuntimeError(reply["error"])
+        return reply, payloads
+
+    def generate(self, char_sets, char_set_props, count, language="en", transforms="default", decode=False, **kwargs):
+        # (record, image) pairs, with images as encoded bytes or, with decode, as uint8 arrays
+        reply, payloads = self.request({"language": language, "char_sets": char_sets,
+            "char_set_props": char_set_props, "count": count, "transforms": transforms, **kwargs})
+        images = [decode_image(x) for x in payloads] if decode else payloads
+        return list(zip(reply["records"], images))
+
+    def stats(self):
+        return self.request({}, op="stats")[0]
+
+    def close(self):
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
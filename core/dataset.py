@@ -0,0 +1,132 @@
+import os
+import itertools
+import numpy as np
+from torch.utils.data import IterableDataset, get_worker_info
+
+from core.core import TextlineGenerator, SETNAMES, GENERATOR_DEFAULTS
+from utils.fonts import load_char_sets, load_coverage, chars_to_codepoints, CoverageCache, FontCache
+from utils.glyphs import GlyphCache
+from utils.atlas import GlyphAtlas
+from utils.lexicon import Lexicon, DEFAULT_LEXICON_PATH
+from utils.coco import clip_bbox
+from utils.transforms import get_synth_transform
+
+
+class SyntheticTextlineDataset(IterableDataset):
+
+    # yields (image, text, char bboxes, word bboxes) straight from a TextlineGenerator, without
+    # touching the disk; images are uint8 arrays and bboxes (n, 4) int arrays of x, y, w, h
+    #
+    # samples come in chunks of chunk_size, each seeded from (seed, setname, chunk index) the same
+    # way effsynth.py seeds its chunks, and chunks are dealt round robin to DataLoader workers;
+    # the stream is infinite unless num_samples is given
+    def __init__(
+            self, font_folder, char_folder, char_sets, char_set_props, language="en",
+            num_samples=None, seed=None, setname="train", chunk_size=256,
+            transforms="default", transform_backend="torch", batch_transforms=False, transform_batch_size=64,
+            font_cache_size=64, glyph_cache_mb=256, text_batch_size=64, coverage_cache_dir=None,
+            lexicon_path=DEFAULT_LEXICON_PATH, glyph_atlas_dir=None, grayscale=False, **generator_kwargs
+        ):
+
+        self.font_paths = [os.path.join(font_folder, x) for x in os.listdir(font_folder)]
+        self.chosen_char_paths, self.char_sets_and_props = load_char_sets(char_folder, char_sets, char_set_props)
+        # nothing is written to disk unless a coverage_cache_dir is given
+        coverage_cache = CoverageCache(coverage_cache_dir)
+        self.coverage_dict, self.charset_coverage_dict = load_coverage(self.font_paths, self.chosen_char_paths, coverage_cache)
+
+        self.language = language
+        self.num_samples = num_samples
+        self.seed = seed if not seed is None else np.random.SeedSequence().entropy
+        self.setname = setname
+        self.chunk_size = chunk_size
+        self.transforms = transforms
+        self.transform_backend = transform_backend
+        self.transform_batch_size = transform_batch_size if batch_transforms else 1
+        self.batch_transforms = batch_transforms
+        self.font_cache_size = font_cache_size
+        self.glyph_cache_mb = glyph_cache_mb
+        self.glyph_atlas_dir = glyph_atlas_dir
+        self.grayscale = grayscale
+        self.text_batch_size = text_batch_size
+        unknown = set(generator_kwargs) - set(GENERATOR_DEFAULTS)
+        assert len(unknown) == 0, f"Unknown generator arguments: {unknown}"
+        self.generator_kwargs = {**GENERATOR_DEFAULTS, **generator_kwargs}
+        self.lexicon = None
+        kw = self.generator_kwargs
+        if (kw["real_words"] > 0 and not kw["wiki_text"]) or kw["single_words"]:
+            self.lexicon = Lexicon.from_file(lexicon_path)
+            self.lexicon.index_fonts({font_path: chars_to_codepoints(self.coverage_dict[font_path])
+                for font_path in self.font_paths})
+        self.epoch = 0
+        self.generator = None
+
+    def set_epoch(self, epoch):
+        # finite datasets repeat the same samples every epoch unless this is changed
+        self.epoch = epoch
+
+    def make_generator(self):
+        # built lazily in every worker, as fonts and transforms don't pickle
+        synth_transform = get_synth_transform(self.transforms, self.transform_backend, self.batch_transforms, self.grayscale)
+        kw = self.generator_kwargs
+        return TextlineGenerator(
+            self.setname, self.font_paths, self.char_sets_and_props, None,
+            synth_transform, self.coverage_dict,
+            kw["max_length"], kw["font_sizes"], kw["max_spaces"],
+            kw["num_geom_p"], kw["max_numbers"],
+            self.language, kw["vertical"], kw["spec_seqs"],
+            kw["char_dist"], kw["char_dist_std"], kw["p_specseq"],
+            kw["word_bbox"], kw["real_words"], kw["single_words"],
+            kw["specseq_count"], kw["wiki_text"], kw["case_aug"],
+            font_cache=FontCache(self.font_cache_size),
+            glyph_cache=GlyphCache(int(self.glyph_cache_mb * 2**20)),
+            charset_coverage_dict=self.charset_coverage_dict, text_batch_size=self.text_batch_size,
+            lexicon=self.lexicon,
+            glyph_atlas=GlyphAtlas(self.glyph_atlas_dir) if not self.glyph_atlas_dir is None else None,
+            grayscale=self.grayscale
+        )
+
+    def chunk_seed(self, chunk_idx):
+        spawn_key = (SETNAMES.index(self.setname), chunk_idx) + ((self.epoch,) if self.epoch > 0 else ())
+        return np.random.SeedSequence(self.seed, spawn_key=spawn_key)
+
+    def to_sample(self, out_dict):
+        image = np.asarray(out_dict["trans_image"])
+        imgh, imgw = image.shape[:2]
+        bboxes, word_bboxes = [np.array([clip_bbox(bbox, imgw, imgh) for bbox in out_dict.get(key, list())],
+            dtype=np.int64).reshape(-1, 4) for key in ("bboxes", "word_bboxes")]
+        return image, out_dict["text"].replace("_", " "), bboxes, word_bboxes
+
+    def __iter__(self):
+        if self.generator is None:
+            self.generator = self.make_generator()
+        worker_info = get_worker_info()
+        worker_id, num_workers = (0, 1) if worker_info is None else (worker_info.id, worker_info.num_workers)
+
+        if self.num_samples is None:
+            chunk_idxs = itertools.count(worker_id, num_workers)
+        else:
+            chunk_idxs = range(worker_id, -(-self.num_samples // self.chunk_size), num_workers)
+
+        for chunk_idx in chunk_idxs:
+            self.generator.reseed(self.chunk_seed(chunk_idx))
+            start = chunk_idx * self.chunk_size
+            stop = start + self.chunk_size if self.num_samples is None else min(start + self.chunk_size, self.num_samples)
+            for batch_start in range(start, stop, self.transform_batch_size):
+                batch_ids = range(batch_start, min(batch_start + self.transform_batch_size, stop))
+                if self.transform_batch_size > 1:
+                    out_dicts = self.generator.make_synthetic_textlines(batch_ids)
+                else:
+                    out_dicts = [self.generator.make_synthetic_textline(image_id) for image_id in batch_ids]
+                for out_dict in out_dicts:
+                    yield self.to_sample(out_dict)
+
+    def __len__(self):
+        if self.num_samples is None:
+            raise TypeError("An infinite SyntheticTextlineDataset has no length")
+        return self.num_samples
+
+
+def collate_textlines(samples):
+    # images differ in size, so batches are kept as lists
+    images, texts, bboxes, word_bboxes = zip(*samples)
+    return list(images), list(texts), list(bboxes), list(word_bboxes)
@@ -1,13 +1,174 @@
 import os
-from matplotlib.pyplot import text
+import sys
+import shutil
 from tqdm import tqdm
 import json
 import argparse
+import multiprocessing
+import numpy as np
 
-from utils.fonts import load_chars, get_unicode_coverage_from_ttf
-from utils.coco import create_coco_annotation_field, COCO_JSON_SKELETON
-from core.core import TextlineGenerator
-from utils.transforms import TRANSFORM_DICT
+from utils.fonts import load_char_sets, load_coverage, chars_to_codepoints, CoverageCache, FontCache
+from utils.coco import clip_bbox
+from utils.annotations import AnnotationWriter, AnnotationStore, annotations_array
+from utils.glyphs import GlyphCache
+from utils.atlas import GlyphAtlas
+from utils.shards import ShardWriter
+from utils.image_writer import AsyncImageWriter
+from utils.corpus import TextCorpus
+from utils.lexicon import Lexicon, DEFAULT_LEXICON_PATH
+from utils.profiling import StageProfiler, ProfileReport
+from utils.checkpoint import output_args, save_checkpoint, load_checkpoint
+from core.core import TextlineGenerator, SETNAMES
+from utils.transforms import get_synth_transform
+
+
+# per-process generation state, set up by init_worker
+WORKER_STATE = {}
+
+
+def init_worker(args, font_paths, char_sets_and_props, images_path, coverage_dict, charset_coverage_dict, num_workers, corpus_dir=None, lexicon=None):
+
+    # only the chosen presets' backends are imported, torch may not be loaded at all
+    variants = None
+    if len(variant_specs(args)) > 0:
+        transforms, variants = {}, []
+        for name, preset, sample in variant_specs(args):
+            if not preset in transforms:
+                transforms[preset] = get_synth_transform(preset, args.transform_backend, args.batch_transforms, args.grayscale)
+            variants.append((name, transforms[preset], sample, os.path.join(args.output_folder, name, "images")))
+        synth_transform = variants[0][1]
+    else:
+        synth_transform = get_synth_transform(args.transforms, args.transform_backend, args.batch_transforms, args.grayscale)
+    if num_workers > 1 and "torch" in sys.modules:
+        sys.modules["torch"].set_num_threads(1)
+
+    font_cache = FontCache(args.font_cache_size)
+    glyph_cache = GlyphCache(int(args.glyph_cache_mb * 2**20))
+    glyph_atlas = GlyphAtlas(args.glyph_atlas_dir) if not args.glyph_atlas_dir is None else None
+
+    corpus = TextCorpus(corpus_dir) if not corpus_dir is None else None
+    image_writer = AsyncImageWriter(args.writer_threads, args.writer_queue) if args.writer_threads > 0 else None
+
+    WORKER_STATE["font_cache"] = font_cache
+    WORKER_STATE["image_writer"] = image_writer
+    WORKER_STATE["profiler"] = StageProfiler(args.profile)
+    WORKER_STATE["glyph_cache"] = glyph_cache
+    WORKER_STATE["glyph_atlas"] = glyph_atlas
+    WORKER_STATE["transform_batch_size"] = args.transform_batch_size if args.batch_transforms else 1
+    WORKER_STATE["generators"] = {}
+    for setname in SETNAMES:
+        WORKER_STATE["generators"][setname] = TextlineGenerator(
+            setname, font_paths, char_sets_and_props, images_path, 
+            synth_transform, coverage_dict,
+            args.textline_max_length, args.font_sizes, args.textline_max_spaces,
+            args.textline_numbers_geom_p, args.textline_max_numbers,
+            args.language, args.vertical, args.specific_seqs,
+            args.char_dist, args.char_dist_std, args.p_spec_seqs,
+            args.word_bbox, args.real_words, args.single_words,
+            args.spec_seq_count, args.wiki_text, args.case_aug,
+            font_cache=font_cache, glyph_cache=glyph_cache,
+            charset_coverage_dict=charset_coverage_dict, text_batch_size=args.text_batch_size,
+            image_codec=args.image_codec, png_compress_level=args.png_compress_level,
+            encode_only=args.shard_size > 0, image_writer=image_writer,
+            skip_existing=args.resume, corpus=corpus, lexicon=lexicon,
+            profiler=WORKER_STATE["profiler"], seed=args.seed, glyph_atlas=glyph_atlas,
+            grayscale=args.grayscale, variants=variants
+        )
+
+
+def variant_specs(args):
+
+    # (name, preset, sample) of every variant a render is fanned out to; none without fan-out
+    if args.fanout_transforms is None and args.fanout_samples == 1:
+        return []
+    presets = args.fanout_transforms.split(",") if not args.fanout_transforms is None else [args.transforms]
+    return [(preset if args.fanout_samples == 1 else f"{preset}_{sample}", preset, sample)
+        for preset in presets for sample in range(args.fanout_samples)]
+
+
+def writer_key(variant, setname):
+
+    # writers are keyed by split, and by variant as well with fan-out
+    return setname if variant is None else f"{variant}/{setname}"
+
+
+def textline_to_coco(textline_dict, image_id, shared_annotations=None):
+
+    synth_text = textline_dict["text"]
+    synth_image = textline_dict["trans_image"]
+    image_name = textline_dict["image_name"]
+
+    imgw, imgh = synth_image.width, synth_image.height
+    image = {"width": imgw, "height": imgh, "id": image_id, 
+        "file_name": image_name, "text": synth_text.replace("_", " ")}
+
+    # variants of one render share its annotations, unless a transform changed the image size
+    key = (image_id, imgw, imgh)
+    if not shared_annotations is None and key in shared_annotations:
+        return image, shared_annotations[key], textline_dict.get("encoded_image")
+
+    # annotations without ids, these are assigned when records are merged
+    annotations = []
+    for cat_id, key_name in ((0, "bboxes"), (1, "word_bboxes")):
+        for bbox in textline_dict.get(key_name, list()):
+            annotations.append((cat_id, *clip_bbox(bbox, imgw, imgh)))
+    annotations = annotations_array(annotations)
+    if not shared_annotations is None:
+        shared_annotations[key] = annotations
+
+    return image, annotations, textline_dict.get("encoded_image")
+
+
+def shard_prefix(setname, args):
+
+    # tar shards of different nodes get different names, so their outputs can be merged
+    return setname if args.num_shards == 1 else f"{setname}.node{args.shard_index}"
+
+
+def shard_record(image, annotations):
+
+    # the per-sample json stored next to the image in a shard
+    return {"id": image["id"], "text": image["text"], "width": image["width"], "height": image["height"],
+        "bboxes": annotations[annotations[:, 0] == 0, 1:].tolist(),
+        "word_bboxes": annotations[annotations[:, 0] == 1, 1:].tolist()}
+
+
+def generate_chunk(task):
+
+    setname, image_ids, seed_seq = task
+    textline_generator = WORKER_STATE["generators"][setname]
+    textline_generator.reseed(seed_seq)
+    batch_size = WORKER_STATE["transform_batch_size"]
+
+    textline_dicts = []
+    if batch_size > 1:
+        for start in range(0, len(image_ids), batch_size):
+            batch_ids = image_ids[start:start+batch_size]
+            textline_dicts.extend(textline_generator.generate_synthetic_textlines(batch_ids))
+    elif not textline_generator.variants is None:
+        for image_id in image_ids:
+            textline_dicts.extend(textline_generator.generate_synthetic_textline_variants(image_id))
+    else:
+        for image_id in image_ids:
+            textline_dicts.append(textline_generator.generate_synthetic_textline(image_id=image_id))
+    # with fan-out, every image id has one textline per variant
+    variants_per_image = len(textline_generator.variants) if not textline_generator.variants is None else 1
+    for i, textline_dict in enumerate(textline_dicts):
+        textline_dict["image_id"] = image_ids[i // variants_per_image]
+
+    # annotations are only committed for images that were written
+    profiler = WORKER_STATE["profiler"]
+    t0 = profiler.tic()
+    textline_dicts = textline_generator.finish_saves(textline_dicts)
+    profiler.toc("save_wait", t0, n=max(len(textline_dicts), 1))
+    shared_annotations = {}
+    records = [(x.get("variant"), *textline_to_coco(x, x["image_id"], shared_annotations)) for x in textline_dicts]
+
+    image_writer = WORKER_STATE["image_writer"]
+    stats = {"writer": image_writer.pop_stats() if not image_writer is None else None,
+        "profile": profiler.pop_stats()}
+
+    return setname, records, stats
 
 
 if __name__ == '__main__':
@@ -61,34 +222,103 @@ if __name__ == '__main__':
         help="Generate images of single words or random character strings")
     parser.add_argument('--real_words', type=int, default=0,
         help="Number of real words to insert in generated textlines")
+    parser.add_argument("--lexicon", type=str, default=DEFAULT_LEXICON_PATH,
+        help="Word list for real words, one word per line, optionally followed by a frequency weight")
     parser.add_argument('--wiki_text', action='store_true', default=False,
         help="Pull generated text sequences randomly from Wikipedia")
+    parser.add_argument("--corpus", type=str, default=None,
+        help="Sample text sequences from local text files or folders of them, as a comma separated list, instead of Wikipedia")
+    parser.add_argument("--corpus_index_dir", type=str,
+        default=os.path.join(os.path.expanduser("~"), ".cache", "effsynth", "corpus"),
+        help="Folder for the cleaned and indexed corpus, rebuilt when the corpus files or char sets change")
     parser.add_argument('--case_aug', action='store_true', default=False,
         help="Augment the case of words (first upper, all upper, all lower) when generating real words")
+    parser.add_argument("--font_cache_size", type=int, default=64,
+        help="Max number of loaded (font, size) pairs kept in memory; 0 disables caching")
+    parser.add_argument("--glyph_cache_mb", type=float, default=256,
+        help="Memory budget in MB for cached glyph renders and metrics; 0 disables caching")
+    parser.add_argument("--glyph_atlas_dir", type=str, default=None,
+        help="Folder of glyph atlases built by build_atlas.py, memory mapped and shared by all workers")
+    parser.add_argument("--workers", type=int, default=1,
+        help="Number of processes used for generation")
+    parser.add_argument("--chunk_size", type=int, default=256,
+        help="Number of textlines per unit of work; each chunk has its own random stream")
+    parser.add_argument("--coverage_cache_dir", type=str,
+        default=os.path.join(os.path.expanduser("~"), ".cache", "effsynth", "coverage"),
+        help="Folder for cached font coverage, invalidated when a font or char set file changes; empty disables it")
+    parser.add_argument("--text_batch_size", type=int, default=64,
+        help="Number of textline texts sampled at once")
+    parser.add_argument('--transform_backend', choices=['torch', 'numpy'], type=str, default="torch",
+        help="Run the transforms on tensors (torchvision/kornia/albumentations) or on a single uint8 array (numpy/cv2)")
+    parser.add_argument('--batch_transforms', action='store_true', default=False,
+        help="Apply transforms to batches of textlines bucketed by size instead of one at a time (torch backend)")
+    parser.add_argument("--transform_batch_size", type=int, default=64,
+        help="Number of textlines rendered before a batched transform is applied to them")
+    parser.add_argument('--grayscale', action='store_true', default=False,
+        help="Render, transform and save textlines in a single channel; color presets still expand them to RGB")
+    parser.add_argument('--compact_json', action='store_true', default=False,
+        help="Write COCO files without indentation or spaces between separators")
+    parser.add_argument('--gzip_json', action='store_true', default=False,
+        help="Gzip the COCO files as they are written")
+    parser.add_argument("--annotation_format", type=str, default="coco", choices=["coco", "columns", "both"],
+        help="Write COCO files, columnar annotation stores of memory mappable .npy files, or both")
+    parser.add_argument("--fanout_transforms", type=str, default=None,
+        help="Transform presets every render is fanned out to as a comma separated list, each written to a subfolder of its own")
+    parser.add_argument("--fanout_samples", type=int, default=1,
+        help="Number of transformed samples of every render per preset; above 1, subfolders are named preset_sample")
+    parser.add_argument("--shard_size", type=int, default=0,
+        help="Write images into tar shards of this many textlines, with an index for random access; 0 writes one file per image")
+    parser.add_argument('--image_codec', choices=['png', 'jpg', 'webp'], type=str, default="png",
+        help="Format images are encoded in")
+    parser.add_argument("--png_compress_level", type=int, default=6,
+        help="zlib compression level of PNG images, from 0 (fastest) to 9 (smallest)")
+    parser.add_argument("--writer_threads", type=int, default=2,
+        help="Number of background threads per process encoding and writing images; 0 saves them synchronously")
+    parser.add_argument("--writer_queue", type=int, default=64,
+        help="Max number of images waiting to be encoded and written before rendering blocks")
+    parser.add_argument("--checkpoint_interval", type=int, default=16,
+        help="Number of chunks between checkpoints of the run's progress")
+    parser.add_argument('--resume', action='store_true', default=False,
+        help="Resume from the output folder's checkpoint, if it has one")
+    parser.add_argument("--seed", type=int, default=None,
+        help="Derive each image's text, font and augmentation from (seed, split, image id), making runs reproducible")
+    parser.add_argument("--num_shards", type=int, default=1,
+        help="Number of nodes the run is split over, each generating disjoint ranges of image ids")
+    parser.add_argument("--shard_index", type=int, default=0,
+        help="Which of the num_shards ranges this node generates; merge the outputs with merge_shards.py")
+    parser.add_argument('--profile', action='store_true', default=False,
+        help="Time every generation stage and report throughput and percentiles")
+    parser.add_argument("--profile_interval", type=float, default=30,
+        help="Seconds between periodic profile reports; 0 only reports at the end")
+    parser.add_argument("--profile_output", type=str, default=None,
+        help="File the final profile is exported to, as json if it ends in .json and as prometheus style text otherwise")
     args = parser.parse_args()
 
-    # create transforms
-    synth_transform = TRANSFORM_DICT[args.transforms]
-    
     # get font paths
     font_paths = [os.path.join(args.font_folder, x) for x in os.listdir(args.font_folder)]
 
-    # make coverage dict
-    coverage_dict = {}
-    for font_path in font_paths:
-        _, covered_chars = get_unicode_coverage_from_ttf(font_path)
-        coverage_dict[font_path] = covered_chars
-
     # get char paths
-    char_paths = [os.path.join(args.char_folder, x) for x in os.listdir(args.char_folder)]
-    char_sets = args.char_sets.split(",")
-    chosen_char_paths = [[x for x in char_paths if c in x][0] for c in char_sets]
+    chosen_char_paths, char_sets_and_props = load_char_sets(args.char_folder, args.char_sets, args.char_set_props)
     print(f"Chosen character sets: {chosen_char_paths}")
-    char_set_props = [float(x) for x in args.char_set_props.split(",")]
-    assert 0.9999999 < sum(char_set_props) <= 1, f"Character set proportions do not sum to 1! They sum to {sum(char_set_props)}!"
-    char_set_lists = [load_chars(x) for x in chosen_char_paths]
-    char_sets_and_props = list(zip(char_set_lists, char_set_props))
-    
+
+    # make coverage dict, along with the covered part of each char set
+    coverage_cache = CoverageCache(args.coverage_cache_dir)
+    coverage_dict, charset_coverage_dict = load_coverage(font_paths, chosen_char_paths, coverage_cache)
+    print(f"Coverage cache: {coverage_cache.hits} hits, {coverage_cache.misses} misses")
+    all_chars = set(sum([char_set for char_set, prop in char_sets_and_props], []))
+
+    # index the local corpus once, workers memory map it
+    corpus_dir = None
+    if not args.corpus is None:
+        corpus_dir = TextCorpus.from_files(args.corpus, args.corpus_index_dir, all_chars).index_dir
+
+    # load the lexicon once for all splits and workers, with the words each font covers
+    lexicon = None
+    if (args.real_words > 0 and not args.wiki_text and args.corpus is None) or args.single_words:
+        lexicon = Lexicon.from_file(args.lexicon)
+        lexicon.index_fonts({font_path: chars_to_codepoints(coverage_dict[font_path]) for font_path in font_paths})
+        print(f"Lexicon: {len(lexicon)} words")
+
     # create output folder
     outdir = args.output_folder
     os.makedirs(outdir, exist_ok=True)
@@ -97,70 +327,146 @@ if __name__ == '__main__':
     train_test_val_split = [float(x) for x in args.train_test_val_props.split(",")]
     train_test_val_counts = [int(args.count * x) for x in train_test_val_split]
     
-    # set dicts
-    SETNAMES = ("train", "test", "val",)
-    anns_dict = {SETNAMES[0]: [], SETNAMES[1]: [], SETNAMES[2]: []}
-    images_dict = {SETNAMES[0]: [], SETNAMES[1]: [], SETNAMES[2]: []}
-    anno_id = 0
+    # checkpoint of an interrupted run with the same arguments
+    checkpoint_path = os.path.join(outdir, "checkpoint.json")
+    checkpoint = load_checkpoint(checkpoint_path, args) if args.resume else None
+    if args.resume and checkpoint is None:
+        print("No checkpoint found, starting from scratch")
+    resume_states = lambda key: checkpoint[key] if not checkpoint is None else {}
 
-    # save for images
-    images_path = os.path.join(outdir, "images")
-    os.makedirs(images_path, exist_ok=True)
+    # with fan-out, every variant is written as a dataset of its own, in a subfolder named after it
+    variants = variant_specs(args)
+    dataset_dirs = {name: os.path.join(outdir, name) for name, preset, sample in variants} if len(variants) > 0 else {None: outdir}
 
-    # create segs
-    for setname, count in zip(SETNAMES, train_test_val_counts):
+    # columnar annotation stores, appended to as records are merged; COCO files are exported from them
+    store_names = {setname: f"{setname}{int(pct*100)}" for setname, pct in zip(SETNAMES, train_test_val_split)}
+    annotation_writers = {writer_key(variant, setname): AnnotationWriter(os.path.join(dataset_dir, f"{name}.annotations"),
+        resume_state=resume_states("annotation_writers").get(writer_key(variant, setname)))
+        for variant, dataset_dir in dataset_dirs.items() for setname, name in store_names.items()}
 
-        textline_generator = TextlineGenerator(
-            setname, font_paths, char_sets_and_props, images_path, 
-            synth_transform, coverage_dict,
-            args.textline_max_length, args.font_sizes, args.textline_max_spaces,
-            args.textline_numbers_geom_p, args.textline_max_numbers,
-            args.language, args.vertical, args.specific_seqs,
-            args.char_dist, args.char_dist_std, args.p_spec_seqs,
-            args.word_bbox, args.real_words, args.single_words,
-            args.spec_seq_count, args.wiki_text, args.case_aug
-        )
+    # save for images, either one file each or tar shards per split
+    images_path = os.path.join(outdir, "images")
+    shard_writers = {}
+    for variant, dataset_dir in dataset_dirs.items():
+        if args.shard_size > 0:
+            for setname in SETNAMES:
+                key = writer_key(variant, setname)
+                shard_writers[key] = ShardWriter(os.path.join(dataset_dir, "shards"), shard_prefix(setname, args),
+                    args.shard_size, codec=args.image_codec, resume_state=resume_states("shard_writers").get(key))
+        else:
+            os.makedirs(os.path.join(dataset_dir, "images"), exist_ok=True)
 
-        for image_id in tqdm(range(count)):
+    # split image ids into chunks, each with an independent random stream
+    # with several nodes, each takes a contiguous range of every split's chunks
+    assert 0 <= args.shard_index < args.num_shards, f"Shard index {args.shard_index} out of range!"
+    base_seed = np.random.SeedSequence(checkpoint["base_seed"] if not checkpoint is None else args.seed)
+    print(f"Base seed: {base_seed.entropy}")
+    tasks = []
+    for set_idx, (setname, count) in enumerate(zip(SETNAMES, train_test_val_counts)):
+        num_chunks = -(-count // args.chunk_size)
+        for chunk_idx, start in enumerate(range(0, count, args.chunk_size)):
+            if chunk_idx * args.num_shards // num_chunks != args.shard_index:
+                continue
+            image_ids = range(start, min(start + args.chunk_size, count))
+            seed_seq = np.random.SeedSequence(base_seed.entropy, spawn_key=(set_idx, chunk_idx))
+            tasks.append((setname, image_ids, seed_seq))
 
-            textline_dict = textline_generator.generate_synthetic_textline(image_id=image_id)
+    # chunks merged before the checkpoint are not generated again
+    tasks_done = checkpoint["tasks_done"] if not checkpoint is None else 0
+    images_done = sum(len(image_ids) for setname, image_ids, seed_seq in tasks[:tasks_done])
+    if tasks_done > 0:
+        print(f"Resuming after {tasks_done} of {len(tasks)} chunks")
 
-            synth_text = textline_dict["text"]
-            synth_image = textline_dict["trans_image"]
-            image_name = textline_dict["image_name"]
+    # generate, either in this process or across a pool of workers
+    init_args = (args, font_paths, char_sets_and_props, images_path, coverage_dict, charset_coverage_dict, args.workers, corpus_dir, lexicon)
+    if args.workers > 1:
+        pool = multiprocessing.Pool(args.workers, initializer=init_worker, initargs=init_args)
+        results = pool.imap(generate_chunk, tasks[tasks_done:])
+    else:
+        pool = None
+        init_worker(*init_args)
+        results = map(generate_chunk, tasks[tasks_done:])
 
-            if all(c == "_" for c in synth_text):
-                continue
+    # merge records in task order so that anno ids are globally unique and stable
+    writer_stats = {}
+    # fan-out runs are labelled with every preset they transform with
+    profile_report = ProfileReport({"language": args.language,
+        "transforms": args.fanout_transforms if not args.fanout_transforms is None else args.transforms,
+        "transform_backend": args.transform_backend}, interval=args.profile_interval) if args.profile else None
+    with tqdm(total=sum(len(image_ids) for setname, image_ids, seed_seq in tasks), initial=images_done) as pbar:
+        for setname, records, chunk_stats in results:
+            if not chunk_stats["writer"] is None:
+                for k, v in chunk_stats["writer"].items():
+                    writer_stats[k] = max(writer_stats.get(k, 0), v) if k == "max_depth" else writer_stats.get(k, 0) + v
+            if not profile_report is None:
+                profile_report.update(chunk_stats["profile"], len(records))
+            for variant, image, annotations, encoded_image in records:
+                key = writer_key(variant, setname)
+                if key in shard_writers:
+                    shard_writers[key].add(os.path.splitext(image["file_name"])[0], encoded_image, shard_record(image, annotations))
+                annotation_writers[key].add(image, annotations)
+            pbar.update(len(records))
 
-            imgw, imgh = synth_image.width, synth_image.height
-            image = {"width": imgw, "height": imgh, "id": image_id, 
-                "file_name": image_name, "text": synth_text.replace("_", " ")}
-            images_dict[setname].append(image)
-
-            for bbox in textline_dict.get("bboxes", list()):
-                x, y, width, height = bbox
-                x0, y0, x1, y1 = max(x, 0), max(y, 0), min(x+width, imgw), min(y+height, imgh)
-                x, y, width, height = x0, y0, x1 - x0, y1 - y0
-                annotation = create_coco_annotation_field(anno_id, image_id, width, height, x, y, cat_id=0)
-                anns_dict[setname].append(annotation)
-                anno_id += 1
-
-            for bbox in textline_dict.get("word_bboxes", list()):
-                x, y, width, height = bbox
-                x0, y0, x1, y1 = max(x, 0), max(y, 0), min(x+width, imgw), min(y+height, imgh)
-                x, y, width, height = x0, y0, x1 - x0, y1 - y0
-                annotation = create_coco_annotation_field(anno_id, image_id, width, height, x, y, cat_id=1)
-                anns_dict[setname].append(annotation)
-                anno_id += 1
+            # writer offsets and counters after every checkpoint_interval chunks; the random state
+            # needs no saving, as every chunk is seeded from the base seed and its index
+            tasks_done += 1
+            if tasks_done % args.checkpoint_interval == 0 and tasks_done < len(tasks):
+                save_checkpoint(checkpoint_path, {"args": output_args(args), "base_seed": base_seed.entropy,
+                    "tasks_done": tasks_done,
+                    "annotation_writers": {k: v.checkpoint() for k, v in annotation_writers.items()},
+                    "shard_writers": {k: v.checkpoint() for k, v in shard_writers.items()}})
+
+    if not pool is None:
+        pool.close()
+        pool.join()
+    elif not WORKER_STATE["image_writer"] is None:
+        WORKER_STATE["image_writer"].close()
 
     # output
-    for setname, pct in zip(SETNAMES, train_test_val_split):
-        coco_json = COCO_JSON_SKELETON.copy()
-        coco_json["images"] = images_dict[setname]
-        coco_json["annotations"] = anns_dict[setname]
-        with open(os.path.join(outdir, f"{setname}{int(pct*100)}.json"), 'w') as f:
-            json.dump(coco_json, f, indent=2)
+    # annotation ids run on across splits, in split order, within every dataset
+    json_ext = ".json.gz" if args.gzip_json else ".json"
+    for variant, dataset_dir in dataset_dirs.items():
+        anno_id = 0
+        for setname, name in store_names.items():
+            annotation_writer = annotation_writers[writer_key(variant, setname)]
+            annotation_writer.close(first_anno_id=anno_id)
+            anno_id += annotation_writer.num_annotations
+            if args.annotation_format in ("coco", "both"):
+                AnnotationStore(annotation_writer.path).write_coco(os.path.join(dataset_dir, f"{name}{json_ext}"),
+                    indent=None if args.compact_json else 2, compress=args.gzip_json)
+            if args.annotation_format == "coco":
+                shutil.rmtree(annotation_writer.path)
+    for shard_writer in shard_writers.values():
+        shard_writer.close()
+    if os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    if args.num_shards > 1:
+        for dataset_dir in dataset_dirs.values():
+            with open(os.path.join(dataset_dir, "shard.json"), "w") as f:
+                json.dump({"shard_index": args.shard_index, "num_shards": args.num_shards, "seed": base_seed.entropy,
+                    "args": output_args(args)}, f)
+
+    # image writer stats, summed over processes
+    if len(writer_stats) > 0:
+        print(f"Image writer: {writer_stats['written']} written, {writer_stats['failed']} failed, "
+            f"queue depth mean {writer_stats['depth_sum'] / max(writer_stats['submitted'], 1):.1f} max {writer_stats['max_depth']}, "
+            f"encode {writer_stats['encode_time']:.2f}s, write {writer_stats['write_time']:.2f}s, "
+            f"blocked on a full queue {writer_stats['wait_time']:.2f}s")
+
+    # final profile
+    if not profile_report is None:
+        print(profile_report.format_summary())
+        if not args.profile_output is None:
+            profile_report.export(args.profile_output)
+
+    # cache stats, only available when generating in this process
+    if pool is None:
+        print(f"Font cache: {WORKER_STATE['font_cache'].stats()}")
+        print(f"Glyph cache: {WORKER_STATE['glyph_cache'].stats()}")
+        if not WORKER_STATE["glyph_atlas"] is None:
+            print(f"Glyph atlas: {WORKER_STATE['glyph_atlas'].stats()}")
 
     # charset
-    with open(os.path.join(outdir, f"charset.txt"), 'w') as f:
-        f.write("\n".join(str(ord(c)) for c in list(textline_generator.all_chars)))
+    for dataset_dir in dataset_dirs.values():
+        with open(os.path.join(dataset_dir, f"charset.txt"), 'w') as f:
+            f.write("\n".join(str(ord(c)) for c in sorted(all_chars)))
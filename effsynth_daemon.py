@@ -0,0 +1,54 @@
+import os
+import signal
+import argparse
+
+from core.daemon import GenerationService, GenerationDaemon
+from utils.lexicon import DEFAULT_LEXICON_PATH
+
+
+def stop(signum, frame):
+    raise KeyboardInterrupt
+
+
+if __name__ == '__main__':
+
+    # keeps generators, fonts, glyphs and coverage warm in one long lived process, serving batches of
+    # textlines to any number of local clients over a unix domain socket; see core.daemon.DaemonClient
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--socket", type=str, default="/tmp/effsynth.sock",
+        help="Path of the unix domain socket to listen on")
+    parser.add_argument("--font_root", type=str, default="fonts",
+        help="Folder with a font folder per language, used by requests that don't name a font folder")
+    parser.add_argument("--char_root", type=str, default="chars",
+        help="Folder with a char set folder per language, used by requests that don't name a char folder")
+    parser.add_argument("--font_cache_size", type=int, default=64,
+        help="Number of (font, size) pairs kept loaded")
+    parser.add_argument("--glyph_cache_mb", type=float, default=256,
+        help="Memory budget of the glyph render cache in MB")
+    parser.add_argument("--glyph_atlas_dir", type=str, default=None,
+        help="Folder of glyph atlases built with build_atlas.py, memory mapped instead of rasterizing glyphs")
+    parser.add_argument("--coverage_cache_dir", type=str,
+        default=os.path.join(os.path.expanduser("~"), ".cache", "effsynth", "coverage"),
+        help="Folder for cached font coverage; empty disables it")
+    parser.add_argument("--lexicon", type=str, default=DEFAULT_LEXICON_PATH,
+        help="Word list used by requests asking for real words")
+    parser.add_argument("--max_generators", type=int, default=16,
+        help="Number of generator configurations kept warm, the least recently used are dropped")
+    parser.add_argument("--text_batch_size", type=int, default=64,
+        help="Number of texts sampled at once by unseeded requests")
+    args = parser.parse_args()
+
+    service = GenerationService(args.font_root, args.char_root, args.coverage_cache_dir, args.font_cache_size,
+        args.glyph_cache_mb, args.glyph_atlas_dir, args.lexicon, args.max_generators, args.text_batch_size)
+    server = GenerationDaemon(args.socket, service)
+
+    # the socket file is removed however the daemon is stopped
+    signal.signal(signal.SIGTERM, stop)
+    print(f"Serving on {args.socket}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(f"Stopped after {service.stats()['requests']} requests")
@@ -0,0 +1,27 @@
+import os
+import argparse
+
+from utils.annotations import AnnotationStore
+
+
+if __name__ == '__main__':
+
+    # writes the COCO file of a columnar annotation store, e.g. train80.annotations to train80.json,
+    # for runs made with --annotation_format columns
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--store", type=str, required=True,
+        help="Path to a split's .annotations folder")
+    parser.add_argument("--output", type=str, default=None,
+        help="Path of the COCO file; defaults to the store's path with a .json extension")
+    parser.add_argument('--compact_json', action='store_true', default=False,
+        help="Write the COCO file without indentation or spaces between separators")
+    parser.add_argument('--gzip_json', action='store_true', default=False,
+        help="Gzip the COCO file")
+    args = parser.parse_args()
+
+    output = args.output
+    if output is None:
+        output = os.path.splitext(args.store.rstrip(os.sep))[0] + (".json.gz" if args.gzip_json else ".json")
+    coco_writer = AnnotationStore(args.store).write_coco(output,
+        indent=None if args.compact_json else 2, compress=args.gzip_json)
+    print(f"{output}: {coco_writer.num_images} images, {coco_writer.num_annotations} annotations")
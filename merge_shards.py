@@ -0,0 +1,139 @@
+import os
+import re
+import json
+import gzip
+import shutil
+import argparse
+
+from core.core import SETNAMES
+from utils.coco import CocoJsonWriter
+from utils.shards import INDEX_COLUMNS
+from utils.annotations import AnnotationWriter, AnnotationStore
+
+
+def load_shard_info(folder):
+    with open(os.path.join(folder, "shard.json")) as f:
+        return json.load(f)
+
+
+def coco_files(folder):
+    # the COCO file of every split, e.g. train80.json or train80.json.gz
+    files = {}
+    for name in os.listdir(folder):
+        match = re.fullmatch(r"([a-z]+)\d+\.json(\.gz)?", name)
+        if match and match.group(1) in SETNAMES:
+            files[match.group(1)] = name
+    return files
+
+
+def store_folders(folder):
+    # the columnar annotation store of every split, e.g. train80.annotations
+    folders = {}
+    for name in os.listdir(folder):
+        match = re.fullmatch(r"([a-z]+)\d+\.annotations", name)
+        if match and match.group(1) in SETNAMES:
+            folders[match.group(1)] = name
+    return folders
+
+
+def load_coco(path):
+    with (gzip.open(path, "rt", encoding="utf-8") if path.endswith(".gz") else open(path, "r", encoding="utf-8")) as f:
+        return json.load(f)
+
+
+def coco_indent(path):
+    # compact files have no newline after the opening brace
+    with (gzip.open(path, "rb") if path.endswith(".gz") else open(path, "rb")) as f:
+        return 2 if f.read(2) == b"{\n" else None
+
+
+def transfer(src, dst, move):
+    if move:
+        os.replace(src, dst)
+    else:
+        shutil.copyfile(src, dst)
+
+
+if __name__ == '__main__':
+
+    # merges the output folders of a run split with --num_shards into what a single node would write:
+    # images and annotations in id order, with annotation ids renumbered across nodes
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--inputs", type=str, required=True,
+        help="Output folders of every node, as a comma separated list")
+    parser.add_argument("--output_folder", type=str, required=True,
+        help="Folder for the merged dataset")
+    parser.add_argument('--move', action='store_true', default=False,
+        help="Move images and tar shards instead of copying them")
+    args = parser.parse_args()
+
+    folders = args.inputs.split(",")
+    infos = [load_shard_info(x) for x in folders]
+    folders = [folder for info, folder in sorted(zip(infos, folders), key=lambda x: x[0]["shard_index"])]
+    infos = sorted(infos, key=lambda x: x["shard_index"])
+    num_shards = infos[0]["num_shards"]
+    assert [x["shard_index"] for x in infos] == list(range(num_shards)), \
+        f"Expected the outputs of shards 0 to {num_shards - 1}, got {[x['shard_index'] for x in infos]}"
+    for info in infos[1:]:
+        changed = [k for k, v in info["args"].items() if not k in ("shard_index", "output_folder") and infos[0]["args"].get(k) != v]
+        assert len(changed) == 0 and info["seed"] == infos[0]["seed"], f"Shards were run with different arguments: {changed}"
+
+    outdir = args.output_folder
+    os.makedirs(outdir, exist_ok=True)
+
+    # coco files, in the order a single node merges chunks: split by split, node by node
+    anno_id = 0
+    names = coco_files(folders[0])
+    for setname in SETNAMES:
+        if not setname in names:
+            continue
+        first_path = os.path.join(folders[0], names[setname])
+        coco_writer = CocoJsonWriter(os.path.join(outdir, names[setname]),
+            indent=coco_indent(first_path), compress=first_path.endswith(".gz"))
+        for folder in folders:
+            coco = load_coco(os.path.join(folder, names[setname]))
+            for image in coco["images"]:
+                coco_writer.add_image(image)
+            for annotation in coco["annotations"]:
+                annotation["id"] = anno_id
+                coco_writer.add_annotation(annotation)
+                anno_id += 1
+        coco_writer.close()
+        print(f"{names[setname]}: {coco_writer.num_images} images, {coco_writer.num_annotations} annotations")
+
+    # columnar annotation stores, concatenated in the same order
+    anno_id = 0
+    names = store_folders(folders[0])
+    for setname in SETNAMES:
+        if not setname in names:
+            continue
+        annotation_writer = AnnotationWriter(os.path.join(outdir, names[setname]))
+        for folder in folders:
+            annotation_writer.append_store(AnnotationStore(os.path.join(folder, names[setname])))
+        annotation_writer.close(first_anno_id=anno_id)
+        anno_id += annotation_writer.num_annotations
+        print(f"{names[setname]}: {annotation_writer.num_images} images, {annotation_writer.num_annotations} annotations")
+
+    # images, or tar shards with their indexes concatenated per split
+    for folder in folders:
+        images_path = os.path.join(folder, "images")
+        if os.path.isdir(images_path):
+            os.makedirs(os.path.join(outdir, "images"), exist_ok=True)
+            for name in os.listdir(images_path):
+                transfer(os.path.join(images_path, name), os.path.join(outdir, "images", name), args.move)
+        shards_path = os.path.join(folder, "shards")
+        if os.path.isdir(shards_path):
+            os.makedirs(os.path.join(outdir, "shards"), exist_ok=True)
+            for name in os.listdir(shards_path):
+                if name.endswith(".tar"):
+                    transfer(os.path.join(shards_path, name), os.path.join(outdir, "shards", name), args.move)
+    if os.path.isdir(os.path.join(folders[0], "shards")):
+        for setname in SETNAMES:
+            with open(os.path.join(outdir, "shards", f"{setname}.index.tsv"), "w", encoding="utf-8") as out:
+                out.write("\t".join(INDEX_COLUMNS) + "\n")
+                for info, folder in zip(infos, folders):
+                    with open(os.path.join(folder, "shards", f"{setname}.node{info['shard_index']}.index.tsv"), encoding="utf-8") as f:
+                        next(f)
+                        shutil.copyfileobj(f, out)
+
+    shutil.copyfile(os.path.join(folders[0], "charset.txt"), os.path.join(outdir, "charset.txt"))
@@ -0,0 +1,186 @@
+import os
+import json
+import shutil
+import numpy as np
+
+from utils.misc import reopen_truncated
+from utils.coco import create_coco_annotation_field, CocoJsonWriter
+
+
+# columns of a split's annotation store, each a .npy file that can be memory mapped; texts and file
+# names are utf-8 blobs indexed by end offsets, so image i's text is text[text_ends[i-1]:text_ends[i]]
+IMAGE_COLUMNS = {"image_id": "<i8", "width": "<i4", "height": "<i4", "text_ends": "<i8", "file_name_ends": "<i8"}
+ANNOTATION_COLUMNS = {"ann_image_id": "<i8", "category": "u1", "x": "<i4", "y": "<i4", "w": "<i4", "h": "<i4"}
+BLOB_COLUMNS = ("text", "file_name")
+FLUSH_ANNOTATIONS = 2**16
+
+
+def annotations_array(annotations):
+    # (category, x, y, w, h) rows as an (n, 5) int32 array
+    return np.array(annotations, dtype=np.int32).reshape(-1, 5)
+
+
+def write_npy(path, raw_path, dtype, length):
+    # a raw column file becomes a .npy file, by writing the header and copying the data after it
+    with open(f"{path}.tmp", "wb") as f:
+        np.lib.format.write_array_header_1_0(f, {"descr": np.dtype(dtype).str, "fortran_order": False, "shape": (length,)})
+        with open(raw_path, "rb") as raw:
+            shutil.copyfileobj(raw, f)
+    os.replace(f"{path}.tmp", path)
+
+
+class AnnotationWriter:
+
+    # appends the images and boxes of one split to raw column files, buffering boxes in arrays
+    # between flushes; close() turns the columns into .npy files in the store's folder
+    #
+    # the raw files stay in a .tmp folder until close; checkpoint() returns their lengths, which
+    # are passed back in as resume_state to truncate them to where the checkpoint was taken
+    def __init__(self, path, resume_state=None):
+        self.path = path
+        self.tmp_dir = f"{path}.tmp"
+        os.makedirs(self.tmp_dir, exist_ok=True)
+        columns = list(IMAGE_COLUMNS) + list(ANNOTATION_COLUMNS) + list(BLOB_COLUMNS)
+        self.files = {}
+        for name in columns:
+            raw_path = os.path.join(self.tmp_dir, name)
+            if resume_state is None:
+                self.files[name] = open(raw_path, "wb")
+            else:
+                self.files[name] = reopen_truncated(raw_path, resume_state["offsets"][name])
+        state = resume_state if not resume_state is None else {}
+        self.num_images = state.get("num_images", 0)
+        self.num_annotations = state.get("num_annotations", 0)
+        self.blob_sizes = {name: state.get("blob_sizes", {}).get(name, 0) for name in BLOB_COLUMNS}
+        self.images = []
+        self.annotations = []
+        self.buffered_annotations = 0
+
+    def add(self, image, annotations):
+        # image is a COCO image dict, annotations an (n, 5) array of (category, x, y, w, h)
+        self.images.append(image)
+        if len(annotations) > 0:
+            self.annotations.append((image["id"], annotations))
+            self.buffered_annotations += len(annotations)
+        if self.buffered_annotations >= FLUSH_ANNOTATIONS:
+            self.flush()
+
+    def flush(self):
+        if len(self.images) > 0:
+            blobs = {name: [x[name].encode("utf-8") for x in self.images] for name in BLOB_COLUMNS}
+            columns = {"image_id": [x["id"] for x in self.images], "width": [x["width"] for x in self.images],
+                "height": [x["height"] for x in self.images]}
+            for name in BLOB_COLUMNS:
+                ends = self.blob_sizes[name] + np.cumsum([len(x) for x in blobs[name]])
+                columns[f"{name}_ends"] = ends
+                self.files[name].write(b"".join(blobs[name]))
+                self.blob_sizes[name] = int(ends[-1])
+            for name, dtype in IMAGE_COLUMNS.items():
+                self.files[name].write(np.asarray(columns[name], dtype=dtype).tobytes())
+            self.num_images += len(self.images)
+            self.images = []
+        if len(self.annotations) > 0:
+            boxes = np.concatenate([x for _, x in self.annotations])
+            image_ids = np.repeat([image_id for image_id, _ in self.annotations], [len(x) for _, x in self.annotations])
+            for name, values in zip(ANNOTATION_COLUMNS, [image_ids] + [boxes[:, i] for i in range(5)]):
+                self.files[name].write(values.astype(ANNOTATION_COLUMNS[name]).tobytes())
+            self.num_annotations += len(boxes)
+            self.annotations = []
+            self.buffered_annotations = 0
+
+    def append_store(self, store):
+        # appends a whole store column by column, shifting its blob offsets past what was written
+        self.flush()
+        for name, dtype in IMAGE_COLUMNS.items():
+            values = np.asarray(store[name])
+            if name.endswith("_ends"):
+                values = values + self.blob_sizes[name[:-len("_ends")]]
+            self.files[name].write(values.astype(dtype).tobytes())
+        for name in BLOB_COLUMNS:
+            self.files[name].write(np.asarray(store[name]).tobytes())
+            self.blob_sizes[name] += len(store[name])
+        for name, dtype in ANNOTATION_COLUMNS.items():
+            self.files[name].write(np.asarray(store[name]).astype(dtype).tobytes())
+        self.num_images += len(store)
+        self.num_annotations += store.meta["num_annotations"]
+
+    def checkpoint(self):
+        self.flush()
+        for f in self.files.values():
+            f.flush()
+        return {"offsets": {name: f.tell() for name, f in self.files.items()}, "num_images": self.num_images,
+            "num_annotations": self.num_annotations, "blob_sizes": dict(self.blob_sizes)}
+
+    def close(self, first_anno_id=0):
+        # first_anno_id is the COCO id of the split's first box, as ids run on across splits
+        self.flush()
+        for f in self.files.values():
+            f.close()
+        os.makedirs(self.path, exist_ok=True)
+        lengths = {**{name: self.num_images for name in IMAGE_COLUMNS},
+            **{name: self.num_annotations for name in ANNOTATION_COLUMNS}}
+        dtypes = {**IMAGE_COLUMNS, **ANNOTATION_COLUMNS, **{name: "u1" for name in BLOB_COLUMNS}}
+        for name in dtypes:
+            raw_path = os.path.join(self.tmp_dir, name)
+            write_npy(os.path.join(self.path, f"{name}.npy"), raw_path, dtypes[name],
+                lengths.get(name, os.path.getsize(raw_path)))
+        with open(os.path.join(self.path, "meta.json"), "w") as f:
+            json.dump({"num_images": self.num_images, "num_annotations": self.num_annotations,
+                "first_anno_id": first_anno_id}, f)
+        shutil.rmtree(self.tmp_dir)
+
+
+class AnnotationStore:
+
+    # read side of a store written by AnnotationWriter, with every column memory mapped
+    def __init__(self, path, mmap=True):
+        self.path = path
+        with open(os.path.join(path, "meta.json")) as f:
+            self.meta = json.load(f)
+        self.columns = {name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r" if mmap else None)
+            for name in list(IMAGE_COLUMNS) + list(ANNOTATION_COLUMNS) + list(BLOB_COLUMNS)}
+
+    def __len__(self):
+        return self.meta["num_images"]
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def images(self, start=0, stop=None):
+        # COCO image dicts of images start to stop, decoding each blob range at once
+        stop = len(self) if stop is None else min(stop, len(self))
+        if stop <= start:
+            return []
+        columns = {name: self.columns[name][start:stop].tolist() for name in ("image_id", "width", "height")}
+        strings = {}
+        for name in BLOB_COLUMNS:
+            ends = self.columns[f"{name}_ends"][start:stop].tolist()
+            blob_start = int(self.columns[f"{name}_ends"][start-1]) if start > 0 else 0
+            blob = self.columns[name][blob_start:ends[-1]].tobytes()
+            starts = [blob_start] + ends[:-1]
+            strings[name] = [blob[a-blob_start:b-blob_start].decode("utf-8") for a, b in zip(starts, ends)]
+        return [{"width": w, "height": h, "id": image_id, "file_name": file_name, "text": text}
+            for image_id, w, h, file_name, text in zip(columns["image_id"], columns["width"], columns["height"],
+                strings["file_name"], strings["text"])]
+
+    def image_boxes(self, i):
+        # (category, x, y, w, h) rows of the i-th image, found by binary search as image ids only grow
+        image_ids = self.columns["ann_image_id"]
+        image_id = self.columns["image_id"][i]
+        start, end = np.searchsorted(image_ids, image_id, side="left"), np.searchsorted(image_ids, image_id, side="right")
+        return np.stack([self.columns[name][start:end] for name in list(ANNOTATION_COLUMNS)[1:]], axis=1).astype(np.int32)
+
+    def write_coco(self, path, indent=2, compress=False, first_anno_id=None, block_size=2**16):
+        # the COCO file of the split, built from the columns a block at a time
+        anno_id = self.meta["first_anno_id"] if first_anno_id is None else first_anno_id
+        coco_writer = CocoJsonWriter(path, indent=indent, compress=compress)
+        for start in range(0, len(self), block_size):
+            for image in self.images(start, start + block_size):
+                coco_writer.add_image(image)
+        for start in range(0, self.meta["num_annotations"], block_size):
+            block = [self.columns[name][start:start+block_size].tolist() for name in ANNOTATION_COLUMNS]
+            for image_id, cat_id, x, y, w, h in zip(*block):
+                coco_writer.add_annotation(create_coco_annotation_field(anno_id, image_id, w, h, x, y, cat_id=cat_id))
+                anno_id += 1
+        coco_writer.close()
+        return coco_writer
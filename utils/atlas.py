@@ -0,0 +1,155 @@
+from PIL import ImageFont
+import numpy as np
+import hashlib
+import json
+import os
+
+from utils.fonts import file_signature
+from utils.glyphs import rasterize_glyph, glyph_metrics
+
+
+ATLAS_VERSION = 2
+
+
+def atlas_name(font_path, font_size):
+    digest = hashlib.sha1(os.path.abspath(font_path).encode("utf-8")).hexdigest()[:12]
+    return f"{os.path.splitext(os.path.basename(font_path))[0]}-{font_size}-{digest}"
+
+
+def index_path(atlas_dir, font_path, font_size):
+    return os.path.join(atlas_dir, f"{atlas_name(font_path, font_size)}.index.npz")
+
+
+def build_atlas(atlas_dir, font_path, font_size, codepoints):
+
+    # renders every glyph into one uint8 blob, with offsets, shapes, bboxes and metrics indexed by
+    # codepoint; glyphs without ink get an empty shape and a (-1, -1, -1, -1) bbox
+    font = ImageFont.truetype(font_path, size=font_size)
+    codepoints = np.unique(np.asarray(codepoints, dtype=np.uint32))
+    shapes = np.zeros((len(codepoints), 2), dtype=np.int32)
+    bboxes = np.full((len(codepoints), 4), -1, dtype=np.int32)
+    metrics = np.zeros((len(codepoints), 4), dtype=np.int32)
+    renders = []
+    for i, codepoint in enumerate(codepoints.tolist()):
+        c = chr(codepoint)
+        char_render, bbox = rasterize_glyph(font, font_size, c)
+        if not char_render is None:
+            shapes[i] = char_render.shape
+            bboxes[i] = bbox
+            renders.append(char_render.ravel())
+        metrics[i] = glyph_metrics(font, c)
+    sizes = shapes[:, 0].astype(np.int64) * shapes[:, 1]
+    offsets = np.cumsum(sizes) - sizes
+    blob = np.concatenate(renders) if len(renders) > 0 else np.zeros(0, dtype=np.uint8)
+
+    # the blob is named after its contents and the index, which names the blob, is written last, so
+    # readers only ever see an index with the blob it was built with, also while an atlas is rebuilt
+    os.makedirs(atlas_dir, exist_ok=True)
+    name = atlas_name(font_path, font_size)
+    blob_file = f"{name}.{hashlib.sha1(blob.tobytes()).hexdigest()[:12]}.glyphs.npy"
+    meta = {"version": ATLAS_VERSION, "font": file_signature(font_path), "font_size": font_size, "blob": blob_file}
+    for path, write in ((os.path.join(atlas_dir, blob_file), lambda f: np.save(f, blob)),
+            (index_path(atlas_dir, font_path, font_size), lambda f: np.savez(f, meta=np.array(json.dumps(meta)),
+                codepoints=codepoints, offsets=offsets, shapes=shapes, bboxes=bboxes, metrics=metrics))):
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            write(f)
+        os.replace(tmp_path, path)
+
+    # blobs of earlier builds are dropped; processes that mapped one keep their mapping
+    for x in os.listdir(atlas_dir):
+        if x.startswith(f"{name}.") and x.endswith(".glyphs.npy") and x != blob_file:
+            os.remove(os.path.join(atlas_dir, x))
+    return len(codepoints), blob.nbytes
+
+
+class FontAtlas:
+
+    # the atlas of one (font, size); glyph views and metric tuples are made on first use, so a
+    # process only holds small objects for the glyphs it draws while the pixels stay in the mapping
+    def __init__(self, blob, index):
+        self.blob = blob
+        self.rows = {chr(x): i for i, x in enumerate(index["codepoints"].tolist())}
+        self.offsets = index["offsets"]
+        self.shapes = index["shapes"]
+        self.bboxes = index["bboxes"]
+        self.metrics = index["metrics"]
+        self.renders = {}
+        self.glyph_metrics = {}
+
+    def get_render(self, c):
+        entry = self.renders.get(c)
+        if entry is None:
+            row = self.rows.get(c)
+            if row is None:
+                return None
+            h, w = self.shapes[row].tolist()
+            offset = int(self.offsets[row])
+            entry = (self.blob[offset:offset+h*w].reshape(h, w), tuple(self.bboxes[row].tolist())) if h > 0 else (None, None)
+            self.renders[c] = entry
+        return entry
+
+    def get_metrics(self, c):
+        metrics = self.glyph_metrics.get(c)
+        if metrics is None:
+            row = self.rows.get(c)
+            if row is None:
+                return None
+            metrics = self.glyph_metrics[c] = tuple(self.metrics[row].tolist())
+        return metrics
+
+
+class GlyphAtlas:
+
+    # read only view of atlases written by build_atlas.py; glyph blobs are memory mapped, so worker
+    # processes share one page cached copy and renders are zero copy views into it. (font, size) pairs
+    # without an atlas, or whose font changed since it was built, return None and get rasterized
+    def __init__(self, atlas_dir):
+        self.atlas_dir = atlas_dir
+        self.atlases = {}
+        self.hits = 0
+        self.misses = 0
+
+    def open(self, font_path, font_size):
+        try:
+            with np.load(index_path(self.atlas_dir, font_path, font_size)) as npz:
+                meta = json.loads(str(npz["meta"]))
+                index = {k: npz[k] for k in npz.files if k != "meta"}
+            if meta["version"] != ATLAS_VERSION or meta["font"] != file_signature(font_path):
+                print(f"Glyph atlas of {font_path} at size {font_size} is stale, rebuild it with build_atlas.py")
+                return None
+            blob = np.load(os.path.join(self.atlas_dir, meta["blob"]), mmap_mode="r")
+        except (OSError, ValueError, KeyError):
+            return None
+        # a plain ndarray view of the mapping, as slicing a memmap is slower
+        return FontAtlas(blob.view(np.ndarray), index)
+
+    def get_atlas(self, font_path, font_size):
+        key = (font_path, font_size)
+        if not key in self.atlases:
+            self.atlases[key] = self.open(font_path, font_size)
+        return self.atlases[key]
+
+    def count(self, entry):
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return entry
+
+    def get_render(self, font_path, font_size, c):
+        atlas = self.get_atlas(font_path, font_size)
+        return self.count(atlas.get_render(c) if not atlas is None else None)
+
+    def get_metrics(self, font_path, font_size, c):
+        atlas = self.get_atlas(font_path, font_size)
+        return self.count(atlas.get_metrics(c) if not atlas is None else None)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total > 0 else 0.,
+            "atlases": sum(not x is None for x in self.atlases.values())
+        }
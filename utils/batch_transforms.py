@@ -0,0 +1,447 @@
+import torch.nn.functional as F
+import numpy as np
+import torch
+import cv2
+from PIL import Image
+
+from utils.transforms import TransformRegistry
+
+
+class ImageBatch:
+
+    # images of one size bucket, padded to a common size and stacked; pixels outside
+    # each image's own size are padding and never reach the output
+    #
+    # every sample draws from a generator of its own, seeded from its seed sequence, so what happens
+    # to it doesn't depend on which images share its batch; without seed sequences they come from np.random
+    def __init__(self, images, seed_seqs=None):
+        self.sizes = [(img.height, img.width) for img in images]
+        arrays = [np.asarray(img) for img in images]
+        self.mode = images[0].mode
+        H = max(h for h, _ in self.sizes)
+        W = max(w for _, w in self.sizes)
+        C = 1 if arrays[0].ndim == 2 else arrays[0].shape[2]
+        self.array = np.full((len(images), H, W, C), 255, dtype=np.uint8)
+        for i, arr in enumerate(arrays):
+            h, w = self.sizes[i]
+            self.array[i, :h, :w] = arr.reshape(h, w, C)
+        self.tensor = None
+        if seed_seqs is None:
+            seed_seqs = [np.random.SeedSequence(np.random.randint(2**32, size=4)) for _ in images]
+        self.rngs = [np.random.default_rng(x) for x in seed_seqs]
+
+    def __len__(self):
+        return len(self.sizes)
+
+    def draw(self, fn):
+        # one draw per sample, each from the sample's own generator
+        return np.array([fn(rng) for rng in self.rngs])
+
+    def applied(self, p):
+        # T.RandomApply and friends, p < torch.rand(1) skips the transform
+        return self.draw(lambda rng: rng.random()) <= p
+
+    def as_tensor(self):
+        # T.ToTensor
+        if self.tensor is None:
+            self.tensor = torch.from_numpy(self.array).permute(0, 3, 1, 2).float().div(255).contiguous()
+            self.array = None
+        return self.tensor
+
+    def as_array(self):
+        # T.ToPILImage followed by np.array
+        if self.array is None:
+            self.array = self.tensor.mul(255).byte().permute(0, 2, 3, 1).contiguous().numpy()
+            self.tensor = None
+        return self.array
+
+    def set_tensor(self, tensor):
+        self.tensor, self.array = tensor, None
+
+    def set_array(self, array):
+        self.array, self.tensor = array, None
+
+    def valid_mask(self):
+        B, _, H, W = self.as_tensor().shape
+        heights = torch.tensor([h for h, _ in self.sizes]).view(B, 1, 1, 1)
+        widths = torch.tensor([w for _, w in self.sizes]).view(B, 1, 1, 1)
+        return (torch.arange(H).view(1, 1, H, 1) < heights) & (torch.arange(W).view(1, 1, 1, W) < widths)
+
+    def reflect_padded(self, idxs, pad):
+        # each image padded with its own reflection, as torch_pad(mode="reflect") would
+        x = self.as_tensor()
+        _, C, H, W = x.shape
+        y = torch.zeros((len(idxs), C, H + 2 * pad, W + 2 * pad), dtype=x.dtype)
+        for j, i in enumerate(idxs.tolist()):
+            h, w = self.sizes[i]
+            y[j, :, :h+2*pad, :w+2*pad] = F.pad(x[i:i+1, :, :h, :w], [pad, pad, pad, pad], mode="reflect")[0]
+        return y
+
+    def fill_constant(self, value, idxs):
+        x = self.as_tensor()
+        for i in idxs:
+            h, w = self.sizes[i]
+            x[i, :, h:, :] = value
+            x[i, :, :, w:] = value
+
+    def unbatch(self):
+        array = self.as_array()
+        mode = "L" if array.shape[3] == 1 else "RGB"
+        return [Image.fromarray(array[i, :h, :w].squeeze(2) if mode == "L" else array[i, :h, :w], mode)
+            for i, (h, w) in enumerate(self.sizes)]
+
+
+def rgb_to_gray(x):
+    return (0.2989 * x[:, 0:1] + 0.587 * x[:, 1:2] + 0.114 * x[:, 2:3]).to(x.dtype)
+
+
+def blend(x, y, ratio):
+    return (ratio * x + (1.0 - ratio) * y).clamp(0, 1.0)
+
+
+def rgb_to_hsv(x):
+    r, g, b = x.unbind(dim=1)
+    maxc = torch.max(x, dim=1)[0]
+    minc = torch.min(x, dim=1)[0]
+    eqc = maxc == minc
+    cr = maxc - minc
+    ones = torch.ones_like(maxc)
+    s = cr / torch.where(eqc, ones, maxc)
+    cr_divisor = torch.where(eqc, ones, cr)
+    rc = (maxc - r) / cr_divisor
+    gc = (maxc - g) / cr_divisor
+    bc = (maxc - b) / cr_divisor
+    hr = (maxc == r) * (bc - gc)
+    hg = ((maxc == g) & (maxc != r)) * (2.0 + rc - bc)
+    hb = ((maxc != g) & (maxc != r)) * (4.0 + gc - rc)
+    h = torch.fmod((hr + hg + hb) / 6.0 + 1.0, 1.0)
+    return torch.stack((h, s, maxc), dim=1)
+
+
+def hsv_to_rgb(x):
+    h, s, v = x.unbind(dim=1)
+    i = torch.floor(h * 6.0)
+    f = (h * 6.0) - i
+    i = i.to(dtype=torch.int32) % 6
+    p = (v * (1.0 - s)).clamp(0.0, 1.0)
+    q = (v * (1.0 - s * f)).clamp(0.0, 1.0)
+    t = (v * (1.0 - s * (1.0 - f))).clamp(0.0, 1.0)
+    a1 = torch.stack((v, q, p, p, t, v), dim=1)
+    a2 = torch.stack((t, v, v, q, p, p), dim=1)
+    a3 = torch.stack((p, p, t, v, v, q), dim=1)
+    a4 = torch.stack((a1, a2, a3), dim=1)
+    idx = i.to(dtype=torch.int64).view(i.shape[0], 1, 1, i.shape[1], i.shape[2]).expand(-1, 3, 1, -1, -1)
+    return torch.gather(a4, 2, idx).squeeze(2)
+
+
+def gaussian_kernels(kernel_size, sigmas):
+    ksize_half = (kernel_size - 1) * 0.5
+    x = torch.linspace(-ksize_half, ksize_half, steps=kernel_size).view(1, -1)
+    pdf = torch.exp(-0.5 * (x / sigmas.view(-1, 1)).pow(2))
+    return pdf / pdf.sum(dim=1, keepdim=True)
+
+
+class BatchColorShift:
+
+    # T.RandomApply([color_shift], p)
+    def __init__(self, p):
+        self.p = p
+
+    def __call__(self, batch):
+        x = batch.as_tensor()
+        applied = torch.from_numpy(batch.applied(self.p)).view(-1, 1, 1, 1)
+        colors = torch.from_numpy(batch.draw(lambda rng: rng.random(3))).float().view(-1, 3, 1, 1)
+        batch.set_tensor(torch.where(applied & (x >= 0.8), colors, x))
+
+
+class BatchColorShiftFromTargets:
+
+    # color_shift_from_targets
+    def __init__(self, targets):
+        self.targets = np.array(targets)
+
+    def __call__(self, batch):
+        x = batch.as_tensor()
+        idxs = batch.draw(lambda rng: rng.integers(len(self.targets)))
+        colors = (self.targets[idxs] + batch.draw(lambda rng: rng.normal(0, 2, size=3))) / 255
+        colors = torch.from_numpy(colors).float().view(-1, 3, 1, 1)
+        batch.set_tensor(torch.where(x >= 0.8, colors, x))
+
+
+class BatchColorJitter:
+
+    # T.RandomApply([T.ColorJitter(brightness, contrast, saturation, hue)], p), with the
+    # factors and the order of the four adjustments drawn per sample
+    def __init__(self, brightness, contrast, saturation, hue, p=1.0):
+        self.brightness = (1 - brightness, 1 + brightness)
+        self.contrast = (1 - contrast, 1 + contrast)
+        self.saturation = (1 - saturation, 1 + saturation)
+        self.hue = (-hue, hue)
+        self.p = p
+
+    def __call__(self, batch):
+        x = batch.as_tensor()
+        applied = torch.from_numpy(batch.applied(self.p))
+        fn_idxs = torch.from_numpy(batch.draw(lambda rng: rng.permutation(4)))
+        ranges = np.array([self.brightness, self.contrast, self.saturation, self.hue])
+        factors = torch.from_numpy(batch.draw(lambda rng: rng.uniform(ranges[:, 0], ranges[:, 1]))).float()
+        mask = batch.valid_mask()
+
+        for position in range(4):
+            for fn_id in range(4):
+                idxs = torch.nonzero(applied & (fn_idxs[:, position] == fn_id)).flatten()
+                if len(idxs) == 0:
+                    continue
+                factor = factors[idxs, fn_id].view(-1, 1, 1, 1)
+                x[idxs] = self.adjust(fn_id, x[idxs], factor, mask[idxs])
+
+        batch.set_tensor(x)
+
+    @staticmethod
+    def adjust(fn_id, x, factor, mask):
+        if fn_id == 0:
+            return blend(x, torch.zeros_like(x), factor)
+        if x.shape[1] == 1 and fn_id in (2, 3):
+            return x
+        gray = rgb_to_gray(x) if x.shape[1] == 3 else x
+        if fn_id == 1:
+            mean = (gray * mask).sum(dim=(1, 2, 3), keepdim=True) / mask.sum(dim=(1, 2, 3), keepdim=True)
+            return blend(x, mean, factor)
+        if fn_id == 2:
+            return blend(x, gray, factor)
+        hsv = rgb_to_hsv(x)
+        h = (hsv[:, 0] + factor.view(-1, 1, 1)) % 1.0
+        return hsv_to_rgb(torch.stack((h, hsv[:, 1], hsv[:, 2]), dim=1))
+
+
+class BatchGaussianBlur:
+
+    # T.RandomApply([T.GaussianBlur(kernel_size, sigma)], p), with sigma drawn per sample
+    def __init__(self, kernel_size, sigma=(0.1, 2.0), p=1.0):
+        self.kernel_size = kernel_size
+        self.sigma = sigma
+        self.p = p
+
+    def __call__(self, batch):
+        idxs = torch.from_numpy(np.nonzero(batch.applied(self.p))[0])
+        sigmas = torch.from_numpy(batch.draw(lambda rng: rng.uniform(self.sigma[0], self.sigma[1]))).float()
+        if len(idxs) == 0:
+            return
+        pad = self.kernel_size // 2
+        x = batch.as_tensor()
+        n, c, h, w = len(idxs), x.shape[1], x.shape[2], x.shape[3]
+        kernels = gaussian_kernels(self.kernel_size, sigmas[idxs]).repeat_interleave(c, dim=0)
+        y = batch.reflect_padded(idxs, pad).view(1, n * c, h + 2 * pad, w + 2 * pad)
+        y = F.conv2d(y, kernels.view(n * c, 1, 1, -1), groups=n * c)
+        y = F.conv2d(y, kernels.view(n * c, 1, -1, 1), groups=n * c)
+        x[idxs] = y.view(n, c, h, w)
+        batch.set_tensor(x)
+
+
+class BatchInvert:
+
+    # T.RandomInvert(p)
+    def __init__(self, p):
+        self.p = p
+
+    def __call__(self, batch):
+        x = batch.as_tensor()
+        applied = torch.from_numpy(batch.applied(self.p)).view(-1, 1, 1, 1)
+        batch.set_tensor(torch.where(applied, 1.0 - x, x))
+
+
+class BatchGrayscale:
+
+    # T.RandomGrayscale(p)
+    def __init__(self, p):
+        self.p = p
+
+    def __call__(self, batch):
+        x = batch.as_tensor()
+        if x.shape[1] == 1:
+            return
+        applied = torch.from_numpy(batch.applied(self.p)).view(-1, 1, 1, 1)
+        batch.set_tensor(torch.where(applied, rgb_to_gray(x).expand(x.shape), x))
+
+
+class BatchErodeDilate:
+
+    # T.RandomApply([random_erode_dilate], p), grouping samples by operation and kernel shape
+    def __init__(self, p):
+        self.p = p
+
+    def __call__(self, batch):
+        applied = batch.applied(self.p)
+        dilate = batch.draw(lambda rng: rng.choice([True, False]))
+        kernel_hs = batch.draw(lambda rng: rng.choice([3, 4]))
+        kernel_ws = batch.draw(lambda rng: rng.choice([2, 3]))
+        for op_dilate in (True, False):
+            for kh in (3, 4):
+                for kw in (2, 3):
+                    idxs = np.nonzero(applied & (dilate == op_dilate) & (kernel_hs == kh) & (kernel_ws == kw))[0]
+                    if len(idxs) > 0:
+                        self.morph(batch, idxs, op_dilate, kh, kw)
+
+    @staticmethod
+    def morph(batch, idxs, op_dilate, kh, kw):
+        # kornia.morphology with a flat kernel and geodesic borders is a max/min pool
+        # in which everything outside the image is ignored
+        border = -1e4 if op_dilate else 1e4
+        batch.fill_constant(border, idxs)
+        x = batch.as_tensor()
+        idxs = torch.from_numpy(idxs)
+        y = x[idxs] if op_dilate else -x[idxs]
+        y = F.pad(y, [kw // 2, kw - kw // 2 - 1, kh // 2, kh - kh // 2 - 1], value=-1e4)
+        y = F.max_pool2d(y, (kh, kw), stride=1)
+        x[idxs] = y if op_dilate else -y
+        batch.set_tensor(x)
+
+
+class BatchPixelDropout:
+
+    # A.PixelDropout(dropout_prob, drop_value, p)
+    def __init__(self, dropout_prob, drop_value=0, p=1.0):
+        self.dropout_prob = dropout_prob
+        self.drop_value = drop_value
+        self.p = p
+
+    def __call__(self, batch):
+        idxs = np.nonzero(batch.applied(self.p))[0]
+        if len(idxs) == 0:
+            return
+        array = batch.as_array()
+        for i in idxs:
+            h, w = batch.sizes[i]
+            array[i, :h, :w][batch.rngs[i].random((h, w)) < self.dropout_prob] = self.drop_value
+        batch.set_array(array)
+
+
+class BatchGaussNoise:
+
+    # A.GaussNoise(var_limit, mean, p), with the variance drawn per sample and noise
+    # drawn over each sample's own size
+    def __init__(self, var_limit, mean=0, p=1.0):
+        self.var_limit = var_limit
+        self.mean = mean
+        self.p = p
+
+    def __call__(self, batch):
+        idxs = np.nonzero(batch.applied(self.p))[0]
+        if len(idxs) == 0:
+            return
+        array = batch.as_array()
+        for i in idxs:
+            h, w = batch.sizes[i]
+            rng = batch.rngs[i]
+            sigma = rng.uniform(self.var_limit[0], self.var_limit[1]) ** 0.5
+            noise = rng.standard_normal((h, w, array.shape[3]), dtype=np.float32)
+            noise *= sigma
+            noise += self.mean
+            noise += array[i, :h, :w]
+            array[i, :h, :w] = np.clip(noise, 0, 255)
+        batch.set_array(array)
+
+
+class BatchImageCompression:
+
+    # A.ImageCompression runs a real codec, so it stays per image on the unpadded crop; the quality
+    # is drawn from the sample's generator, as albumentations' own is not seeded with it
+    def __init__(self, quality_lower, quality_upper, p=1.0):
+        self.quality_lower = quality_lower
+        self.quality_upper = quality_upper
+        self.p = p
+
+    def __call__(self, batch):
+        array = batch.as_array()
+        for i in np.nonzero(batch.applied(self.p))[0]:
+            quality = int(batch.rngs[i].integers(self.quality_lower, self.quality_upper + 1))
+            h, w = batch.sizes[i]
+            crop = np.ascontiguousarray(array[i, :h, :w].squeeze(2) if array.shape[3] == 1 else array[i, :h, :w])
+            _, encoded = cv2.imencode(".jpg", crop, (int(cv2.IMWRITE_JPEG_QUALITY), quality))
+            array[i, :h, :w] = cv2.imdecode(encoded, cv2.IMREAD_UNCHANGED).reshape(h, w, -1)
+        batch.set_array(array)
+
+
+class BatchedTransform:
+
+    # runs a list of batch ops over images bucketed by padded size, and returns
+    # the transformed images in their original order
+    def __init__(self, ops, bucket_size=(16, 64)):
+        self.ops = ops
+        self.bucket_size = bucket_size
+
+    def __call__(self, image):
+        return self.transform_batch([image])[0]
+
+    def bucket_key(self, image):
+        bh, bw = self.bucket_size
+        return (image.mode, -(-image.height // bh), -(-image.width // bw))
+
+    def transform_batch(self, images, seed_seqs=None):
+        buckets = {}
+        for i, image in enumerate(images):
+            buckets.setdefault(self.bucket_key(image), []).append(i)
+
+        out_images = [None] * len(images)
+        for idxs in buckets.values():
+            batch = ImageBatch([images[i] for i in idxs], [seed_seqs[i] for i in idxs] if not seed_seqs is None else None)
+            for op in self.ops:
+                op(batch)
+            for i, out_image in zip(idxs, batch.unbatch()):
+                out_images[i] = out_image
+
+        return out_images
+
+
+# built on first use, like the torch presets
+BATCH_TRANSFORM_DICT = TransformRegistry({
+    "default": lambda:
+        BatchedTransform([
+            BatchColorShift(p=0.25),
+            BatchColorJitter(brightness=0.5, contrast=0.3, saturation=0.3, hue=0.3, p=0.5),
+            BatchGaussianBlur(15, sigma=(1, 4), p=0.5),
+            BatchInvert(p=0.2),
+            BatchGrayscale(p=0.2),
+        ]),
+    "album": lambda:
+        BatchedTransform([
+            BatchPixelDropout(dropout_prob=0.01, drop_value=0, p=0.10),
+            BatchGaussNoise(var_limit=(10.0, 100.0), mean=0, p=0.25),
+            BatchImageCompression(quality_lower=0, quality_upper=50, p=0.20),
+            BatchColorShift(p=0.25),
+            BatchColorJitter(brightness=0.5, contrast=0.3, saturation=0.3, hue=0.3, p=0.5),
+            BatchGaussianBlur(15, sigma=(1, 3), p=0.5),
+            BatchInvert(p=0.2),
+            BatchGrayscale(p=0.2),
+            BatchErodeDilate(p=0.25),
+        ]),
+    "pr": lambda:
+        BatchedTransform([
+            BatchColorShiftFromTargets(targets=[[234,234,212], [225, 207, 171]]),
+            BatchGaussianBlur(11, p=0.35),
+        ]),
+    "trdg": lambda:
+        BatchedTransform([
+            BatchGrayscale(p=1.0),
+            BatchErodeDilate(p=0.6),
+            BatchGaussianBlur(9, sigma=(1, 2), p=0.5),
+            BatchGaussNoise(var_limit=(10.0, 150.0), mean=0, p=0.25),
+            BatchImageCompression(quality_lower=0, quality_upper=100, p=0.20),
+        ]),
+    "trdgcolor": lambda:
+        BatchedTransform([
+            BatchColorShift(p=0.5),
+            BatchColorJitter(brightness=0.5, contrast=0.3, saturation=0.3, hue=0.3, p=0.5),
+            BatchGrayscale(p=0.25),
+            BatchErodeDilate(p=0.6),
+            BatchGaussianBlur(9, sigma=(1, 2), p=0.5),
+            BatchGaussNoise(var_limit=(10.0, 150.0), mean=0, p=0.25),
+            BatchImageCompression(quality_lower=0, quality_upper=100, p=0.20),
+        ]),
+    "simple": lambda:
+        BatchedTransform([
+            BatchGrayscale(p=1.0),
+            BatchGaussNoise(var_limit=(10.0, 150.0), mean=0, p=0.25),
+            BatchImageCompression(quality_lower=0, quality_upper=100, p=0.20),
+        ]),
+})
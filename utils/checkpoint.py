@@ -0,0 +1,29 @@
+import os
+import json
+
+
+# args that change how a run goes but not what it outputs, and so may differ when resuming
+RUNTIME_ARGS = ("resume", "workers", "writer_threads", "writer_queue", "font_cache_size", "glyph_cache_mb",
+    "glyph_atlas_dir", "coverage_cache_dir", "checkpoint_interval", "corpus_index_dir",
+    "profile", "profile_interval", "profile_output")
+
+
+def output_args(args):
+    return {k: v for k, v in vars(args).items() if not k in RUNTIME_ARGS}
+
+
+def save_checkpoint(path, state):
+    # written under a temporary name and renamed, so the checkpoint on disk is always complete
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(state, f)
+    os.replace(f"{path}.tmp", path)
+
+
+def load_checkpoint(path, args):
+    if not os.path.exists(path):
+        return None
+    with open(path, "r") as f:
+        state = json.load(f)
+    changed = [k for k, v in output_args(args).items() if state["args"].get(k) != v]
+    assert len(changed) == 0, f"Can't resume, arguments differ from the checkpointed run: {changed}"
+    return state
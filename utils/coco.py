@@ -1,3 +1,7 @@
+import os
+import json
+import gzip
+import shutil
 
 
 COCO_JSON_SKELETON = {
@@ -9,6 +13,12 @@ COCO_JSON_SKELETON = {
     }
 
 
+def clip_bbox(bbox, imgw, imgh):
+    x, y, width, height = bbox
+    x0, y0, x1, y1 = max(x, 0), max(y, 0), min(x+width, imgw), min(y+height, imgh)
+    return x0, y0, x1 - x0, y1 - y0
+
+
 def create_coco_annotation_field(anno_id, image_id, width, height, x, y, cat_id):
     return {
         "id": anno_id, 
@@ -39,4 +49,60 @@ def create_coco_image_entry(path, h, w, image_id):
         "height": h, 
         "width": w, 
         "id": image_id
-    }
\ No newline at end of file
+    }
+
+
+class CocoJsonWriter:
+
+    # streams a COCO file to disk record by record; images go straight to the output, while
+    # annotations are spooled to a side file and appended on close, as COCO lists all images first;
+    # both files stay under .tmp names until close
+    def __init__(self, path, indent=2, compress=False):
+        self.path = path
+        self.indent = indent
+        self.compress = compress
+        self.separators = (",", ":") if indent is None else (",", ": ")
+        self.tmp_path = f"{path}.tmp"
+        self.spool_path = f"{path}.annotations.tmp"
+        self.raw = open(self.tmp_path, "wb")
+        self.spool = open(self.spool_path, "wb")
+        self.num_images = 0
+        self.num_annotations = 0
+        self.f = gzip.GzipFile(fileobj=self.raw, mode="wb", mtime=0) if self.compress else self.raw
+        self.write("{" + self.newline(1) + '"images": [')
+
+    def write(self, text):
+        self.f.write(text.encode("utf-8"))
+
+    def newline(self, depth):
+        return "" if self.indent is None else "\n" + " " * (self.indent * depth)
+
+    def dumps(self, value, depth):
+        text = json.dumps(value, indent=self.indent, separators=self.separators)
+        return text if self.indent is None else text.replace("\n", self.newline(depth))
+
+    def add_image(self, image):
+        self.write(("," if self.num_images > 0 else "") + self.newline(2) + self.dumps(image, 2))
+        self.num_images += 1
+
+    def add_annotation(self, annotation):
+        text = ("," if self.num_annotations > 0 else "") + self.newline(2) + self.dumps(annotation, 2)
+        self.spool.write(text.encode("utf-8"))
+        self.num_annotations += 1
+
+    def close(self):
+        self.write((self.newline(1) if self.num_images > 0 else "") + "]," + self.newline(1) + '"annotations": [')
+        self.spool.close()
+        with open(self.spool_path, "rb") as spool:
+            shutil.copyfileobj(spool, self.f)
+        os.remove(self.spool_path)
+        self.write((self.newline(1) if self.num_annotations > 0 else "") + "]")
+        for key, value in COCO_JSON_SKELETON.items():
+            if key in ("images", "annotations"):
+                continue
+            self.write("," + self.newline(1) + json.dumps(key) + self.separators[1] + self.dumps(value, 1))
+        self.write(self.newline(0) + "}")
+        if self.compress:
+            self.f.close()
+        self.raw.close()
+        os.replace(self.tmp_path, self.path)
@@ -0,0 +1,103 @@
+import os
+import re
+import json
+import hashlib
+import numpy as np
+
+from utils.fonts import file_signature
+
+
+# number of cleaned chars gathered before they are appended to the corpus blob
+FLUSH_CHARS = 1 << 22
+
+
+def list_corpus_files(corpus_paths):
+    # comma separated files or folders of files, in a stable order
+    files = []
+    for path in corpus_paths.split(","):
+        if os.path.isdir(path):
+            files.extend(sorted(os.path.join(root, x) for root, _, names in os.walk(path) for x in names))
+        else:
+            files.append(path)
+    return files
+
+
+def corpus_index_dir(index_root, files, all_chars):
+    # one index per set of source files and charset, invalidated when either changes
+    key = json.dumps({"files": [file_signature(x) for x in files], "chars": "".join(sorted(all_chars))})
+    return os.path.join(index_root, hashlib.sha1(key.encode("utf-8")).hexdigest())
+
+
+def build_corpus_index(files, index_dir, all_chars):
+
+    # cleans the corpus the same way as wikipedia pages, keeping charset chars and spaces, and
+    # stores it as one blob of codepoints with lines joined by spaces, plus the (start, end) offsets
+    # of every word in it
+    tmp_dir = f"{index_dir}.{os.getpid()}.tmp"
+    os.makedirs(tmp_dir, exist_ok=True)
+    strip = re.compile("[^" + re.escape("".join(sorted(all_chars - {"\n", "="}))) + " ]")
+    word_bounds, num_chars, pending, pending_chars = [], 0, [], 0
+
+    with open(os.path.join(tmp_dir, "text.u32"), "wb") as blob:
+
+        def flush():
+            nonlocal num_chars, pending, pending_chars
+            text = np.frombuffer((" ".join(pending) + " ").encode("utf-32-le"), dtype="<u4")
+            non_space = text != ord(" ")
+            edges = np.flatnonzero(np.diff(non_space.astype(np.int8), prepend=0))
+            word_bounds.append(edges.reshape(-1, 2) + num_chars)
+            blob.write(text.tobytes())
+            num_chars += len(text)
+            pending, pending_chars = [], 0
+
+        for path in files:
+            with open(path, "r", encoding="utf-8", errors="ignore") as f:
+                for line in f:
+                    line = strip.sub("", line).strip()
+                    if len(line) > 0:
+                        pending.append(line)
+                        pending_chars += len(line) + 1
+                    if pending_chars >= FLUSH_CHARS:
+                        flush()
+        if len(pending) > 0:
+            flush()
+
+    words = np.concatenate(word_bounds) if len(word_bounds) > 0 else np.zeros((0, 2), dtype=np.int64)
+    assert len(words) > 0, f"No text left in the corpus after keeping only charset chars: {files}"
+    np.save(os.path.join(tmp_dir, "words.npy"), words.astype(np.int64))
+    with open(os.path.join(tmp_dir, "meta.json"), "w") as f:
+        json.dump({"files": files, "num_chars": num_chars, "num_words": len(words)}, f)
+    os.replace(tmp_dir, index_dir)
+
+
+class TextCorpus:
+
+    # memory maps a corpus index, sampling word and char windows in O(1) without reading the corpus
+    def __init__(self, index_dir):
+        self.index_dir = index_dir
+        self.text = np.memmap(os.path.join(index_dir, "text.u32"), dtype="<u4", mode="r")
+        self.words = np.load(os.path.join(index_dir, "words.npy"), mmap_mode="r")
+
+    @classmethod
+    def from_files(cls, corpus_paths, index_root, all_chars):
+        files = list_corpus_files(corpus_paths)
+        index_dir = corpus_index_dir(index_root, files, all_chars)
+        if not os.path.isdir(index_dir):
+            print(f"Building corpus index in {index_dir}")
+            os.makedirs(index_root, exist_ok=True)
+            build_corpus_index(files, index_dir, set(all_chars))
+        return cls(index_dir)
+
+    def decode(self, start, end):
+        return self.text[start:end].tobytes().decode("utf-32-le")
+
+    def sample_words(self, num_words):
+        # consecutive words, which may run over line ends as lines are joined by spaces
+        num_words = min(num_words, len(self.words))
+        idx = np.random.randint(0, len(self.words) - num_words + 1)
+        return self.decode(self.words[idx, 0], self.words[idx + num_words - 1, 1]).split()
+
+    def sample_chars(self, num_chars):
+        num_chars = min(num_chars, len(self.text) - 1)
+        start = np.random.randint(0, len(self.text) - num_chars)
+        return self.decode(start, start + num_chars)
@@ -1,6 +1,10 @@
-from fontTools.ttLib import TTFont
 from itertools import chain
-from fontTools.unicode import Unicode
+from collections import OrderedDict
+from PIL import ImageFont
+import numpy as np
+import hashlib
+import json
+import os
 
 
 def load_chars(path):
@@ -11,8 +15,159 @@ def load_chars(path):
     return chars
 
 
+def load_char_sets(char_folder, char_sets, char_set_props):
+    # returns the chosen char set files and (chars, proportion) pairs, in the order of char_sets
+    char_paths = [os.path.join(char_folder, x) for x in os.listdir(char_folder)]
+    chosen_char_paths = [[x for x in char_paths if c in x][0] for c in char_sets.split(",")]
+    props = [float(x) for x in char_set_props.split(",")]
+    assert 0.9999999 < sum(props) <= 1, f"Character set proportions do not sum to 1! They sum to {sum(props)}!"
+    char_sets_and_props = list(zip([load_chars(x) for x in chosen_char_paths], props))
+    return chosen_char_paths, char_sets_and_props
+
+
+def load_coverage(font_paths, chosen_char_paths, coverage_cache):
+    # coverage of every font, along with the covered part of each char set
+    coverage_dict, charset_coverage_dict = {}, {}
+    for font_path in font_paths:
+        codepoints, intersections = coverage_cache.get(font_path, chosen_char_paths)
+        coverage_dict[font_path] = [chr(x) for x in codepoints]
+        charset_coverage_dict[font_path] = [intersections[x] for x in chosen_char_paths]
+    return coverage_dict, charset_coverage_dict
+
+
 def get_unicode_coverage_from_ttf(ttf_path):
+    # fontTools is only needed on coverage cache misses
+    from fontTools.ttLib import TTFont
+    from fontTools.unicode import Unicode
     with TTFont(ttf_path, 0, allowVID=0, ignoreDecompileErrors=True, fontNumber=-1) as ttf:
         chars = chain.from_iterable([y + (Unicode[y[0]],) for y in x.cmap.items()] for x in ttf["cmap"].tables)
         chars_dec = [x[0] for x in chars]
         return chars_dec, [chr(x) for x in chars_dec]
+
+
+def chars_to_codepoints(chars):
+    return np.unique(np.array([ord(c) for c in chars if len(c) == 1], dtype=np.uint32))
+
+
+def load_codepoints(path):
+    return chars_to_codepoints(load_chars(path))
+
+
+def file_signature(path):
+    stat = os.stat(path)
+    return {"path": os.path.abspath(path), "mtime_ns": stat.st_mtime_ns, "size": stat.st_size}
+
+
+class CoverageCache:
+
+    def __init__(self, cache_dir=None):
+        self.cache_dir = cache_dir
+        if self.cache_dir:
+            os.makedirs(self.cache_dir, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+
+    def cache_path(self, font_path):
+        name = hashlib.sha1(os.path.abspath(font_path).encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, f"{name}.npz")
+
+    def get(self, font_path, char_paths=()):
+
+        # returns sorted covered codepoints and their intersection with each char set file
+        font_sig = file_signature(font_path)
+        char_sigs = {char_path: file_signature(char_path) for char_path in char_paths}
+        entry = self.read(font_path)
+
+        dirty = False
+        if entry is None or entry["meta"]["font"] != font_sig:
+            self.misses += 1
+            chars_dec, _ = get_unicode_coverage_from_ttf(font_path)
+            entry = {"meta": {"font": font_sig, "char_sets": {}}, "arrays": {}}
+            entry["arrays"]["codepoints"] = np.unique(np.array(chars_dec, dtype=np.uint32))
+            dirty = True
+        else:
+            self.hits += 1
+
+        codepoints = entry["arrays"]["codepoints"]
+        intersections = {}
+        for char_path, char_sig in char_sigs.items():
+            char_key = char_sig["path"]
+            char_entry = entry["meta"]["char_sets"].get(char_key)
+            if char_entry is None or char_entry["sig"] != char_sig:
+                array_name = f"char_set_{hashlib.sha1(char_key.encode('utf-8')).hexdigest()}"
+                entry["arrays"][array_name] = np.intersect1d(codepoints, load_codepoints(char_path))
+                entry["meta"]["char_sets"][char_key] = {"sig": char_sig, "array": array_name}
+                char_entry = entry["meta"]["char_sets"][char_key]
+                dirty = True
+            intersections[char_path] = entry["arrays"][char_entry["array"]]
+
+        if dirty:
+            self.write(font_path, entry)
+
+        return codepoints, intersections
+
+    def read(self, font_path):
+        if not self.cache_dir:
+            return None
+        path = self.cache_path(font_path)
+        try:
+            with np.load(path) as npz:
+                meta = json.loads(str(npz["meta"]))
+                arrays = {k: npz[k] for k in npz.files if k != "meta"}
+        except (OSError, ValueError, KeyError):
+            return None
+        return {"meta": meta, "arrays": arrays}
+
+    def write(self, font_path, entry):
+        if not self.cache_dir:
+            return
+        path = self.cache_path(font_path)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                np.savez(f, meta=np.array(json.dumps(entry["meta"])), **entry["arrays"])
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"Could not write coverage cache for {font_path}: {e}")
+
+
+class FontCache:
+
+    def __init__(self, max_size=64):
+        self.max_size = max_size
+        self.fonts = OrderedDict()
+        self.covered_chars = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get_font(self, font_path, size):
+        key = (font_path, size)
+        font = self.fonts.get(key)
+        if font is not None:
+            self.fonts.move_to_end(key)
+            self.hits += 1
+            return font
+        self.misses += 1
+        font = ImageFont.truetype(font_path, size=size)
+        if self.max_size > 0:
+            self.fonts[key] = font
+            if len(self.fonts) > self.max_size:
+                self.fonts.popitem(last=False)
+        return font
+
+    def get_covered_chars(self, font_path, chars):
+        covered_chars = self.covered_chars.get(font_path)
+        if covered_chars is None:
+            covered_chars = set(chars)
+            self.covered_chars[font_path] = covered_chars
+        return covered_chars
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total > 0 else 0.,
+            "size": len(self.fonts),
+            "max_size": self.max_size
+        }
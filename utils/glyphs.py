@@ -0,0 +1,67 @@
+from collections import OrderedDict
+from PIL import Image, ImageDraw
+import numpy as np
+
+
+def rasterize_glyph(font, font_size, c):
+    # cropped, inverted single channel render of a single glyph (None if it has no ink) and its bbox
+    img = Image.new('L', (font_size*4, font_size*4), 0)
+    draw = ImageDraw.Draw(img)
+    draw.text((font_size, font_size), c, 255, font=font, anchor='mm')
+    bbox = img.getbbox()
+    if bbox is None:
+        return None, None
+    return 255 - np.asarray(img.crop(bbox)), bbox
+
+
+def glyph_metrics(font, c):
+    # mask size and full size of a single glyph, as used by the latin renderer
+    mask_w, mask_h = font.getmask(c).size
+    size_w, size_h = font.getsize(c)
+    return mask_w, mask_h, size_w, size_h
+
+
+class GlyphCache:
+
+    def __init__(self, max_bytes=256 * 2**20):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def put(self, key, value, nbytes):
+        if nbytes > self.max_bytes:
+            return value
+        old_entry = self.entries.pop(key, None)
+        if old_entry is not None:
+            self.num_bytes -= old_entry[1]
+        self.entries[key] = (value, nbytes)
+        self.num_bytes += nbytes
+        while self.num_bytes > self.max_bytes:
+            _, (_, evicted_nbytes) = self.entries.popitem(last=False)
+            self.num_bytes -= evicted_nbytes
+            self.evictions += 1
+        return value
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total > 0 else 0.,
+            "evictions": self.evictions,
+            "entries": len(self.entries),
+            "mbytes": round(self.num_bytes / 2**20, 2),
+            "max_mbytes": round(self.max_bytes / 2**20, 2)
+        }
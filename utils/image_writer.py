@@ -0,0 +1,83 @@
+import os
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+def write_bytes(path, data):
+    # written under a temporary name first, so a file at path is always complete
+    with open(f"{path}.tmp", "wb") as f:
+        f.write(data)
+    os.replace(f"{path}.tmp", path)
+
+
+class AsyncImageWriter:
+
+    # encodes and writes images on a pool of threads, fed through a bounded queue: submit blocks
+    # once max_pending images are waiting, so rendering never runs too far ahead of the disk
+    def __init__(self, num_threads=2, max_pending=64):
+        self.executor = ThreadPoolExecutor(num_threads)
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.lock = threading.Lock()
+        self.depth = 0
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.submitted = 0
+        self.written = 0
+        self.failed = 0
+        self.encode_time = 0.
+        self.write_time = 0.
+        self.wait_time = 0.
+        self.depth_sum = 0
+        self.max_depth = 0
+
+    def job(self, encode, write):
+        try:
+            t0 = time.perf_counter()
+            data = encode()
+            t1 = time.perf_counter()
+            if not write is None:
+                write(data)
+            t2 = time.perf_counter()
+            with self.lock:
+                self.encode_time += t1 - t0
+                self.write_time += t2 - t1
+            return data
+        finally:
+            with self.lock:
+                self.depth -= 1
+            self.slots.release()
+
+    def submit(self, encode, write=None):
+        t0 = time.perf_counter()
+        self.slots.acquire()
+        with self.lock:
+            self.wait_time += time.perf_counter() - t0
+            self.depth += 1
+            self.submitted += 1
+            self.depth_sum += self.depth
+            self.max_depth = max(self.max_depth, self.depth)
+        return self.executor.submit(self.job, encode, write)
+
+    def result(self, future):
+        # (True, encoded bytes) once the image is written, (False, None) if encoding or writing failed
+        try:
+            data = future.result()
+        except Exception as e:
+            print(f"Image write failed: {e!r}")
+            self.failed += 1
+            return False, None
+        self.written += 1
+        return True, data
+
+    def pop_stats(self):
+        with self.lock:
+            stats = {"submitted": self.submitted, "written": self.written, "failed": self.failed,
+                "encode_time": self.encode_time, "write_time": self.write_time, "wait_time": self.wait_time,
+                "depth_sum": self.depth_sum, "max_depth": self.max_depth}
+            self.reset_stats()
+        return stats
+
+    def close(self):
+        self.executor.shutdown(wait=True)
@@ -0,0 +1,69 @@
+import re
+import numpy as np
+
+
+DEFAULT_LEXICON_PATH = "/usr/share/dict/words"
+
+
+def read_word_list(path):
+    # "word count" lines give frequency weights; anything else is split into words as before
+    with open(path, "r", encoding="utf-8", errors="ignore") as f:
+        lines = [x.split() for x in f.read().splitlines() if len(x.strip()) > 0]
+    if len(lines) > 0 and all(len(x) == 2 and re.fullmatch(r"[0-9.eE+-]+", x[1]) for x in lines):
+        return [x[0] for x in lines], np.array([float(x[1]) for x in lines])
+    words = re.sub(r"[^\w]", " ", " ".join(" ".join(x) for x in lines)).split()
+    return words, None
+
+
+class Lexicon:
+
+    # words stored as one codepoint blob with offsets, with optional frequency weights; after
+    # index_fonts every font has the ids of the words it fully covers, so sampled words always render
+    def __init__(self, words, weights=None):
+        assert len(words) > 0, "Empty lexicon!"
+        lengths = np.array([len(x) for x in words], dtype=np.int64)
+        self.offsets = np.concatenate([[0], np.cumsum(lengths)])
+        self.blob = np.frombuffer("".join(words).encode("utf-32-le"), dtype="<u4")
+        self.weights = None if weights is None else np.asarray(weights, dtype=np.float64)
+        self.font_words = {}
+        self.font_cum_weights = {}
+
+    @classmethod
+    def from_file(cls, path=DEFAULT_LEXICON_PATH):
+        return cls(*read_word_list(path))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def word(self, idx):
+        return self.blob[self.offsets[idx]:self.offsets[idx+1]].tobytes().decode("utf-32-le")
+
+    def index_fonts(self, coverage):
+        # coverage maps font paths to their covered codepoints
+        starts = self.offsets[:-1]
+        for font_path, codepoints in coverage.items():
+            char_covered = np.isin(self.blob, np.asarray(codepoints, dtype=np.uint32))
+            missing = np.add.reduceat((~char_covered).astype(np.int64), starts)
+            word_ids = np.flatnonzero(missing == 0)
+            if len(word_ids) == 0:
+                print(f"{font_path} covers no words of the lexicon, sampling from all of them")
+                word_ids = np.arange(len(self))
+            self.font_words[font_path] = word_ids
+            if not self.weights is None:
+                self.font_cum_weights[font_path] = np.cumsum(self.weights[word_ids])
+
+    def sample(self, font_path=None, size=None):
+        # word ids, restricted to the words the font covers once fonts are indexed
+        word_ids = self.font_words.get(font_path)
+        if word_ids is None:
+            if self.weights is None:
+                return np.random.randint(0, len(self), size=size)
+            cum_weights = np.cumsum(self.weights)
+            return np.searchsorted(cum_weights, np.random.random(size=size) * cum_weights[-1], side="right")
+        if self.weights is None:
+            return word_ids[np.random.randint(0, len(word_ids), size=size)]
+        cum_weights = self.font_cum_weights[font_path]
+        return word_ids[np.searchsorted(cum_weights, np.random.random(size=size) * cum_weights[-1], side="right")]
+
+    def sample_words(self, font_path=None, num_words=1):
+        return [self.word(x) for x in self.sample(font_path, num_words).tolist()]
@@ -1,3 +1,5 @@
+import sys
+import numpy as np
 
 
 def to_string_list(x):
@@ -8,4 +10,30 @@ def safe_list_get(l, idx, default):
     try:
         return l[idx]
     except IndexError:
-        return default
\ No newline at end of file
+        return default
+
+
+def seed_rngs(seed_seq):
+    # torch is only seeded once something has imported it, the transform presets that use it
+    # are built before any chunk is seeded
+    np.random.seed(seed_seq.generate_state(4))
+    torch = sys.modules.get("torch")
+    if not torch is None:
+        torch.manual_seed(int(seed_seq.generate_state(1, np.uint64)[0]))
+
+
+def reopen_truncated(path, offset):
+    # reopens a partially written file for appending, dropping anything past offset
+    f = open(path, "r+b")
+    f.truncate(offset)
+    f.seek(offset)
+    return f
+
+
+def blit(canvas, glyph, x, y):
+    # copies glyph into canvas with its top left corner at (x, y), clipped to the canvas like Image.paste
+    canvas_h, canvas_w = canvas.shape[:2]
+    h, w = glyph.shape[:2]
+    x0, y0, x1, y1 = max(x, 0), max(y, 0), min(x + w, canvas_w), min(y + h, canvas_h)
+    if x1 > x0 and y1 > y0:
+        canvas[y0:y1, x0:x1] = glyph[y0-y:y1-y, x0-x:x1-x]
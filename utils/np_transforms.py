@@ -0,0 +1,252 @@
+import numpy as np
+import cv2
+
+from utils.transforms import TransformRegistry
+
+
+# every op takes an HxWxC uint8 array and modifies it in place where it can,
+# so that a pipeline works on a single buffer from render to save
+
+
+class NumpyCompose:
+
+    def __init__(self, ops):
+        self.ops = ops
+
+    def __call__(self, image):
+        x = np.array(image)
+        if x.ndim == 2:
+            x = x[:, :, None]
+        for op in self.ops:
+            x = op(x)
+        return x[:, :, 0] if x.shape[2] == 1 else x
+
+
+class RandomApply:
+
+    def __init__(self, op, p):
+        self.op = op
+        self.p = p
+
+    def __call__(self, x):
+        if np.random.random() < self.p:
+            return self.op(x)
+        return x
+
+
+def cv_view(x):
+    # cv2 wants single channel images without a channel axis
+    return x[:, :, 0] if x.shape[2] == 1 else x
+
+
+def gray_values(x):
+    return np.dot(x, np.array([0.2989, 0.587, 0.114], dtype=np.float32))
+
+
+def to_grayscale(x):
+    # T.RandomGrayscale with p=1.0, keeping the number of channels
+    if x.shape[2] == 3:
+        x[...] = gray_values(x).astype(np.uint8)[:, :, None]
+    return x
+
+
+def color_shift(x):
+    # the >= 0.8 threshold of utils.colors.color_shift is >= 204 in uint8
+    color = np.random.random(size=3)
+    for c in range(x.shape[2]):
+        channel = x[:, :, c]
+        channel[channel >= 204] = int(color[c] * 255)
+    return x
+
+
+class ColorShiftFromTargets:
+
+    def __init__(self, targets):
+        self.targets = np.array(targets)
+
+    def __call__(self, x):
+        idx = np.random.choice(range(len(self.targets)))
+        color = [(t + np.random.normal(0, 2)) / 255 for t in self.targets[idx]]
+        for c in range(x.shape[2]):
+            channel = x[:, :, c]
+            channel[channel >= 204] = int(np.clip(color[c], 0, 1) * 255)
+        return x
+
+
+class ColorJitter:
+
+    # T.ColorJitter, run on one float32 working buffer
+    def __init__(self, brightness, contrast, saturation, hue):
+        self.brightness = (1 - brightness, 1 + brightness)
+        self.contrast = (1 - contrast, 1 + contrast)
+        self.saturation = (1 - saturation, 1 + saturation)
+        self.hue = (-hue, hue)
+
+    def __call__(self, x):
+        y = x.astype(np.float32)
+        y *= 1 / 255
+        for fn_id in np.random.permutation(4):
+            if fn_id == 0:
+                y *= np.random.uniform(*self.brightness)
+            elif fn_id == 1:
+                factor = np.random.uniform(*self.contrast)
+                mean = gray_values(y).mean() if y.shape[2] == 3 else y.mean()
+                y *= factor
+                y += (1 - factor) * mean
+            elif fn_id == 2 and y.shape[2] == 3:
+                factor = np.random.uniform(*self.saturation)
+                gray = gray_values(y)[:, :, None]
+                y *= factor
+                y += (1 - factor) * gray
+            elif fn_id == 3 and y.shape[2] == 3:
+                hsv = cv2.cvtColor(y, cv2.COLOR_RGB2HSV)
+                hsv[:, :, 0] += np.random.uniform(*self.hue) * 360
+                hsv[:, :, 0] %= 360
+                cv2.cvtColor(hsv, cv2.COLOR_HSV2RGB, dst=y)
+            np.clip(y, 0, 1, out=y)
+        y *= 255
+        x[...] = y
+        return x
+
+
+class GaussianBlur:
+
+    def __init__(self, kernel_size, sigma=(0.1, 2.0)):
+        self.kernel_size = kernel_size
+        self.sigma = sigma
+
+    def __call__(self, x):
+        sigma = np.random.uniform(*self.sigma)
+        k = (self.kernel_size, self.kernel_size)
+        src = cv_view(x)
+        cv2.GaussianBlur(src, k, sigma, dst=src, borderType=cv2.BORDER_REFLECT_101)
+        return x
+
+
+class RandomInvert:
+
+    def __init__(self, p):
+        self.p = p
+
+    def __call__(self, x):
+        if np.random.random() < self.p:
+            np.subtract(255, x, out=x)
+        return x
+
+
+class RandomGrayscale:
+
+    def __init__(self, p):
+        self.p = p
+
+    def __call__(self, x):
+        if np.random.random() < self.p:
+            return to_grayscale(x)
+        return x
+
+
+def random_erode_dilate(x):
+    # utils.transforms.random_erode_dilate; cv2's default borders ignore pixels outside the image
+    dilate = np.random.choice([True, False])
+    kh, kw = np.random.choice([3,4]), np.random.choice([2,3])
+    kernel = np.ones((kh, kw), dtype=np.uint8)
+    anchor = (kw // 2, kh // 2)
+    src = cv_view(x)
+    if dilate:
+        cv2.dilate(src, kernel, dst=src, anchor=anchor)
+    else:
+        cv2.erode(src, kernel, dst=src, anchor=anchor)
+    return x
+
+
+class PixelDropout:
+
+    def __init__(self, dropout_prob, drop_value=0):
+        self.dropout_prob = dropout_prob
+        self.drop_value = drop_value
+
+    def __call__(self, x):
+        x[np.random.random(size=x.shape[:2]) < self.dropout_prob] = self.drop_value
+        return x
+
+
+class GaussNoise:
+
+    def __init__(self, var_limit, mean=0):
+        self.var_limit = var_limit
+        self.mean = mean
+
+    def __call__(self, x):
+        sigma = np.random.uniform(*self.var_limit) ** 0.5
+        noise = np.random.normal(self.mean, sigma, size=x.shape)
+        noise += x
+        np.clip(noise, 0, 255, out=noise)
+        x[...] = noise
+        return x
+
+
+class ImageCompression:
+
+    def __init__(self, quality_lower, quality_upper):
+        self.quality_lower = quality_lower
+        self.quality_upper = quality_upper
+
+    def __call__(self, x):
+        quality = np.random.randint(self.quality_lower, self.quality_upper + 1)
+        _, encoded = cv2.imencode(".jpg", cv_view(x), (int(cv2.IMWRITE_JPEG_QUALITY), int(quality)))
+        x[...] = cv2.imdecode(encoded, cv2.IMREAD_UNCHANGED).reshape(x.shape)
+        return x
+
+
+# built on first use, like the torch presets
+NUMPY_TRANSFORM_DICT = TransformRegistry({
+    "default": lambda:
+        NumpyCompose([
+            RandomApply(color_shift, p=0.25),
+            RandomApply(ColorJitter(brightness=0.5, contrast=0.3, saturation=0.3, hue=0.3), p=0.5),
+            RandomApply(GaussianBlur(15, sigma=(1, 4)), p=0.5),
+            RandomInvert(p=0.2),
+            RandomGrayscale(p=0.2),
+        ]),
+    "album": lambda:
+        NumpyCompose([
+            RandomApply(PixelDropout(dropout_prob=0.01, drop_value=0), p=0.10),
+            RandomApply(GaussNoise(var_limit=(10.0, 100.0), mean=0), p=0.25),
+            RandomApply(ImageCompression(quality_lower=0, quality_upper=50), p=0.20),
+            RandomApply(color_shift, p=0.25),
+            RandomApply(ColorJitter(brightness=0.5, contrast=0.3, saturation=0.3, hue=0.3), p=0.5),
+            RandomApply(GaussianBlur(15, sigma=(1, 3)), p=0.5),
+            RandomInvert(p=0.2),
+            RandomGrayscale(p=0.2),
+            RandomApply(random_erode_dilate, p=0.25),
+        ]),
+    "pr": lambda:
+        NumpyCompose([
+            ColorShiftFromTargets(targets=[[234,234,212], [225, 207, 171]]),
+            RandomApply(GaussianBlur(11), p=0.35),
+        ]),
+    "trdg": lambda:
+        NumpyCompose([
+            to_grayscale,
+            RandomApply(random_erode_dilate, p=0.6),
+            RandomApply(GaussianBlur(9, sigma=(1, 2)), p=0.5),
+            RandomApply(GaussNoise(var_limit=(10.0, 150.0), mean=0), p=0.25),
+            RandomApply(ImageCompression(quality_lower=0, quality_upper=100), p=0.20),
+        ]),
+    "trdgcolor": lambda:
+        NumpyCompose([
+            RandomApply(color_shift, p=0.5),
+            RandomApply(ColorJitter(brightness=0.5, contrast=0.3, saturation=0.3, hue=0.3), p=0.5),
+            RandomGrayscale(p=0.25),
+            RandomApply(random_erode_dilate, p=0.6),
+            RandomApply(GaussianBlur(9, sigma=(1, 2)), p=0.5),
+            RandomApply(GaussNoise(var_limit=(10.0, 150.0), mean=0), p=0.25),
+            RandomApply(ImageCompression(quality_lower=0, quality_upper=100), p=0.20),
+        ]),
+    "simple": lambda:
+        NumpyCompose([
+            to_grayscale,
+            RandomApply(GaussNoise(var_limit=(10.0, 150.0), mean=0), p=0.25),
+            RandomApply(ImageCompression(quality_lower=0, quality_upper=100), p=0.20),
+        ]),
+})
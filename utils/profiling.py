@@ -0,0 +1,153 @@
+import os
+import math
+import json
+import time
+import numpy as np
+
+
+# log spaced histogram bins from 0.1us to 1000s, 50 per decade
+HIST_MIN_EXP = -7
+HIST_BINS_PER_DECADE = 50
+HIST_NUM_BINS = 10 * HIST_BINS_PER_DECADE
+QUANTILES = (0.5, 0.9, 0.95, 0.99)
+STAGES = ("text", "font", "render", "transform", "save", "save_wait")
+
+
+def hist_bin(seconds):
+    if seconds <= 0:
+        return 0
+    return min(max(int((math.log10(seconds) - HIST_MIN_EXP) * HIST_BINS_PER_DECADE), 0), HIST_NUM_BINS - 1)
+
+
+def bin_upper_edge(idx):
+    return 10 ** (HIST_MIN_EXP + (idx + 1) / HIST_BINS_PER_DECADE)
+
+
+class StageProfiler:
+
+    # wall time per generation stage, overall, per font and per fan-out variant, kept as counts, totals
+    # and log spaced histograms so that snapshots from many workers merge exactly and memory stays
+    # constant; disabled, tic and toc return straight away
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.stats = {}
+
+    def tic(self):
+        return time.perf_counter() if self.enabled else 0.
+
+    def toc(self, stage, t0, font=None, n=1, exclude=0., variant=None):
+        # records the time since t0, less any excluded time, split evenly over n lines
+        if not self.enabled:
+            return 0.
+        elapsed = time.perf_counter() - t0 - exclude
+        self.add((stage, "", ""), elapsed, n)
+        if not font is None:
+            self.add((stage, font, ""), elapsed, n)
+        if not variant is None:
+            self.add((stage, "", variant), elapsed, n)
+        return elapsed
+
+    def add(self, key, elapsed, n):
+        entry = self.stats.get(key)
+        if entry is None:
+            entry = self.stats[key] = {"count": 0, "total": 0., "hist": {}}
+        entry["count"] += n
+        entry["total"] += elapsed
+        idx = hist_bin(elapsed / n)
+        entry["hist"][idx] = entry["hist"].get(idx, 0) + n
+
+    def pop_stats(self):
+        stats, self.stats = self.stats, {}
+        return stats
+
+
+def merge_stats(into, stats):
+    for key, entry in stats.items():
+        merged = into.get(key)
+        if merged is None:
+            merged = into[key] = {"count": 0, "total": 0., "hist": {}}
+        merged["count"] += entry["count"]
+        merged["total"] += entry["total"]
+        for idx, count in entry["hist"].items():
+            merged["hist"][idx] = merged["hist"].get(idx, 0) + count
+
+
+def summarize_entry(entry):
+    idxs = sorted(entry["hist"])
+    cum_counts = np.cumsum([entry["hist"][idx] for idx in idxs])
+    summary = {"count": entry["count"], "total_s": entry["total"], "mean_s": entry["total"] / max(entry["count"], 1)}
+    for q in QUANTILES:
+        pos = min(int(np.searchsorted(cum_counts, q * cum_counts[-1])), len(idxs) - 1)
+        summary[f"p{int(q * 100)}_s"] = bin_upper_edge(idxs[pos])
+    summary["hist"] = {f"{bin_upper_edge(idx):.4g}": entry["hist"][idx] for idx in idxs}
+    return summary
+
+
+class ProfileReport:
+
+    # merges profiler snapshots from the workers, printing throughput and stage percentiles
+    # every interval seconds and exporting the totals as json or prometheus style text
+    def __init__(self, labels, interval=30.):
+        self.labels = labels
+        self.interval = interval
+        self.stats = {}
+        self.lines = 0
+        self.start_time = time.perf_counter()
+        self.last_report = self.start_time
+
+    def update(self, stats, num_lines):
+        merge_stats(self.stats, stats)
+        self.lines += num_lines
+        if self.interval > 0 and time.perf_counter() - self.last_report >= self.interval:
+            self.last_report = time.perf_counter()
+            print(self.format_summary())
+
+    def summary(self):
+        elapsed = time.perf_counter() - self.start_time
+        stages, fonts, variants = {}, {}, {}
+        for (stage, font, variant), entry in sorted(self.stats.items()):
+            if font != "":
+                fonts.setdefault(font, {})[stage] = summarize_entry(entry)
+            elif variant != "":
+                variants.setdefault(variant, {})[stage] = summarize_entry(entry)
+            else:
+                stages[stage] = summarize_entry(entry)
+        return {"labels": self.labels, "lines": self.lines, "elapsed_s": elapsed,
+            "lines_per_s": self.lines / max(elapsed, 1e-9), "stages": stages, "fonts": fonts, "variants": variants}
+
+    def format_summary(self):
+        summary = self.summary()
+        parts = [f"{summary['lines']} lines, {summary['lines_per_s']:.1f} lines/s"]
+        for stage in STAGES:
+            s = summary["stages"].get(stage)
+            if not s is None:
+                parts.append(f"{stage} mean {s['mean_s']*1e3:.2f}ms p50 {s['p50_s']*1e3:.2f}ms p99 {s['p99_s']*1e3:.2f}ms")
+        for variant, stages in summary["variants"].items():
+            s = stages["transform"]
+            parts.append(f"transform {variant} mean {s['mean_s']*1e3:.2f}ms p99 {s['p99_s']*1e3:.2f}ms")
+        return "Profile: " + " | ".join(parts)
+
+    def export(self, path):
+        summary = self.summary()
+        with open(f"{path}.tmp", "w") as f:
+            if path.endswith(".json"):
+                json.dump(summary, f, indent=2)
+            else:
+                f.write(self.to_text(summary))
+        os.replace(f"{path}.tmp", path)
+
+    def to_text(self, summary):
+        # prometheus text exposition format
+        labels = ",".join(f'{k}="{v}"' for k, v in summary["labels"].items())
+        lines = [f"effsynth_lines_total{{{labels}}} {summary['lines']}",
+            f"effsynth_lines_per_second{{{labels}}} {summary['lines_per_s']}"]
+        groups = [("", summary["stages"])] + [(f',font="{font}"', stages) for font, stages in summary["fonts"].items()] + \
+            [(f',variant="{variant}"', stages) for variant, stages in summary["variants"].items()]
+        for group_label, stages in groups:
+            for stage, s in stages.items():
+                stage_labels = f'{labels},stage="{stage}"{group_label}'
+                lines.append(f"effsynth_stage_seconds_count{{{stage_labels}}} {s['count']}")
+                lines.append(f"effsynth_stage_seconds_sum{{{stage_labels}}} {s['total_s']}")
+                for q in QUANTILES:
+                    lines.append(f"effsynth_stage_seconds{{{stage_labels},quantile=\"{q}\"}} {s[f'p{int(q * 100)}_s']}")
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,146 @@
+import os
+import io
+import json
+import tarfile
+
+from utils.misc import reopen_truncated
+
+
+# image codecs, as (PIL format, file extension)
+CODECS = {
+    "png": ("PNG", "png"),
+    "jpg": ("JPEG", "jpg"),
+    "webp": ("WEBP", "webp"),
+}
+
+INDEX_COLUMNS = ("key", "shard", "image_offset", "image_size", "record_offset", "record_size")
+
+
+def image_save_kwargs(codec, png_compress_level=6, quality=95):
+    if codec == "png":
+        return {"compress_level": png_compress_level}
+    return {"quality": quality}
+
+
+def encode_image(image, codec="png", png_compress_level=6, quality=95):
+    buffer = io.BytesIO()
+    image.save(buffer, format=CODECS[codec][0], **image_save_kwargs(codec, png_compress_level, quality))
+    return buffer.getvalue()
+
+
+class ShardWriter:
+
+    # writes samples into tar shards of shard_size samples each, webdataset style: every sample
+    # is an encoded image plus a json record sharing the same key; an index of byte offsets into
+    # the shards is kept alongside them for random access
+    def __init__(self, out_dir, prefix, shard_size, codec="png", resume_state=None):
+        self.out_dir = out_dir
+        self.prefix = prefix
+        self.shard_size = shard_size
+        self.ext = CODECS[codec][1]
+        self.tar = None
+        os.makedirs(out_dir, exist_ok=True)
+        self.index_path = os.path.join(out_dir, f"{prefix}.index.tsv")
+        if resume_state is None:
+            self.shard_idx = -1
+            self.num_in_shard = 0
+            self.num_samples = 0
+            self.index = open(f"{self.index_path}.tmp", "wb")
+            self.index.write(("\t".join(INDEX_COLUMNS) + "\n").encode("utf-8"))
+        else:
+            self.shard_idx = resume_state["shard_idx"]
+            self.num_in_shard = resume_state["num_in_shard"]
+            self.num_samples = resume_state["num_samples"]
+            self.index = reopen_truncated(f"{self.index_path}.tmp", resume_state["index_offset"])
+            if self.shard_idx >= 0:
+                self.open_shard(resume_state["shard_offset"])
+
+    def shard_name(self, shard_idx):
+        return f"{self.prefix}-{shard_idx:06d}.tar"
+
+    def open_shard(self, offset=None):
+        # a shard finished after the last checkpoint is reopened under its .tmp name
+        self.shard_path = os.path.join(self.out_dir, self.shard_name(self.shard_idx))
+        if offset is None:
+            self.raw = open(f"{self.shard_path}.tmp", "wb")
+        else:
+            if not os.path.exists(f"{self.shard_path}.tmp"):
+                os.replace(self.shard_path, f"{self.shard_path}.tmp")
+            self.raw = reopen_truncated(f"{self.shard_path}.tmp", offset)
+        self.tar = tarfile.open(fileobj=self.raw, mode="w", format=tarfile.USTAR_FORMAT)
+
+    def next_shard(self):
+        self.close_shard()
+        self.shard_idx += 1
+        self.num_in_shard = 0
+        self.open_shard()
+
+    def close_shard(self):
+        if not self.tar is None:
+            self.tar.close()
+            self.raw.close()
+            os.replace(f"{self.shard_path}.tmp", self.shard_path)
+            self.tar = None
+
+    def add_member(self, name, data):
+        # returns the offset of the member's data in the shard; mtime is fixed so shards are reproducible
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = 0
+        self.tar.addfile(info, io.BytesIO(data))
+        return self.tar.offset - tarfile.BLOCKSIZE * -(-len(data) // tarfile.BLOCKSIZE)
+
+    def add(self, key, image_bytes, record):
+        if self.tar is None or self.num_in_shard >= self.shard_size:
+            self.next_shard()
+        record_bytes = json.dumps(record).encode("utf-8")
+        image_offset = self.add_member(f"{key}.{self.ext}", image_bytes)
+        record_offset = self.add_member(f"{key}.json", record_bytes)
+        row = (key, self.shard_name(self.shard_idx), image_offset, len(image_bytes), record_offset, len(record_bytes))
+        self.index.write(("\t".join(str(x) for x in row) + "\n").encode("utf-8"))
+        self.num_in_shard += 1
+        self.num_samples += 1
+
+    def checkpoint(self):
+        self.index.flush()
+        state = {"shard_idx": self.shard_idx, "num_in_shard": self.num_in_shard, "num_samples": self.num_samples,
+            "index_offset": self.index.tell(), "shard_offset": None}
+        if not self.tar is None:
+            self.raw.flush()
+            state["shard_offset"] = self.tar.offset
+        return state
+
+    def close(self):
+        self.close_shard()
+        self.index.close()
+        os.replace(f"{self.index_path}.tmp", self.index_path)
+
+
+class ShardReader:
+
+    # random access to samples written by ShardWriter, through its index
+    def __init__(self, index_path):
+        self.out_dir = os.path.dirname(index_path)
+        self.entries = {}
+        with open(index_path, "r", encoding="utf-8") as f:
+            next(f)
+            for line in f:
+                key, shard, *offsets = line.rstrip("\n").split("\t")
+                self.entries[key] = (shard, *[int(x) for x in offsets])
+
+    def __len__(self):
+        return len(self.entries)
+
+    def keys(self):
+        return self.entries.keys()
+
+    def read(self, shard, offset, size):
+        with open(os.path.join(self.out_dir, shard), "rb") as f:
+            f.seek(offset)
+            return f.read(size)
+
+    def get(self, key):
+        shard, image_offset, image_size, record_offset, record_size = self.entries[key]
+        image_bytes = self.read(shard, image_offset, image_size)
+        record = json.loads(self.read(shard, record_offset, record_size))
+        return image_bytes, record
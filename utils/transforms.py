@@ -1,12 +1,44 @@
-import torchvision.transforms as T
-from utils.colors import color_shift_from_targets, color_shift
-import albumentations as A
 import numpy as np
-import kornia
-import torch
+from utils.colors import color_shift_from_targets, color_shift
+
+
+# torch, torchvision, kornia and albumentations are imported by the presets that use them, when
+# they are first built, so that startup only pays for the backend a run actually selects
+
+
+class TransformRegistry:
+
+    # preset name -> builder; a preset is built on first lookup and reused after that, and
+    # other modules can register their own presets
+    def __init__(self, builders=None):
+        self.builders = dict(builders) if not builders is None else {}
+        self.built = {}
+
+    def register(self, name):
+        def decorator(builder):
+            self.builders[name] = builder
+            return builder
+        return decorator
+
+    def __getitem__(self, name):
+        transform = self.built.get(name)
+        if transform is None:
+            transform = self.built[name] = self.builders[name]()
+        return transform
+
+    def __contains__(self, name):
+        return name in self.builders
+
+    def __iter__(self):
+        return iter(self.builders)
+
+    def __len__(self):
+        return len(self.builders)
 
 
 def random_erode_dilate(x):
+    import kornia
+    import torch
     erode = np.random.choice([True, False])
     if erode:
         return kornia.morphology.dilation(x.unsqueeze(0), kernel=torch.ones(np.random.choice([3,4]), np.random.choice([2,3]))).squeeze(0)
@@ -14,69 +46,140 @@ def random_erode_dilate(x):
         return kornia.morphology.erosion(x.unsqueeze(0), kernel=torch.ones(np.random.choice([3,4]), np.random.choice([2,3]))).squeeze(0)
 
 
-TRANSFORM_DICT = {
-    "default":
-        T.Compose([
-            T.ToTensor(),
-            T.RandomApply([color_shift], p=0.25),
-            T.RandomApply([T.ColorJitter(brightness=0.5, contrast=0.3, saturation=0.3, hue=0.3)], p=0.5),
-            T.RandomApply([T.GaussianBlur(15, sigma=(1, 4))], p=0.5),
-            T.RandomInvert(p=0.2),
-            T.RandomGrayscale(p=0.2),
-            T.ToPILImage(),
-        ]),
-    "album":
-        T.Compose([
-            lambda x: A.PixelDropout(dropout_prob=0.01, drop_value=0, p=0.10)(image=np.array(x))["image"],
-            lambda x: A.GaussNoise(var_limit=(10.0, 100.0), mean=0, p=0.25)(image=np.array(x))["image"],
-            lambda x: A.ImageCompression(quality_lower=0, quality_upper=50, p=0.20)(image=np.array(x))["image"],
-            T.ToTensor(),
-            T.RandomApply([color_shift], p=0.25),
-            T.RandomApply([T.ColorJitter(brightness=0.5, contrast=0.3, saturation=0.3, hue=0.3)], p=0.5),
-            T.RandomApply([T.GaussianBlur(15, sigma=(1, 3))], p=0.5),
-            T.RandomInvert(p=0.2),
-            T.RandomGrayscale(p=0.2),
-            T.RandomApply([random_erode_dilate], p=0.25),
-            T.ToPILImage(),
-        ]),
-    "pr":
-        T.Compose([
-            T.ToTensor(),
-            lambda x: color_shift_from_targets(x, targets=[[234,234,212], [225, 207, 171]]),
-            T.RandomApply([T.GaussianBlur(11)], p=0.35),
-            T.ToPILImage()
-        ]),
-    "trdg":
-        T.Compose([
-            T.ToTensor(),
-            T.RandomGrayscale(p=1.0),
-            T.RandomApply([random_erode_dilate], p=0.6),
-            T.RandomApply([T.GaussianBlur(9, sigma=(1, 2))], p=0.5),
-            T.ToPILImage(),
-            lambda x: A.GaussNoise(var_limit=(10.0, 150.0), mean=0, p=0.25)(image=np.array(x))["image"],
-            lambda x: A.ImageCompression(quality_lower=0, quality_upper=100, p=0.20)(image=np.array(x))["image"],
-            T.ToPILImage(),
-        ]),
-    "trdgcolor":
-        T.Compose([
-            T.ToTensor(),
-            T.RandomApply([color_shift], p=0.5),
-            T.RandomApply([T.ColorJitter(brightness=0.5, contrast=0.3, saturation=0.3, hue=0.3)], p=0.5),
-            T.RandomGrayscale(p=0.25),
-            T.RandomApply([random_erode_dilate], p=0.6),
-            T.RandomApply([T.GaussianBlur(9, sigma=(1, 2))], p=0.5),
-            T.ToPILImage(),
-            lambda x: A.GaussNoise(var_limit=(10.0, 150.0), mean=0, p=0.25)(image=np.array(x))["image"],
-            lambda x: A.ImageCompression(quality_lower=0, quality_upper=100, p=0.20)(image=np.array(x))["image"],
-            T.ToPILImage(),
-        ]),
-    "simple":
-        T.Compose([
-            T.ToTensor(),
-            T.RandomGrayscale(p=1.0),
-            T.ToPILImage(),
-            lambda x: A.GaussNoise(var_limit=(10.0, 150.0), mean=0, p=0.25)(image=np.array(x))["image"],
-            lambda x: A.ImageCompression(quality_lower=0, quality_upper=100, p=0.20)(image=np.array(x))["image"],
-            T.ToPILImage(),
-        ]),
-}
+class SeededAlbumentation:
+
+    # albumentations transforms draw from generators of their own, which np.random.seed doesn't reach;
+    # reseeding one from np.random on every call ties its draws to the image's stream like the rest of a preset
+    def __init__(self, transform):
+        self.transform = transform
+
+    def __call__(self, x):
+        self.transform.set_random_seed(int(np.random.randint(2**31)))
+        return self.transform(image=np.array(x))["image"]
+
+
+TRANSFORM_DICT = TransformRegistry()
+
+
+@TRANSFORM_DICT.register("default")
+def build_default():
+    import torchvision.transforms as T
+    return T.Compose([
+        T.ToTensor(),
+        T.RandomApply([color_shift], p=0.25),
+        T.RandomApply([T.ColorJitter(brightness=0.5, contrast=0.3, saturation=0.3, hue=0.3)], p=0.5),
+        T.RandomApply([T.GaussianBlur(15, sigma=(1, 4))], p=0.5),
+        T.RandomInvert(p=0.2),
+        T.RandomGrayscale(p=0.2),
+        T.ToPILImage(),
+    ])
+
+
+@TRANSFORM_DICT.register("album")
+def build_album():
+    import torchvision.transforms as T
+    import albumentations as A
+    return T.Compose([
+        SeededAlbumentation(A.PixelDropout(dropout_prob=0.01, drop_value=0, p=0.10)),
+        SeededAlbumentation(A.GaussNoise(var_limit=(10.0, 100.0), mean=0, p=0.25)),
+        SeededAlbumentation(A.ImageCompression(quality_lower=0, quality_upper=50, p=0.20)),
+        T.ToTensor(),
+        T.RandomApply([color_shift], p=0.25),
+        T.RandomApply([T.ColorJitter(brightness=0.5, contrast=0.3, saturation=0.3, hue=0.3)], p=0.5),
+        T.RandomApply([T.GaussianBlur(15, sigma=(1, 3))], p=0.5),
+        T.RandomInvert(p=0.2),
+        T.RandomGrayscale(p=0.2),
+        T.RandomApply([random_erode_dilate], p=0.25),
+        T.ToPILImage(),
+    ])
+
+
+@TRANSFORM_DICT.register("pr")
+def build_pr():
+    import torchvision.transforms as T
+    return T.Compose([
+        T.ToTensor(),
+        lambda x: color_shift_from_targets(x, targets=[[234,234,212], [225, 207, 171]]),
+        T.RandomApply([T.GaussianBlur(11)], p=0.35),
+        T.ToPILImage()
+    ])
+
+
+@TRANSFORM_DICT.register("trdg")
+def build_trdg():
+    import torchvision.transforms as T
+    import albumentations as A
+    return T.Compose([
+        T.ToTensor(),
+        T.RandomGrayscale(p=1.0),
+        T.RandomApply([random_erode_dilate], p=0.6),
+        T.RandomApply([T.GaussianBlur(9, sigma=(1, 2))], p=0.5),
+        T.ToPILImage(),
+        SeededAlbumentation(A.GaussNoise(var_limit=(10.0, 150.0), mean=0, p=0.25)),
+        SeededAlbumentation(A.ImageCompression(quality_lower=0, quality_upper=100, p=0.20)),
+        T.ToPILImage(),
+    ])
+
+
+@TRANSFORM_DICT.register("trdgcolor")
+def build_trdgcolor():
+    import torchvision.transforms as T
+    import albumentations as A
+    return T.Compose([
+        T.ToTensor(),
+        T.RandomApply([color_shift], p=0.5),
+        T.RandomApply([T.ColorJitter(brightness=0.5, contrast=0.3, saturation=0.3, hue=0.3)], p=0.5),
+        T.RandomGrayscale(p=0.25),
+        T.RandomApply([random_erode_dilate], p=0.6),
+        T.RandomApply([T.GaussianBlur(9, sigma=(1, 2))], p=0.5),
+        T.ToPILImage(),
+        SeededAlbumentation(A.GaussNoise(var_limit=(10.0, 150.0), mean=0, p=0.25)),
+        SeededAlbumentation(A.ImageCompression(quality_lower=0, quality_upper=100, p=0.20)),
+        T.ToPILImage(),
+    ])
+
+
+@TRANSFORM_DICT.register("simple")
+def build_simple():
+    import torchvision.transforms as T
+    import albumentations as A
+    return T.Compose([
+        T.ToTensor(),
+        T.RandomGrayscale(p=1.0),
+        T.ToPILImage(),
+        SeededAlbumentation(A.GaussNoise(var_limit=(10.0, 150.0), mean=0, p=0.25)),
+        SeededAlbumentation(A.ImageCompression(quality_lower=0, quality_upper=100, p=0.20)),
+        T.ToPILImage(),
+    ])
+
+
+# presets that never add color, which grayscale textlines go through in a single channel
+GRAYSCALE_PRESETS = ("trdg", "simple")
+
+
+class ExpandToRGB:
+
+    # runs a color preset on grayscale textlines, expanding each to RGB right before it
+    def __init__(self, transform):
+        self.transform = transform
+        if hasattr(transform, "transform_batch"):
+            self.transform_batch = lambda images, seed_seqs=None: transform.transform_batch(
+                [x.convert("RGB") for x in images], seed_seqs)
+
+    def __call__(self, image):
+        return self.transform(image.convert("RGB"))
+
+
+def get_synth_transform(name, backend="torch", batched=False, grayscale=False):
+    # the other backends are only imported when asked for
+    if backend == "numpy":
+        from utils.np_transforms import NUMPY_TRANSFORM_DICT
+        transform = NUMPY_TRANSFORM_DICT[name]
+    elif batched:
+        from utils.batch_transforms import BATCH_TRANSFORM_DICT
+        transform = BATCH_TRANSFORM_DICT[name]
+    else:
+        transform = TRANSFORM_DICT[name]
+    if grayscale and not name in GRAYSCALE_PRESETS:
+        return ExpandToRGB(transform)
+    return transform